@@ -1,21 +1,19 @@
 from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from jose import JWTError, jwt
-from passlib.context import CryptContext
 from datetime import timedelta, datetime
 from typing import Optional
-import os
-import psycopg2
+from functools import lru_cache
 from pydantic import BaseModel
 import logging
+from psycopg2 import errors
+from db import get_db_connection, release_connection, execute
+from settings import get_settings
+from rate_limit import rate_limit, check_rate_limit
 
-# JWTやパスワードの設定
-SECRET_KEY = os.getenv("SECRET_KEY")
-if not SECRET_KEY:
-    raise Exception("SECRET_KEY is not set in environment variables")
+# JWTやパスワードの設定（SECRET_KEY の有無は create_app() で起動時に確認する）
 ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_MINUTES = 30
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")  # ここでインスタンス化
 
 # ブラックリストを定義（サインアウトしたトークンを保存）
@@ -23,34 +21,32 @@ BLACKLIST = set()
 
 auth_router = APIRouter()
 
-# データベース接続の設定
-def get_db_connection():
-    conn = psycopg2.connect(
-        host=os.getenv("DB_HOST"),
-        database=os.getenv("DB_NAME"),
-        user=os.getenv("DB_USER"),
-        password=os.getenv("DB_PASSWORD")
-    )
-    return conn
-
 # リクエストボディのモデル定義
 class UserCreate(BaseModel):
     email: str
     password: str
     sex: str
 
+# passlib と bcrypt バックエンドは読み込みが重いため、最初に使うときに読み込む
+@lru_cache
+def get_pwd_context():
+    from passlib.context import CryptContext
+    return CryptContext(schemes=["bcrypt"], deprecated="auto")
+
 # パスワードをハッシュ化する関数
 def hash_password(password: str):
-    return pwd_context.hash(password)
+    return get_pwd_context().hash(password)
 
 # データベースからユーザー情報を取得 (emailを使用)
 def get_user_from_db(email: str):
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute("SELECT user_id, email, password, sex FROM users WHERE email = %s", (email,))
-    user = cursor.fetchone()
-    cursor.close()
-    conn.close()
+    try:
+        execute(cursor, "get_user_by_email", (email,))
+        user = cursor.fetchone()
+    finally:
+        cursor.close()
+        release_connection(conn)
     if user:
         return {"user_id": user[0], "email": user[1], "hashed_password": user[2], "sex": user[3]}
     return None
@@ -62,24 +58,22 @@ def create_user_in_db(password: str, email: str, sex: str):
     hashed_password = hash_password(password)
     
     try:
-        cursor.execute(
-            """
-            INSERT INTO users (password, email, sex)
-            VALUES (%s, %s, %s)
-            """,
-            (hashed_password, email, sex),
-        )
+        execute(cursor, "insert_user", (hashed_password, email, sex))
         conn.commit()
+    except errors.UniqueViolation:
+        # 確認と INSERT の間に同じメールアドレスで登録された（users_email_key）
+        conn.rollback()
+        raise HTTPException(status_code=400, detail="Email already registered")
     except Exception as e:
         conn.rollback()
         raise HTTPException(status_code=500, detail=f"Error creating user: {str(e)}")
     finally:
         cursor.close()
-        conn.close()
+        release_connection(conn)
 
 # パスワード検証
 def verify_password(plain_password: str, hashed_password: str):
-    return pwd_context.verify(plain_password, hashed_password)
+    return get_pwd_context().verify(plain_password, hashed_password)
 
 # 認証処理 (emailで認証)
 def authenticate_user(email: str, password: str):
@@ -96,9 +90,9 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     if expires_delta:
         expire = datetime.utcnow() + expires_delta
     else:
-        expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+        expire = datetime.utcnow() + timedelta(minutes=get_settings().access_token_expire_minutes)
     to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY.encode('utf-8'), algorithm=ALGORITHM)
+    encoded_jwt = jwt.encode(to_encode, get_settings().secret_key.encode('utf-8'), algorithm=ALGORITHM)
     return encoded_jwt
 
 # トークンを無効化する関数
@@ -110,7 +104,7 @@ def decode_access_token(token: str):
     if token in BLACKLIST:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = jwt.decode(token, get_settings().secret_key, algorithms=[ALGORITHM])
         email: str = payload.get("sub")
         user_id: int = payload.get("user_id")  # トークンからuser_idを取得
         if email is None or user_id is None:
@@ -120,9 +114,11 @@ def decode_access_token(token: str):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
 
 # サインインエンドポイント (emailとpasswordで認証)
-@auth_router.post("/token")
+@auth_router.post("/token", dependencies=[Depends(rate_limit("token"))])
 async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
-    user = authenticate_user(form_data.username, form_data.password)  # emailで認証
+    # 同じアカウントへの総当たりを IP に関係なく制限する
+    await check_rate_limit("token_user", form_data.username.lower())
+    user = await run_in_threadpool(authenticate_user, form_data.username, form_data.password)  # emailで認証
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -130,7 +126,7 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
             headers={"WWW-Authenticate": "Bearer"},
         )
     
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    access_token_expires = timedelta(minutes=get_settings().access_token_expire_minutes)
     access_token = create_access_token(
         data={"sub": user["email"], "user_id": user["user_id"]},  # トークンにemailとuser_idを含める
         expires_delta=access_token_expires
@@ -139,14 +135,16 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
 
 # アカウント作成エンドポイント
 @auth_router.post("/signup")
-async def create_user(user: UserCreate):
+def create_user(user: UserCreate):
     # ユーザーが既に存在するかチェック
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute("SELECT * FROM users WHERE email = %s", (user.email,))
-    existing_user = cursor.fetchone()
-    cursor.close()
-    conn.close()
+    try:
+        execute(cursor, "user_exists", (user.email,))
+        existing_user = cursor.fetchone()
+    finally:
+        cursor.close()
+        release_connection(conn)
     
     if existing_user:
         raise HTTPException(status_code=400, detail="Email already registered")
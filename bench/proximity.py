@@ -0,0 +1,138 @@
+import argparse
+import math
+import random
+import statistics
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from psycopg2.extras import execute_values
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import geo
+from db import get_db_connection, release_connection, execute
+
+# 完全一致 (match_mode=exact) と近傍検索 (match_mode=proximity) の件数と所要時間を比べる
+# 注文はトランザクション内に投入し、最後にロールバックする（DBには何も残らない）
+
+ORIGINS = [
+    ("渋谷駅", 35.658034, 139.701636),
+    ("新宿駅", 35.689607, 139.700571),
+    ("池袋駅", 35.729503, 139.710900),
+    ("品川駅", 35.628471, 139.738760),
+    ("東京駅", 35.681236, 139.767125),
+]
+DESTINATIONS = [
+    ("東京ドーム", 35.705639, 139.751891),
+    ("水道橋駅", 35.702003, 139.753425),
+    ("後楽園駅", 35.707898, 139.751801),
+]
+# 同じ場所を指す表記ゆれ
+SUFFIXES = ["", "", " 東口", " 西口", "前", "（改札）"]
+CRITERIA = (1, 2, 1, False, "verified", "outward")
+
+
+def jitter(lat, lng, meters):
+    angle = random.uniform(0, 2 * math.pi)
+    distance = meters * math.sqrt(random.random())
+    dlat = distance * math.cos(angle) / geo.METERS_PER_DEGREE
+    dlng = distance * math.sin(angle) / (geo.METERS_PER_DEGREE * math.cos(math.radians(lat)))
+    return lat + dlat, lng + dlng
+
+
+def seed(cursor, orders, slots):
+    # users.email はユニークなので、既存のユーザーや同時に実行した別のベンチマークと重ならないアドレスにする
+    cursor.execute(
+        "INSERT INTO users (email, password, user_name) VALUES (%s, '-', 'bench') RETURNING user_id",
+        (f"bench-{uuid.uuid4().hex}@example.com",),
+    )
+    user_id = cursor.fetchone()[0]
+    cursor.execute("INSERT INTO events (event_title, start_time) VALUES ('bench', %s) RETURNING event_id", (slots[0],))
+    event_id = cursor.fetchone()[0]
+
+    rows = []
+    for _ in range(orders):
+        origin, origin_lat, origin_lng = random.choice(ORIGINS)
+        destination, destination_lat, destination_lng = random.choice(DESTINATIONS)
+        origin_lat, origin_lng = jitter(origin_lat, origin_lng, 300)
+        destination_lat, destination_lng = jitter(destination_lat, destination_lng, 300)
+        rows.append((
+            user_id, event_id, origin + random.choice(SUFFIXES), destination + random.choice(SUFFIXES),
+            random.choice(slots)) + CRITERIA + (
+            origin_lat, origin_lng, geo.encode(origin_lat, origin_lng),
+            destination_lat, destination_lng, geo.encode(destination_lat, destination_lng),
+        ))
+    execute_values(
+        cursor,
+        """
+        INSERT INTO orders (user_id, event_id, origin, destination, check_in_time, co_passenger, min_participants,
+                            back_seat_passengers, wants_female, id_verification_status, journey_type,
+                            origin_lat, origin_lng, origin_geohash, destination_lat, destination_lng, destination_geohash)
+        VALUES %s
+        """,
+        rows,
+        page_size=5000,
+    )
+    cursor.execute("ANALYZE orders")
+
+
+def measure(cursor, name, values, repeat):
+    timings = []
+    count = 0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        execute(cursor, name, values)
+        count = len(cursor.fetchall())
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return count, statistics.median(timings), timings[int(len(timings) * 0.95) - 1]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="search-orders の近傍検索のベンチマーク")
+    parser.add_argument("--orders", type=int, default=100000)
+    parser.add_argument("--slots", type=int, default=200, help="check_in_time の種類の数")
+    parser.add_argument("--radius", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+    random.seed(args.seed)
+
+    base = datetime.now().replace(minute=0, second=0, microsecond=0) + timedelta(days=1)
+    slots = [base + timedelta(hours=i) for i in range(args.slots)]
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        started = time.perf_counter()
+        seed(cursor, args.orders, slots)
+        print(f"seeded {args.orders} orders in {time.perf_counter() - started:.1f}s")
+
+        check_in_time = slots[0]
+        origin, origin_lat, origin_lng = ORIGINS[0]
+        destination, destination_lat, destination_lng = DESTINATIONS[0]
+        conditions = (check_in_time,) + CRITERIA + (0,)
+        destination_cells = geo.cover(destination_lat, destination_lng, args.radius)
+        cases = [
+            ("exact", "search_candidate_orders", (origin, destination) + conditions),
+            ("proximity", "search_nearby_orders", (
+                geo.cover(origin_lat, origin_lng, args.radius), len(destination_cells[0]), destination_cells,
+                origin_lat, origin_lng, destination_lat, destination_lng, args.radius,
+            ) + conditions),
+        ]
+        print(f"{'mode':<10} {'matches':>8} {'p50 ms':>8} {'p95 ms':>8}")
+        for label, name, values in cases:
+            count, p50, p95 = measure(cursor, name, values, args.repeat)
+            print(f"{label:<10} {count:>8} {p50:>8.2f} {p95:>8.2f}")
+    finally:
+        conn.rollback()
+        cursor.close()
+        release_connection(conn)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
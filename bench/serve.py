@@ -0,0 +1,108 @@
+import argparse
+import asyncio
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import httpx
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# serve.py をワーカー数を変えて起動し、同じ負荷をかけてスループットとレイテンシを比べる
+# 負荷をかける側もこのマシンのCPUを使うため、本番の数値は本番と同じ構成のマシンから別ホストで測ること
+
+
+async def wait_until_ready(base_url, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        while time.monotonic() < deadline:
+            try:
+                if (await client.get("/test-db-connection")).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError("server did not become ready")
+
+
+async def load(base_url, paths, concurrency, duration):
+    latencies = []
+    errors = 0
+    deadline = time.monotonic() + duration
+
+    async def client_loop(client, index):
+        nonlocal errors
+        i = index
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            try:
+                response = await client.get(paths[i % len(paths)])
+                if response.status_code >= 400:
+                    errors += 1
+            except httpx.TransportError:
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+            i += 1
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30.0) as client:
+        started = time.monotonic()
+        await asyncio.gather(*(client_loop(client, i) for i in range(concurrency)))
+        elapsed = time.monotonic() - started
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": len(latencies) / elapsed,
+        "p50": statistics.median(latencies) * 1000,
+        "p99": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+    }
+
+
+def run(workers, args):
+    bind = f"127.0.0.1:{args.port}"
+    server = subprocess.Popen(
+        [sys.executable, str(ROOT / "serve.py"), "--workers", str(workers), "--bind", bind],
+        cwd=ROOT,
+        env=dict(os.environ, WEB_ACCESS_LOG="false"),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        base_url = f"http://{bind}"
+        asyncio.run(wait_until_ready(base_url))
+        asyncio.run(load(base_url, args.path, args.concurrency, 1.0))  # 暖機
+        return asyncio.run(load(base_url, args.path, args.concurrency, args.duration))
+    finally:
+        # SIGTERM で終了させ、graceful に止まることも確かめる
+        server.send_signal(signal.SIGTERM)
+        server.wait(timeout=60)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="serve.py のワーカー数ごとのベンチマーク")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--path", nargs="+", default=["/search-events", "/events/1", "/test-db-connection"])
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args(argv)
+
+    print(f"cpus={os.cpu_count()} concurrency={args.concurrency} duration={args.duration}s paths={' '.join(args.path)}")
+    print(f"{'workers':>7} {'requests':>9} {'errors':>6} {'req/s':>9} {'p50 ms':>8} {'p99 ms':>8}")
+    for workers in args.workers:
+        result = run(workers, args)
+        print(
+            f"{workers:>7} {result['requests']:>9} {result['errors']:>6} {result['rps']:>9.1f} "
+            f"{result['p50']:>8.2f} {result['p99']:>8.2f}"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,28 +1,15 @@
 from fastapi import APIRouter, Depends, HTTPException
 from pydantic import BaseModel, Field
 from datetime import datetime
-import psycopg2
-import os
 import pytz
 import logging
+from db import get_db_connection, release_connection, execute
+from partitions import hot_since
 from auth import decode_access_token, oauth2_scheme  # auth.pyからoauth2_schemeをインポート
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# データベース接続関数
-def get_db_connection():
-    try:
-        conn = psycopg2.connect(
-            host=os.getenv("DB_HOST"),
-            database=os.getenv("DB_NAME"),
-            user=os.getenv("DB_USER"),
-            password=os.getenv("DB_PASSWORD")
-        )
-        return conn
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"DB connection error: {str(e)}")
-
 # リクエストボディ用のPydanticモデル
 class OrderCreate(BaseModel):
     event_id: int
@@ -56,23 +43,19 @@ def check_requested(user_id: int):
 
     logger.info("connection START")    
     # データベース接続を取得
-    conn = get_db_connection()
+    conn = get_db_connection("read", user_id=user_id)
     cursor = conn.cursor()
     logger.info("make cursor")    
 
     try:
         # 指定された注文のステータスを取得
-        query = """
-            SELECT * FROM orders
-            WHERE user_id = %s
-            AND status = 'requested';
-        """
-        values = (user_id,)  # タプル形式に変更
+        query = "get_requested_order"
+        values = (user_id, hot_since())  # タプル形式に変更
 
         logger.info(query)
         logger.info(values)
 
-        cursor.execute(query, values)
+        execute(cursor, query, values)
 
         logger.info("cursor execute DONE")
         result = cursor.fetchone()
@@ -84,16 +67,10 @@ def check_requested(user_id: int):
 
         logger.info(result[0])
 
-        query = """
-            SELECT users.user_name, users.rating, users.review_count, orders.order_id, orders.status
-            FROM orders
-            INNER JOIN users
-            ON orders.user_id = users.user_id
-            WHERE orders.user_id = %s ;
-        """
-        values = (result[16],)  # タプル形式に変更
+        query = "get_partner_profile"
+        values = (result[16], hot_since())  # タプル形式に変更
 
-        cursor.execute(query, values)
+        execute(cursor, query, values)
 
         result = cursor.fetchone()
         print('passing')
@@ -114,4 +91,4 @@ def check_requested(user_id: int):
 
     finally:
         cursor.close()
-        conn.close()
+        release_connection(conn)
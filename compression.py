@@ -0,0 +1,129 @@
+import gzip
+import logging
+
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+
+from http_cache import get_response_cache
+from settings import get_settings
+
+logger = logging.getLogger(__name__)
+
+# brotli / zstandard は入っていれば使う（無ければ gzip のみ）
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSIBLE_TYPES = ("application/json", "text/")
+
+
+def supported_encodings():
+    encodings = []
+    if brotli is not None:
+        encodings.append("br")
+    if zstandard is not None:
+        encodings.append("zstd")
+    encodings.append("gzip")
+    return encodings
+
+
+# Accept-Encoding から使う圧縮方式を選ぶ（q値が同じならサーバー側の優先順）
+def choose_encoding(accept_encoding):
+    weights = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        # q は他のパラメータの後ろにあってもよい（"gzip;foo=bar;q=0.5"）
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value.strip())
+                except ValueError:
+                    q = 0.0
+        weights[name] = q
+
+    best = None
+    best_q = 0.0
+    for encoding in supported_encodings():
+        q = weights.get(encoding, weights.get("*", 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def compress(data, encoding):
+    settings = get_settings()
+    if encoding == "br":
+        return brotli.compress(data, quality=settings.brotli_quality)
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=settings.zstd_level).compress(data)
+    return gzip.compress(data, compresslevel=settings.gzip_level)
+
+
+# レスポンスを圧縮するミドルウェア
+# 圧縮はスレッドプールで行い、ETag 付きのレスポンスは圧縮結果を ResponseCache に保存して使い回す
+class CompressionMiddleware:
+    def __init__(self, app, minimum_size=1024):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        encoding = choose_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        start = None
+        chunks = []
+
+        async def buffered_send(message):
+            nonlocal start
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+            chunks.append(message.get("body", b""))
+            if message.get("more_body", False):
+                return
+            await self.send_response(start, b"".join(chunks), encoding, send)
+
+        await self.app(scope, receive, buffered_send)
+
+    async def send_response(self, start, body, encoding, send):
+        headers = MutableHeaders(raw=start["headers"])
+        content_type = headers.get("content-type", "")
+        compressible = (
+            start["status"] == 200
+            and "content-encoding" not in headers
+            and content_type.startswith(COMPRESSIBLE_TYPES)
+            and len(body) >= self.minimum_size
+        )
+
+        if compressible:
+            headers.add_vary_header("Accept-Encoding")
+            if encoding is not None:
+                etag = headers.get("etag")
+                cache = get_response_cache()
+                data = cache.get(etag, encoding) if etag else None
+                if data is None:
+                    data = await run_in_threadpool(compress, body, encoding)
+                    if etag:
+                        cache.put(etag, data, encoding)
+                body = data
+                headers["Content-Encoding"] = encoding
+                headers["Content-Length"] = str(len(body))
+
+        await send(start)
+        await send({"type": "http.response.body", "body": body})
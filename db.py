@@ -0,0 +1,442 @@
+import logging
+import random
+import re
+import threading
+import time
+
+import psycopg2
+from psycopg2 import errors, extensions, pool
+from fastapi import HTTPException
+
+from queries import QUERIES
+from query_guard import current_statement_timeout, track_connection, untrack_connection
+from read_your_writes import record_write, required_lsn
+from settings import get_settings
+
+logger = logging.getLogger(__name__)
+
+_PARAM_RE = re.compile(r"\$(\d+)")
+
+
+# プリペアド済みのステートメント名を接続ごとに保持する接続クラス
+class PreparedConnection(extensions.connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+        self.owner = None  # 借りたプール
+        self.statement_timeout = None  # この接続に SET した statement_timeout（None はサーバーの既定値）
+
+
+# 空きが無いときは PoolError にせず、一定時間空きを待つコネクションプール
+class BlockingConnectionPool(pool.ThreadedConnectionPool):
+    def __init__(self, minconn, maxconn, timeout, *args, **kwargs):
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._timeout = timeout
+        super().__init__(minconn, maxconn, *args, **kwargs)
+
+    def getconn(self, key=None, timeout=None):
+        if not self._slots.acquire(timeout=self._timeout if timeout is None else timeout):
+            raise HTTPException(status_code=503, detail="DB connection pool exhausted")
+        try:
+            return super().getconn(key)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn, key=None, close=False):
+        try:
+            super().putconn(conn, key, close)
+        finally:
+            self._slots.release()
+
+
+def _make_pool(host, port=None):
+    settings = get_settings()
+    return BlockingConnectionPool(
+        settings.db_pool_min,
+        settings.db_pool_max,
+        settings.db_pool_timeout,
+        host=host,
+        port=port,
+        database=settings.db_name,
+        user=settings.db_user,
+        password=settings.db_password,
+        # auto: 5回目以降は汎用プランがカスタムプランより悪くない場合のみ汎用プランを使う
+        options=f"-c plan_cache_mode={settings.db_plan_cache_mode}",
+        connection_factory=PreparedConnection,
+    )
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+# プライマリ（書き込み先）のプール
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = _make_pool(get_settings().db_host, get_settings().db_port)
+    return _pool
+
+
+# リードレプリカ1台分の状態（ヘルスチェック結果とプール）
+# レプリカのヘルスチェックの接続タイムアウト（秒）
+REPLICA_CONNECT_TIMEOUT = 2
+
+
+class Replica:
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.pool = None
+        self.healthy = False  # 最初のチェックが済むまでは使わない
+        self.lag = 0.0  # 秒
+        self.replay_lsn = 0  # 最後のチェックの時点で再生済みの WAL の位置
+        self.checked_at = 0.0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def get_pool(self):
+        if self.pool is None:
+            with self.lock:
+                if self.pool is None:
+                    self.pool = _make_pool(self.host, self.port)
+        return self.pool
+
+    # レプリカの遅延を測る。レプリカでない（リカバリ中でない）インスタンスは遅延0として扱う
+    def check(self):
+        settings = get_settings()
+        conn = None
+        try:
+            conn = psycopg2.connect(
+                host=self.host,
+                port=self.port,
+                database=settings.db_name,
+                user=settings.db_user,
+                password=settings.db_password,
+                connect_timeout=REPLICA_CONNECT_TIMEOUT,
+            )
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                SELECT CASE
+                    WHEN NOT pg_is_in_recovery() THEN 0
+                    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                    ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+                END,
+                COALESCE(CASE
+                    WHEN pg_is_in_recovery() THEN pg_last_wal_replay_lsn()
+                    ELSE pg_current_wal_lsn()
+                END - '0/0', 0)
+                """
+            )
+            lag, replay_lsn = cursor.fetchone()
+            self.lag = float(lag)
+            self.replay_lsn = int(replay_lsn)
+            self.healthy = True
+            cursor.close()
+        except psycopg2.Error as e:
+            if self.healthy:
+                logger.warning(f"replica {self.host}:{self.port} is unhealthy: {str(e)}")
+            self.healthy = False
+        finally:
+            self.checked_at = time.monotonic()
+            if conn is not None:
+                conn.close()
+
+    # ヘルスチェックはリクエストのスレッドではなく、レプリカごとのバックグラウンドのスレッドで定期的に行う
+    # （止まった・遅いレプリカへの接続を、たまたまチェックの時刻に来た読み込みが待たないように）
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name=f"replica-check-{self.host}:{self.port}", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        interval = get_settings().db_replica_check_interval
+        while not self.stopped.is_set():
+            self.check()
+            self.stopped.wait(interval)
+
+    def stop(self):
+        self.stopped.set()
+
+    def mark_unhealthy(self):
+        self.healthy = False
+        self.checked_at = time.monotonic()
+
+    # 読み込みに使えるか。遅延は測った値だけで判断し、
+    # チェックのスレッドが止まっているなど、結果が古すぎる場合は使わない
+    def usable(self, max_lag):
+        expires = get_settings().db_replica_check_interval * 3 + REPLICA_CONNECT_TIMEOUT
+        return self.healthy and self.lag <= max_lag and time.monotonic() - self.checked_at <= expires
+
+
+_replicas = None
+_replicas_lock = threading.Lock()
+
+
+# DB_REPLICA_HOSTS からレプリカ一覧を作る
+def get_replicas():
+    global _replicas
+    if _replicas is None:
+        with _replicas_lock:
+            if _replicas is None:
+                replicas = [Replica(host, port) for host, port in get_settings().replica_hosts()]
+                for replica in replicas:
+                    replica.start()
+                _replicas = replicas
+    return _replicas
+
+
+# 書き込みをコミットした後に呼ぶ。このクライアントと user_ids のユーザーの読み込みは、
+# レプリカがこの書き込みを再生するまでプライマリに送る（read_your_writes.py）
+def mark_user_write(conn, *user_ids):
+    if not get_replicas():
+        return
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT pg_current_wal_insert_lsn() - '0/0'")
+        lsn = int(cursor.fetchone()[0])
+        conn.commit()
+    except psycopg2.Error as e:
+        # 書き込みはコミット済みなので失敗にはしない（この書き込みの直後の読み込みはレプリカに行きうる）
+        conn.rollback()
+        logger.warning(f"failed to read WAL position: {str(e)}")
+        return
+    finally:
+        cursor.close()
+    record_write(lsn, [user_id for user_id in user_ids if user_id is not None])
+
+
+def _choose_replica(user_id):
+    replicas = get_replicas()
+    if not replicas:
+        return None
+
+    max_lag = get_settings().db_replica_max_lag
+    required = required_lsn(user_id)
+
+    candidates = []
+    for replica in replicas:
+        if not replica.usable(max_lag):
+            continue
+        # 自分（または相手）の書き込みをまだ再生していない可能性があるレプリカは使わない
+        if required is not None and replica.replay_lsn < required:
+            continue
+        candidates.append(replica)
+
+    return random.choice(candidates) if candidates else None
+
+
+def close_pool():
+    global _pool, _replicas
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+    with _replicas_lock:
+        for replica in _replicas or []:
+            replica.stop()
+            if replica.pool is not None:
+                replica.pool.closeall()
+                replica.pool = None
+        _replicas = None
+
+
+# プールを通さずにプライマリへ接続する（LISTEN のように接続を占有し続ける用途）
+# 黙って切れた接続（NAT やロードバランサのアイドルタイムアウト、FIN の無いフェイルオーバー）を
+# libpq の既定（2時間）より早く検出できるよう、TCP キープアライブと送信のタイムアウトを短くする
+def open_connection():
+    settings = get_settings()
+    return psycopg2.connect(
+        host=settings.db_host,
+        port=settings.db_port,
+        database=settings.db_name,
+        user=settings.db_user,
+        password=settings.db_password,
+        connect_timeout=5,
+        keepalives=1,
+        keepalives_idle=10,
+        keepalives_interval=2,
+        keepalives_count=3,
+        tcp_user_timeout=10000,  # ミリ秒
+        connection_factory=PreparedConnection,
+    )
+
+
+# プールから接続を借りる
+# intent="read" の場合は使えるレプリカがあればレプリカから、無ければプライマリから借りる
+def get_db_connection(intent="write", user_id=None):
+    if intent == "read":
+        replica = _choose_replica(user_id)
+        if replica is not None:
+            try:
+                # レプリカの空きは待たない（埋まっていればプライマリへ）
+                conn = replica.get_pool().getconn(timeout=0)
+                conn.owner = replica.pool
+                return _checkout(conn)
+            except HTTPException:
+                # レプリカのプールが埋まっている場合はプライマリへ
+                pass
+            except Exception as e:
+                replica.mark_unhealthy()
+                logger.warning(f"replica {replica.host}:{replica.port} connection failed: {str(e)}")
+
+    try:
+        conn = get_pool().getconn()
+        conn.owner = get_pool()
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"DB connection error: {str(e)}")
+    return _checkout(conn)
+
+
+# 借りた接続に、このリクエストの statement_timeout を設定し、切断時にキャンセルできるよう登録する
+# 値が前回と同じなら何もしない（同じルートが続く限り往復は増えない）
+def _checkout(conn):
+    timeout = current_statement_timeout()
+    if timeout != conn.statement_timeout:
+        try:
+            conn.autocommit = True
+            cursor = conn.cursor()
+            if timeout is None:
+                cursor.execute("RESET statement_timeout")
+            else:
+                cursor.execute("SET statement_timeout = %s", (timeout,))
+            cursor.close()
+            conn.autocommit = False
+            conn.statement_timeout = timeout
+        except Exception as e:
+            release_connection(conn)
+            raise HTTPException(status_code=500, detail=f"DB connection error: {str(e)}")
+    track_connection(conn)
+    return conn
+
+
+# 借りた接続を借りたプールに返す（未完了のトランザクションはロールバックする）
+def release_connection(conn):
+    untrack_connection(conn)
+    owner = conn.owner
+    if conn.closed:
+        owner.putconn(conn, close=True)
+        return
+    try:
+        if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+            conn.rollback()
+    except psycopg2.Error:
+        owner.putconn(conn, close=True)
+        return
+    owner.putconn(conn)
+
+
+def _statement_sql(name):
+    sql = QUERIES[name]
+    params = {int(n) for n in _PARAM_RE.findall(sql)}
+    count = max(params) if params else 0
+    placeholders = ", ".join(["%s"] * count)
+    prepare_sql = f"PREPARE {name} AS {sql}"
+    execute_sql = f"EXECUTE {name} ({placeholders})" if count else f"EXECUTE {name}"
+    return prepare_sql, execute_sql
+
+
+_STATEMENTS = {name: _statement_sql(name) for name in QUERIES}
+
+
+# 登録済みのステートメントを名前で実行する
+# 接続で未PREPAREなら初回にPREPAREし、以降はEXECUTEのみ送る（パース・プランのコストを省く）
+def execute(cursor, name, params=()):
+    conn = cursor.connection
+    prepare_sql, execute_sql = _STATEMENTS[name]
+    # トランザクション外で始めた場合のみ、失敗時にロールバックして1回だけやり直せる
+    can_retry = conn.get_transaction_status() == extensions.TRANSACTION_STATUS_IDLE
+
+    for attempt in range(2):
+        try:
+            if name not in conn.prepared:
+                cursor.execute(prepare_sql)
+                conn.prepared.add(name)
+            cursor.execute(execute_sql, params)
+            return cursor
+        except errors.InvalidSqlStatementName:
+            # 接続側でステートメントが破棄されていた (DISCARD ALL など)
+            conn.prepared.clear()
+            if not can_retry or attempt:
+                raise
+            conn.rollback()
+        except errors.FeatureNotSupported:
+            # スキーマ変更でキャッシュされたプランの結果型が変わった
+            conn.rollback()
+            _deallocate(conn, name)
+            if not can_retry or attempt:
+                raise
+        except errors.DuplicatePreparedStatement:
+            # 接続上には既にある（トラッキングだけが漏れていた）
+            conn.prepared.add(name)
+            if not can_retry or attempt:
+                raise
+            conn.rollback()
+
+
+# 登録済みのステートメントの実行計画を返す（migrate.py check-plans 用）
+def explain(cursor, name, params=()):
+    conn = cursor.connection
+    prepare_sql, execute_sql = _STATEMENTS[name]
+    if name not in conn.prepared:
+        cursor.execute(prepare_sql)
+        conn.prepared.add(name)
+    cursor.execute("EXPLAIN (FORMAT JSON) " + execute_sql, params)
+    return cursor.fetchone()[0]
+
+
+def _deallocate(conn, name):
+    conn.prepared.discard(name)
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"DEALLOCATE {name}")
+        conn.commit()
+    except psycopg2.Error:
+        conn.rollback()
+    finally:
+        cursor.close()
+
+
+# プール内の接続で全ステートメントを事前にPREPAREしておく
+def prepare_all(conn):
+    cursor = conn.cursor()
+    try:
+        for name, (prepare_sql, _) in _STATEMENTS.items():
+            if name in conn.prepared:
+                continue
+            try:
+                cursor.execute(prepare_sql)
+                conn.commit()
+                conn.prepared.add(name)
+            except psycopg2.Error as e:
+                conn.rollback()
+                logger.warning(f"failed to prepare {name}: {str(e)}")
+    finally:
+        cursor.close()
+
+
+# 起動時にプールの接続を張り、各接続で全ステートメントをPREPAREしておく
+def warm_pool():
+    pools = [(get_pool(), None)] + [(replica.get_pool(), replica) for replica in get_replicas()]
+    for warm_target, replica in pools:
+        conns = []
+        try:
+            for _ in range(max(get_settings().db_pool_min, 1)):
+                conn = warm_target.getconn(timeout=0)
+                conn.owner = warm_target
+                conns.append(conn)
+                prepare_all(conn)
+        except Exception as e:
+            if replica is None:
+                raise
+            replica.mark_unhealthy()
+            logger.warning(f"replica {replica.host}:{replica.port} warm-up failed: {str(e)}")
+        finally:
+            for conn in conns:
+                release_connection(conn)
@@ -0,0 +1,98 @@
+import argparse
+import logging
+import select
+import sys
+import time
+
+from db import get_db_connection, release_connection
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 複数プロセスが同時にリフレッシュしないためのアドバイザリロックのキー
+REFRESH_LOCK_KEY = 727002
+
+
+# カタログが前回のリフレッシュ以降に変わっていれば event_listing をリフレッシュする
+# CONCURRENTLY なのでリフレッシュ中も search_events の読み込みはブロックされない
+def refresh_event_listing(force=False):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT pg_try_advisory_xact_lock(%s)", (REFRESH_LOCK_KEY,))
+        if not cursor.fetchone()[0]:
+            logger.info("event_listing refresh is already running")
+            return False
+
+        cursor.execute(
+            """
+            SELECT v.version, s.refreshed_version
+            FROM catalog_version v, event_listing_state s
+            WHERE v.id = 1 AND s.id = 1
+            """
+        )
+        version, refreshed_version = cursor.fetchone()
+        if not force and refreshed_version >= version:
+            return False
+
+        started = time.monotonic()
+        cursor.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY event_listing")
+        cursor.execute(
+            "UPDATE event_listing_state SET refreshed_version = %s, refreshed_at = now() WHERE id = 1",
+            (version,),
+        )
+        conn.commit()
+        logger.info(f"event_listing refreshed to catalog version {version} in {time.monotonic() - started:.2f}s")
+        return True
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        release_connection(conn)
+
+
+# catalog_changed の通知を待ち受け、まとめてリフレッシュする
+# 連続した更新は debounce 秒だけ待ってから1回のリフレッシュにまとめる
+def listen_and_refresh(debounce=2.0, interval=300.0):
+    conn = get_db_connection()
+    try:
+        conn.autocommit = True
+        cursor = conn.cursor()
+        cursor.execute("LISTEN catalog_changed")
+        refresh_event_listing()
+
+        while True:
+            # 通知を取りこぼした場合に備え、interval 秒ごとにもバージョンを確認する
+            if select.select([conn], [], [], interval) == ([], [], []):
+                refresh_event_listing()
+                continue
+            conn.poll()
+            conn.notifies.clear()
+
+            # 続けて届く通知を debounce 秒間まとめる
+            while select.select([conn], [], [], debounce) != ([], [], []):
+                conn.poll()
+                conn.notifies.clear()
+            refresh_event_listing()
+    finally:
+        conn.autocommit = False
+        release_connection(conn)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="event_listing のリフレッシュ")
+    parser.add_argument("--once", action="store_true", help="1回だけリフレッシュして終了する")
+    parser.add_argument("--force", action="store_true", help="カタログに変更が無くてもリフレッシュする")
+    parser.add_argument("--debounce", type=float, default=2.0)
+    args = parser.parse_args(argv)
+
+    if args.once or args.force:
+        refresh_event_listing(force=args.force)
+    else:
+        listen_and_refresh(debounce=args.debounce)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
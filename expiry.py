@@ -0,0 +1,139 @@
+import argparse
+import asyncio
+import logging
+import sys
+from datetime import datetime, timedelta, timezone
+
+from starlette.concurrency import run_in_threadpool
+
+from db import get_db_connection, release_connection, execute, mark_user_write
+from partitions import now_jst
+from send_email import send_emails
+from settings import get_settings
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 複数のワーカー・プロセスのうち1つだけが整理するためのアドバイザリロックのキー
+EXPIRY_LOCK_KEY = 727004
+
+SUBJECTS = {
+    "expire_past_orders": "[あいタク] 募集が終了しました",
+    "revert_stale_requests": "[あいタク] 相乗りの依頼が確定されませんでした",
+}
+
+
+def notification_body(query, origin, destination, check_in_time):
+    route = f"{check_in_time:%Y-%m-%d %H:%M} 集合の {origin} → {destination}"
+    if query == "expire_past_orders":
+        return f"{route} の募集は、相乗りが成立しないまま集合時刻を過ぎたため終了しました。"
+    return f"{route} の相乗りの依頼が確定されなかったため、注文を募集中に戻しました。"
+
+
+# query の UPDATE を batch_size 件ずつ、対象が無くなるまで繰り返す（params は $3 以降のパラメータ）
+# 各バッチのトランザクションでロックを取り、取れなければ（他が実行中なら）やめる
+def run_batches(conn, query, cutoff, batch_size, *params):
+    cursor = conn.cursor()
+    updated = []
+    try:
+        while True:
+            cursor.execute("SELECT pg_try_advisory_xact_lock(%s)", (EXPIRY_LOCK_KEY,))
+            if not cursor.fetchone()[0]:
+                conn.rollback()
+                break
+            execute(cursor, query, (cutoff, batch_size) + params)
+            rows = cursor.fetchall()
+            conn.commit()
+            updated += rows
+            if len(rows) < batch_size:
+                break
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+    return updated
+
+
+# 通知する (宛先, 件名, 本文) のリストを作る（メールアドレスを取得するだけで、送信はしない）
+# notify_since より前に集合する注文は知らせない（初回の実行でずっと前の注文をまとめて期限切れにしたときなど）
+def notification_messages(conn, results, notify_since):
+    results = {query: [row for row in rows if row[4] >= notify_since] for query, rows in results.items()}
+    user_ids = list({row[1] for rows in results.values() for row in rows})
+    if not user_ids:
+        return []
+    cursor = conn.cursor()
+    try:
+        execute(cursor, "get_user_emails", (user_ids,))
+        emails = dict(cursor.fetchall())
+        conn.commit()
+    finally:
+        cursor.close()
+
+    messages = []
+    for query, rows in results.items():
+        for order_id, user_id, origin, destination, check_in_time in rows:
+            email = emails.get(user_id)
+            if email:
+                messages.append((email, SUBJECTS[query], notification_body(query, origin, destination, check_in_time)))
+    return messages
+
+
+# 集合時刻を過ぎても成立していない注文を expired に、確定されない requested / approved_waiting を waiting に戻す
+def run_expiry_once():
+    settings = get_settings()
+    # check_in_time はタイムゾーン無し（日本時間）、requested_at / updated_at はタイムゾーン付き
+    waiting_cutoff = now_jst() - timedelta(minutes=settings.expiry_waiting_grace_minutes)
+    request_cutoff = datetime.now(timezone.utc) - timedelta(minutes=settings.expiry_request_timeout_minutes)
+
+    messages = []
+    conn = get_db_connection()
+    try:
+        results = {
+            "expire_past_orders": run_batches(conn, "expire_past_orders", waiting_cutoff, settings.expiry_batch_size),
+            "revert_stale_requests": run_batches(conn, "revert_stale_requests", request_cutoff, settings.expiry_batch_size, waiting_cutoff),
+        }
+        for query, rows in results.items():
+            if not rows:
+                continue
+            logger.info(f"{query}: {len(rows)} orders")
+            mark_user_write(conn, *{row[1] for row in rows})
+        if settings.expiry_notify and settings.smtp_server:
+            notify_since = waiting_cutoff - timedelta(hours=settings.expiry_notify_max_age_hours)
+            messages = notification_messages(conn, results, notify_since)
+    finally:
+        release_connection(conn)
+
+    # SMTP の送信中はプールの接続を持たない。1回の実行で1つの SMTP セッションを使う
+    if messages:
+        failed = send_emails(messages)
+        if failed:
+            logger.warning(f"failed to send {len(failed)} of {len(messages)} expiry notifications")
+    return {query: len(rows) for query, rows in results.items()}
+
+
+# アプリの lifespan から起動する定期実行のタスク（EXPIRY_ENABLED のとき）
+async def expiry_loop():
+    interval = get_settings().expiry_interval
+    while True:
+        try:
+            await run_in_threadpool(run_expiry_once)
+        except Exception as e:
+            logger.warning(f"order expiry failed: {str(e)}")
+        await asyncio.sleep(interval)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="期限切れの注文の整理")
+    parser.add_argument("--once", action="store_true", help="1回だけ実行して終了する（cron 用）")
+    args = parser.parse_args(argv)
+
+    if args.once:
+        run_expiry_once()
+        return 0
+    asyncio.run(expiry_loop())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
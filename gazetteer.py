@@ -0,0 +1,129 @@
+import argparse
+import logging
+import re
+import sys
+import threading
+import time
+import unicodedata
+
+import geo
+from db import get_db_connection, release_connection, execute
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 未知の地名を受け取ったらこの間隔で再読み込みを許す（集合場所の追加に追従する）
+RELOAD_INTERVAL = 60.0
+
+SPACES_RE = re.compile(r"\s+")
+
+
+# 全角・半角や空白の違いを吸収する
+def normalize(name):
+    return SPACES_RE.sub("", unicodedata.normalize("NFKC", name))
+
+
+# 地名 -> 座標の辞書（places と check_in_place。起動時に読み込み、プロセス内で使い回す）
+class Gazetteer:
+    def __init__(self, places):
+        # places: [(name, lat, lng)]
+        self.coordinates = {}
+        for name, lat, lng in places:
+            self.coordinates.setdefault(normalize(name), (lat, lng))
+        self.loaded_at = time.monotonic()
+
+    # 完全一致が無ければ、登録された地名で始まる最も長いもの（「渋谷駅 ハチ公口」→「渋谷駅」）を使う
+    def resolve(self, name):
+        key = normalize(name)
+        for length in range(len(key), 1, -1):
+            coordinates = self.coordinates.get(key[:length])
+            if coordinates is not None:
+                return coordinates
+        return None
+
+
+_gazetteer = None
+_gazetteer_lock = threading.Lock()
+
+
+def load_gazetteer():
+    global _gazetteer
+    conn = get_db_connection("read")
+    cursor = conn.cursor()
+    try:
+        execute(cursor, "list_places")
+        places = cursor.fetchall()
+    finally:
+        cursor.close()
+        release_connection(conn)
+    _gazetteer = Gazetteer(places)
+    logger.info(f"gazetteer loaded: {len(_gazetteer.coordinates)} places")
+    return _gazetteer
+
+
+def get_gazetteer():
+    if _gazetteer is None:
+        with _gazetteer_lock:
+            if _gazetteer is None:
+                load_gazetteer()
+    return _gazetteer
+
+
+# 地名を (lat, lng, geohash) に変換する。見つからなければ (None, None, None)
+def resolve(name):
+    coordinates = get_gazetteer().resolve(name)
+    if coordinates is None:
+        with _gazetteer_lock:
+            if time.monotonic() - _gazetteer.loaded_at > RELOAD_INTERVAL:
+                load_gazetteer()
+        coordinates = _gazetteer.resolve(name)
+    if coordinates is None:
+        return None, None, None
+    lat, lng = coordinates
+    return lat, lng, geo.encode(lat, lng)
+
+
+# 座標が未設定の注文を、地名辞書から埋める（マイグレーション後や places の追加後に実行する）
+def backfill(batch_size=1000):
+    load_gazetteer()
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    updated = 0
+    last_order_id = 0
+    try:
+        while True:
+            execute(cursor, "list_orders_without_coordinates", (last_order_id, batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            for order_id, check_in_time, origin, destination in rows:
+                origin_point = resolve(origin)
+                destination_point = resolve(destination)
+                if origin_point[2] is None and destination_point[2] is None:
+                    continue
+                execute(cursor, "set_order_coordinates", (order_id, check_in_time) + origin_point + destination_point)
+                updated += 1
+            conn.commit()
+            last_order_id = rows[-1][0]
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        release_connection(conn)
+    logger.info(f"backfilled coordinates for {updated} orders")
+    return updated
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="地名辞書から注文の座標を埋める")
+    parser.add_argument("command", choices=["backfill"])
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args(argv)
+    if args.command == "backfill":
+        backfill(args.batch_size)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
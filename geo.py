@@ -0,0 +1,101 @@
+import math
+
+# ジオハッシュで使う base32 の文字（a, i, l, o を除く）
+BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+EARTH_RADIUS_M = 6371008.8
+METERS_PER_DEGREE = 2 * math.pi * EARTH_RADIUS_M / 360
+
+# orders に保存するジオハッシュの桁数（9桁でおよそ 5m 四方）
+STORED_PRECISION = 9
+
+
+def encode(lat, lng, precision=STORED_PRECISION):
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    bit_count = 0
+    even = True  # 偶数ビットは経度、奇数ビットは緯度
+    while len(chars) < precision:
+        value, value_range = (lng, lng_range) if even else (lat, lat_range)
+        mid = (value_range[0] + value_range[1]) / 2
+        bits <<= 1
+        if value >= mid:
+            bits |= 1
+            value_range[0] = mid
+        else:
+            value_range[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(BASE32[bits])
+            bits = 0
+            bit_count = 0
+    return "".join(chars)
+
+
+# ジオハッシュのセルの (緯度の幅, 経度の幅)（度）
+def cell_size(precision):
+    lng_bits = (5 * precision + 1) // 2
+    lat_bits = 5 * precision // 2
+    return 180.0 / 2 ** lat_bits, 360.0 / 2 ** lng_bits
+
+
+# 中心座標を返す
+def decode(geohash):
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    even = True
+    for char in geohash:
+        index = BASE32.index(char)
+        for shift in range(4, -1, -1):
+            value_range = lng_range if even else lat_range
+            mid = (value_range[0] + value_range[1]) / 2
+            if index >> shift & 1:
+                value_range[0] = mid
+            else:
+                value_range[1] = mid
+            even = not even
+    return (lat_range[0] + lat_range[1]) / 2, (lng_range[0] + lng_range[1]) / 2
+
+
+# 隣接する8セルと自身（重複を除く。極付近では数が減る）
+def neighbours(geohash):
+    precision = len(geohash)
+    lat, lng = decode(geohash)
+    lat_size, lng_size = cell_size(precision)
+    cells = []
+    for dlat in (-1, 0, 1):
+        for dlng in (-1, 0, 1):
+            cell_lat = lat + dlat * lat_size
+            if not -90.0 < cell_lat < 90.0:
+                continue
+            cell_lng = (lng + dlng * lng_size + 180.0) % 360.0 - 180.0
+            cell = encode(cell_lat, cell_lng, precision)
+            if cell not in cells:
+                cells.append(cell)
+    return cells
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    dlat = math.radians(lat2 - lat1)
+    dlng = math.radians(lng2 - lng1)
+    a = math.sin(dlat / 2) ** 2 + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dlng / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+
+# 半径 radius_m の円が「中心セル + 隣接8セル」に収まる最も細かい桁数
+def precision_for_radius(lat, radius_m):
+    for precision in range(STORED_PRECISION, 0, -1):
+        lat_size, lng_size = cell_size(precision)
+        height = lat_size * METERS_PER_DEGREE
+        width = lng_size * METERS_PER_DEGREE * math.cos(math.radians(lat))
+        if height >= radius_m and width >= radius_m:
+            return precision
+    return 1
+
+
+# 座標から半径 radius_m 以内を含むセル（ジオハッシュの前方一致で検索する）
+def cover(lat, lng, radius_m):
+    precision = precision_for_radius(lat, radius_m)
+    return neighbours(encode(lat, lng, precision))
@@ -0,0 +1,141 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from datetime import timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import NamedTuple
+
+from fastapi import Request, Response
+
+from db import get_db_connection, release_connection, execute
+from settings import get_settings
+
+
+# カタログの版。event_listing はリフレッシュされるまでカタログより古いことがあるため別に持つ
+class CatalogVersion(NamedTuple):
+    catalog_version: int
+    catalog_updated_at: object
+    listing_version: int
+    listing_refreshed_at: object
+
+
+_version = None
+_version_at = 0.0
+_version_lock = threading.Lock()
+
+
+# 版はリクエストごとに読むと重いため、catalog_version_ttl 秒だけプロセス内で使い回す
+def get_catalog_version():
+    global _version, _version_at
+    ttl = get_settings().catalog_version_ttl
+    if _version is not None and time.monotonic() - _version_at < ttl:
+        return _version
+    with _version_lock:
+        if _version is not None and time.monotonic() - _version_at < ttl:
+            return _version
+        conn = get_db_connection("read")
+        cursor = conn.cursor()
+        try:
+            execute(cursor, "get_catalog_version")
+            _version = CatalogVersion(*cursor.fetchone())
+            _version_at = time.monotonic()
+        finally:
+            cursor.close()
+            release_connection(conn)
+    return _version
+
+
+# 版とURL（パス + クエリ）から ETag を作る。URLが違えば表現も違うので別の値にする
+def make_etag(kind, version, request: Request):
+    query = sorted(request.query_params.multi_items())
+    digest = hashlib.sha1(f"{request.url.path}?{query}".encode("utf-8")).hexdigest()[:16]
+    return f'W/"{kind}{version}-{digest}"'
+
+
+def cache_headers(etag, last_modified):
+    return {
+        "ETag": etag,
+        "Last-Modified": format_datetime(last_modified.astimezone(timezone.utc), usegmt=True),
+        "Cache-Control": f"public, max-age={get_settings().event_cache_max_age}",
+    }
+
+
+def _etag_matches(header, etag):
+    if header.strip() == "*":
+        return True
+    # 弱い比較（W/ の有無を無視する）
+    target = etag[2:] if etag.startswith("W/") else etag
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == target:
+            return True
+    return False
+
+
+# If-None-Match があればそれを、無ければ If-Modified-Since を見る
+def is_not_modified(request: Request, etag, last_modified):
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return _etag_matches(if_none_match, etag)
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        return last_modified.replace(microsecond=0) <= since
+    return False
+
+
+# 304 にも 200 と同じ Vary を付ける（圧縮方式ごとにキャッシュした表現を取り違えないように）
+def not_modified_response(headers):
+    response = Response(status_code=304, headers=headers)
+    vary = [value.strip().lower() for value in response.headers.get("vary", "").split(",")]
+    if "accept-encoding" not in vary:
+        response.headers.add_vary_header("Accept-Encoding")
+    return response
+
+
+# ETag をキーに、レスポンス本文とその圧縮済みの表現を保持する LRU キャッシュ
+# ETag は版とURLから決まるため、版が変われば古いエントリは参照されずに追い出される
+class ResponseCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()  # etag -> {encoding: bytes}（非圧縮は "identity"）
+        self.lock = threading.Lock()
+
+    def get(self, etag, encoding="identity"):
+        with self.lock:
+            entry = self.entries.get(etag)
+            if entry is None:
+                return None
+            self.entries.move_to_end(etag)
+            return entry.get(encoding)
+
+    def put(self, etag, data, encoding="identity"):
+        if len(data) > self.max_bytes:
+            return
+        with self.lock:
+            entry = self.entries.setdefault(etag, {})
+            self.entries.move_to_end(etag)
+            self.size += len(data) - len(entry.get(encoding, b""))
+            entry[encoding] = data
+            while self.size > self.max_bytes and self.entries:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= sum(len(v) for v in evicted.values())
+
+
+_response_cache = None
+
+
+def get_response_cache():
+    global _response_cache
+    if _response_cache is None:
+        _response_cache = ResponseCache(get_settings().response_cache_bytes)
+    return _response_cache
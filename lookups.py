@@ -0,0 +1,77 @@
+import logging
+import threading
+import time
+
+from db import get_db_connection, release_connection, execute
+
+logger = logging.getLogger(__name__)
+
+# ジャンルは events の登録時に増えるため、未知の名称を受け取ったらこの間隔で再読み込みを許す
+RELOAD_INTERVAL = 60.0
+
+
+# 都道府県・ジャンルのコード表（起動時に読み込み、プロセス内で使い回す）
+class Lookups:
+    def __init__(self, prefectures, genres):
+        # prefectures: [(prefecture_code, name, full_name)], genres: [(genre_code, name)]
+        self.prefectures = prefectures
+        self.genres = genres
+        self.prefecture_codes = {}
+        for code, name, full_name in prefectures:
+            self.prefecture_codes[name] = code
+            self.prefecture_codes[full_name] = code
+        self.genre_codes = {name: code for code, name in genres}
+        self.loaded_at = time.monotonic()
+
+    # 「東京都」「東京」のどちらでもコードに変換する（未知の名称は None）
+    def prefecture_code(self, name):
+        return self.prefecture_codes.get(name)
+
+    def genre_code(self, name):
+        return self.genre_codes.get(name)
+
+
+_lookups = None
+_lookups_lock = threading.Lock()
+
+
+def load_lookups():
+    global _lookups
+    conn = get_db_connection("read")
+    cursor = conn.cursor()
+    try:
+        execute(cursor, "list_prefectures")
+        prefectures = cursor.fetchall()
+        execute(cursor, "list_genres")
+        genres = cursor.fetchall()
+    finally:
+        cursor.close()
+        release_connection(conn)
+    _lookups = Lookups(prefectures, genres)
+    logger.info(f"lookups loaded: {len(prefectures)} prefectures, {len(genres)} genres")
+    return _lookups
+
+
+def get_lookups():
+    if _lookups is None:
+        with _lookups_lock:
+            if _lookups is None:
+                load_lookups()
+    return _lookups
+
+
+# 名称のリストをコードのリストに変換する
+# 未知の名称があれば（間隔を空けて）コード表を読み直し、それでも無いものは除外する
+def genre_codes_for(names):
+    lookups = get_lookups()
+    if any(lookups.genre_code(name) is None for name in names):
+        with _lookups_lock:
+            if time.monotonic() - _lookups.loaded_at > RELOAD_INTERVAL:
+                load_lookups()
+        lookups = _lookups
+    return [code for code in (lookups.genre_code(name) for name in names) if code is not None]
+
+
+def prefecture_codes_for(names):
+    lookups = get_lookups()
+    return [code for code in (lookups.prefecture_code(name) for name in names) if code is not None]
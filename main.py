@@ -1,8 +1,21 @@
-from fastapi import FastAPI, HTTPException
+from contextlib import asynccontextmanager
+import asyncio
+import contextlib
+import logging
+import time
+from fastapi import APIRouter, FastAPI, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from dotenv import load_dotenv
-import psycopg2
-import os
+from db import get_db_connection, release_connection, execute, warm_pool, close_pool
+from lookups import load_lookups
+from gazetteer import load_gazetteer
+from matching_index import start_matching_index, stop_matching_index
+from expiry import expiry_loop
+from settings import get_settings
+from rate_limit import ConcurrencyLimitMiddleware, rate_limit_router
+from compression import CompressionMiddleware
+from query_guard import QueryCancellationMiddleware, add_query_canceled_handlers
+from read_your_writes import ReadYourWritesMiddleware
 from auth import auth_router  # auth.pyからauth_routerをインポート
 from search import search_router  # search.pyのルーターをインポート
 from orders import order_router  # orders.pyのルーターをインポート
@@ -11,85 +24,139 @@ from update_accept_order import update_accept_order_router, matching_router
 from check_requested import check_requested_router
 from send_email import send_email_router
 
-load_dotenv()
+logger = logging.getLogger(__name__)
 
-app = FastAPI()
+# main.py 直下のエンドポイント用
+root_router = APIRouter()
 
-# CORSミドルウェアの追加
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],  # 全てのオリジンからのアクセスを許可
-    allow_credentials=True,
-    allow_methods=["*"],  # 全てのHTTPメソッドを許可
-    allow_headers=["*"],  # 全てのヘッダーを許可
-)
 
-# auth.pyからルーターを追加
-app.include_router(auth_router)
+# 起動時の準備: プールの接続を張ってステートメントをPREPAREし、コード表を読み込む
+# DBに繋がらなくても起動は続ける（接続は最初のリクエストで張り直す）
+def warm_up():
+    started = time.monotonic()
+    try:
+        warm_pool()
+        load_lookups()
+        load_gazetteer()
+    except Exception as e:
+        logger.warning(f"warm-up failed: {str(e)}")
+    logger.info(f"warm-up finished in {time.monotonic() - started:.2f}s")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await run_in_threadpool(warm_up)
+    start_matching_index()
+    # 期限切れの注文の整理（全ワーカーで動かしても、アドバイザリロックで同時に実行するのは1つだけ）
+    expiry_task = asyncio.create_task(expiry_loop()) if get_settings().expiry_enabled else None
+    yield
+    if expiry_task is not None:
+        expiry_task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await expiry_task
+    await run_in_threadpool(stop_matching_index)
+    await run_in_threadpool(close_pool)
+
+
+def create_app() -> FastAPI:
+    settings = get_settings()
+    if not settings.secret_key:
+        raise Exception("SECRET_KEY is not set in environment variables")
+
+    app = FastAPI(lifespan=lifespan)
+
+    # クエリが statement_timeout を超えたら 503 (Retry-After) を返す
+    add_query_canceled_handlers(app)
+
+    # クライアントが切断したら、そのリクエストが実行中のクエリをキャンセルする
+    app.add_middleware(QueryCancellationMiddleware)
+
+    # 書き込んだクライアントに Cookie で WAL の位置を返し、レプリカが追いつくまで読み込みをプライマリに送る
+    app.add_middleware(ReadYourWritesMiddleware)
+
+    # CORSミドルウェアの追加
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],  # 全てのオリジンからのアクセスを許可
+        allow_credentials=True,
+        allow_methods=["*"],  # 全てのHTTPメソッドを許可
+        allow_headers=["*"],  # 全てのヘッダーを許可
+    )
 
-# search.py用ルーターを追加
-app.include_router(search_router)
+    # レスポンスの圧縮 (br / zstd / gzip)
+    app.add_middleware(CompressionMiddleware, minimum_size=settings.compression_min_size)
 
-# orders.py用ルーターを追加
-app.include_router(order_router)
+    # 同時処理数の上限（CORS より外側に置き、混雑時はルーティング前に返す）
+    app.add_middleware(ConcurrencyLimitMiddleware, limit=settings.max_concurrent_requests)
 
-# search_candidates.py用ルーターを追加
-app.include_router(search_candidates_router)
+    # auth.pyからルーターを追加
+    app.include_router(auth_router)
 
-# update_accept_order.py用
-app.include_router(update_accept_order_router)
-app.include_router(matching_router)
+    # search.py用ルーターを追加
+    app.include_router(search_router)
 
-# check_requested.py用
-app.include_router(check_requested_router)
+    # orders.py用ルーターを追加
+    app.include_router(order_router)
 
-# send_email_router.py用
-app.include_router(send_email_router)
+    # search_candidates.py用ルーターを追加
+    app.include_router(search_candidates_router)
+
+    # update_accept_order.py用
+    app.include_router(update_accept_order_router)
+    app.include_router(matching_router)
+
+    # check_requested.py用
+    app.include_router(check_requested_router)
+
+    # send_email_router.py用
+    app.include_router(send_email_router)
+
+    # rate_limit.py用（運用者向け。RATE_LIMIT_STATS_TOKEN を設定したときだけ）
+    if settings.rate_limit_stats_token:
+        app.include_router(rate_limit_router)
+
+    # main.py のエンドポイント
+    app.include_router(root_router)
+
+    return app
 
 # クラスでDB接続を管理
 class Database:
+    def __init__(self, intent="write"):
+        self.intent = intent  # "read" ならリードレプリカを使える
+
     def __enter__(self):
-        # コンストラクタ内でDB接続を初期化
-        try:
-            self.conn = psycopg2.connect(
-                host=os.getenv("DB_HOST"),
-                database=os.getenv("DB_NAME"),  # データベース名
-                user=os.getenv("DB_USER"),  # ユーザー名
-                password=os.getenv("DB_PASSWORD")  # パスワード
-            )
-            self.cursor = self.conn.cursor()
-            # スキーマの設定をコンストラクタ内で行う
-            self.cursor.execute("SET search_path TO public;")
-            return self
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"DB connection error: {str(e)}")
+        # プールから接続を借りる（search_path はプールの接続で既定の public を使う）
+        self.conn = get_db_connection(self.intent)
+        self.cursor = self.conn.cursor()
+        return self
 
     def __exit__(self, exc_type, exc_value, traceback):
         # リソースをクリーンアップ
         self.cursor.close()
-        self.conn.close()
+        release_connection(self.conn)
 
     def get_email_by_username(self, user_name: str):
         # クエリを実行し、結果を返すメソッド
         try:
-            self.cursor.execute("SELECT email FROM test WHERE user_name = %s", (user_name,))
+            execute(self.cursor, "get_email_by_username", (user_name,))
             return self.cursor.fetchone()
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Query execution error: {str(e)}")
 
 
 # ルートエンドポイント: "Hello Taxi"メッセージを表示
-@app.get("/")
+@root_router.get("/")
 def read_root():
     return {"message": "Hello Taxi!"}
 
 
 # RDSへの接続テスト用エンドポイント
-@app.get("/test-db-connection")
+@root_router.get("/test-db-connection")
 def test_db_connection():
     try:
         with Database() as db:  # DB接続をインスタンス化
-            db.cursor.execute("SELECT 1;")  # データベースの接続テストクエリ
+            execute(db.cursor, "ping")  # データベースの接続テストクエリ
             result = db.cursor.fetchone()
             return {"message": f"DB connection successful: {result[0]}"}
     except Exception as e:
@@ -97,10 +164,10 @@ def test_db_connection():
 
 
 # user_nameをトリガーにemailを取得するエンドポイント
-@app.get("/get-email/{user_name}")
+@root_router.get("/get-email/{user_name}")
 def get_email(user_name: str):
     try:
-        with Database() as db:  # インスタンスを作成
+        with Database("read") as db:  # インスタンスを作成
             result = db.get_email_by_username(user_name)
 
         if result is None:
@@ -111,3 +178,12 @@ def get_email(user_name: str):
     except Exception as e:
         print(f"Query execution error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Query execution error: {str(e)}")
+
+
+# uvicorn main:app 用。import しただけではアプリを作らず、最初に参照されたときに作る
+def __getattr__(name):
+    if name == "app":
+        app = create_app()
+        globals()["app"] = app
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
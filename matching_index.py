@@ -0,0 +1,201 @@
+import bisect
+import logging
+import select
+import threading
+import time
+from datetime import datetime
+
+from db import open_connection, execute
+from partitions import hot_since
+from settings import get_settings
+
+logger = logging.getLogger(__name__)
+
+# 行の列位置（queries.py の list_open_orders と同じ順）
+ORDER_ID, USER_ID, ORIGIN, DESTINATION, CHECK_IN_TIME = 0, 1, 3, 4, 5
+CO_PASSENGER, MIN_PARTICIPANTS, BACK_SEAT_PASSENGERS, WANTS_FEMALE = 6, 7, 8, 9
+ID_VERIFICATION_STATUS, STATUS, JOURNEY_TYPE = 10, 11, 12
+
+OPEN_STATUSES = ("waiting", "matched")
+
+# 通知を待つ間隔
+POLL_INTERVAL = 1.0
+# LISTEN の接続で SELECT 1 を往復させる間隔（成功したときだけハートビートを更新する）
+PING_INTERVAL = 2.0
+# 期限切れの注文を索引から取り除く間隔
+PRUNE_INTERVAL = 300.0
+# 接続が切れたときに再接続するまでの待ち時間
+RECONNECT_DELAY = 5.0
+
+
+# search_candidate_orders を、受付中の注文のプロセス内索引で答える
+# (origin, destination, journey_type) ごとに (check_in_time, order_id) を昇順に並べて持ち、二分探索で引く
+# orders_changed の通知で変わった注文だけを読み直して追従し、通知が途絶えたら None を返してDBに任せる
+class MatchingIndex:
+    def __init__(self):
+        self.groups = {}  # (origin, destination, journey_type) -> [(check_in_time, order_id)]
+        self.rows = {}  # order_id -> 行
+        self.horizon = None  # これより前の check_in_time は索引に無い
+        self.ready = False
+        self.heartbeat = 0.0
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="matching-index", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join(timeout=POLL_INTERVAL * 2)
+
+    def is_fresh(self):
+        return self.ready and time.monotonic() - self.heartbeat <= get_settings().matching_index_max_staleness
+
+    # search_candidate_orders と同じ条件で検索する。索引で答えられなければ None
+    def search(self, origin, destination, check_in_time, co_passenger, min_participants, back_seat_passengers,
+               wants_female, id_verification_status, journey_type, user_id):
+        try:
+            check_in_time = datetime.fromisoformat(check_in_time)
+        except ValueError:
+            return None
+        # タイムゾーン付きの指定はDBでの解釈に任せる
+        if check_in_time.tzinfo is not None:
+            return None
+
+        with self.lock:
+            if not self.is_fresh() or check_in_time < self.horizon:
+                return None
+            keys = self.groups.get((origin, destination, journey_type), [])
+            results = []
+            i = bisect.bisect_left(keys, (check_in_time,))
+            while i < len(keys) and keys[i][0] == check_in_time:
+                row = self.rows[keys[i][1]]
+                if (
+                    row[CO_PASSENGER] == co_passenger
+                    and row[MIN_PARTICIPANTS] == min_participants
+                    and row[BACK_SEAT_PASSENGERS] == back_seat_passengers
+                    and row[WANTS_FEMALE] == wants_female
+                    and row[ID_VERIFICATION_STATUS] == id_verification_status
+                    and row[USER_ID] != user_id
+                ):
+                    results.append(row)
+                i += 1
+            return results
+
+    def _group_key(self, row):
+        return row[ORIGIN], row[DESTINATION], row[JOURNEY_TYPE]
+
+    def _add(self, row):
+        self._remove(row[ORDER_ID])
+        self.rows[row[ORDER_ID]] = row
+        bisect.insort(self.groups.setdefault(self._group_key(row), []), (row[CHECK_IN_TIME], row[ORDER_ID]))
+
+    def _remove(self, order_id):
+        row = self.rows.pop(order_id, None)
+        if row is None:
+            return
+        key = self._group_key(row)
+        keys = self.groups[key]
+        i = bisect.bisect_left(keys, (row[CHECK_IN_TIME], order_id))
+        if i < len(keys) and keys[i] == (row[CHECK_IN_TIME], order_id):
+            del keys[i]
+        if not keys:
+            del self.groups[key]
+
+    # 受付中の注文をすべて読み込み直す
+    def bootstrap(self, cursor):
+        horizon = hot_since()
+        execute(cursor, "list_open_orders", (horizon,))
+        rows = cursor.fetchall()
+        with self.lock:
+            self.groups = {}
+            self.rows = {}
+            self.horizon = horizon
+            for row in rows:
+                self._add(row)
+            self.ready = True
+            self.heartbeat = time.monotonic()
+        logger.info(f"matching index loaded: {len(rows)} open orders")
+
+    # 通知された注文を読み直し、受付中なら追加・更新し、そうでなければ取り除く
+    def apply(self, cursor, order_ids):
+        execute(cursor, "get_orders_by_ids", (list(order_ids),))
+        rows = {row[ORDER_ID]: row for row in cursor.fetchall()}
+        with self.lock:
+            for order_id in order_ids:
+                row = rows.get(order_id)
+                if row is not None and row[STATUS] in OPEN_STATUSES and row[CHECK_IN_TIME] >= self.horizon:
+                    self._add(row)
+                else:
+                    self._remove(order_id)
+
+    # check_in_time が対象期間を過ぎた注文を取り除く
+    def prune(self):
+        horizon = hot_since()
+        with self.lock:
+            self.horizon = horizon
+            for order_id in [order_id for order_id, row in self.rows.items() if row[CHECK_IN_TIME] < horizon]:
+                self._remove(order_id)
+
+    def run(self):
+        while not self.stopping.is_set():
+            conn = None
+            try:
+                conn = open_connection()
+                conn.autocommit = True
+                cursor = conn.cursor()
+                # 読み込み中の変更を取りこぼさないよう、先に LISTEN してから読み込む
+                cursor.execute("LISTEN orders_changed")
+                self.bootstrap(cursor)
+                pruned_at = pinged_at = time.monotonic()
+
+                while not self.stopping.is_set():
+                    if select.select([conn], [], [], POLL_INTERVAL) != ([], [], []):
+                        conn.poll()
+                        order_ids = {int(notify.payload) for notify in conn.notifies}
+                        conn.notifies.clear()
+                        if order_ids:
+                            self.apply(cursor, order_ids)
+                    if time.monotonic() - pruned_at > PRUNE_INTERVAL:
+                        self.prune()
+                        pruned_at = time.monotonic()
+                    # 通知が無いだけなのか接続が切れているのかは select では分からないので、往復して確かめる
+                    # 黙って切れた接続ではここで止まるか失敗し、ハートビートが古くなって検索はDBに戻る
+                    if time.monotonic() - pinged_at >= PING_INTERVAL:
+                        cursor.execute("SELECT 1")
+                        cursor.fetchone()
+                        pinged_at = self.heartbeat = time.monotonic()
+            except Exception as e:
+                self.ready = False
+                logger.warning(f"matching index listener failed: {str(e)}")
+                self.stopping.wait(RECONNECT_DELAY)
+            finally:
+                if conn is not None:
+                    conn.close()
+        self.ready = False
+
+
+_index = None
+
+
+# MATCHING_INDEX_ENABLED のときだけ使う（無効なら None）
+def get_matching_index():
+    return _index
+
+
+def start_matching_index():
+    global _index
+    if not get_settings().matching_index_enabled or _index is not None:
+        return
+    _index = MatchingIndex()
+    _index.start()
+
+
+def stop_matching_index():
+    global _index
+    if _index is not None:
+        _index.stop()
+        _index = None
@@ -0,0 +1,528 @@
+import argparse
+import json
+import logging
+import math
+import os
+import random
+import re
+import sys
+from datetime import datetime, timedelta, timezone
+
+import psycopg2
+from psycopg2.extensions import parse_dsn
+from psycopg2.extras import execute_values
+
+import geo
+from db import PreparedConnection, explain
+from partitions import hot_since, now_jst
+from search import search_events_sql
+from settings import get_settings
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+
+# 1行目がこれのマイグレーションはトランザクションの外で1文ずつ実行する（CREATE INDEX CONCURRENTLY 用）
+NO_TRANSACTION = "-- migrate: no-transaction"
+
+# 複数インスタンスが同時にマイグレーションを実行しないためのアドバイザリロックのキー
+MIGRATION_LOCK_KEY = 727001
+
+# 実行計画の確認 (check-plans) で投入する件数
+PLAN_CHECK_USERS = 5000
+PLAN_CHECK_EVENTS = 3000
+PLAN_CHECK_VENUES = 500
+PLAN_CHECK_ORDERS = 100000
+PLAN_CHECK_RADIUS = 500
+# これより小さいテーブル（空の月パーティションなど）はシーケンシャルスキャンの方が安いので報告しない
+PLAN_CHECK_MIN_ROWS = 1000
+
+# 投入する注文の乗車地と目的地（この周辺に散らばらせる）
+PLAN_CHECK_ORIGINS = [
+    ("渋谷駅", 35.658034, 139.701636),
+    ("新宿駅", 35.689607, 139.700571),
+    ("池袋駅", 35.729503, 139.710900),
+    ("品川駅", 35.628471, 139.738760),
+    ("東京駅", 35.681236, 139.767125),
+    ("上野駅", 35.713768, 139.777254),
+    ("横浜駅", 35.465798, 139.622314),
+    ("大宮駅", 35.906295, 139.623999),
+]
+PLAN_CHECK_DESTINATIONS = [
+    ("東京ドーム", 35.705639, 139.751891),
+    ("日本武道館", 35.693316, 139.749830),
+    ("有明アリーナ", 35.637420, 139.790080),
+    ("横浜アリーナ", 35.512466, 139.619977),
+    ("さいたまスーパーアリーナ", 35.894922, 139.630890),
+]
+
+
+# 各エンドポイント（と定期処理）のクエリ: (名前, 登録済みのステートメント名, 投入したデータの sample からパラメータを作る関数)
+# /search-events はSQLを組み立てるので、ステートメント名の代わりに search_events_sql へ渡す引数を作る
+def _candidate_conditions(s):
+    return (
+        s["check_in_time"], s["co_passenger"], s["min_participants"], s["back_seat_passengers"],
+        s["wants_female"], s["id_verification_status"], s["journey_type"], s["other_user_id"],
+    )
+
+
+def _nearby_params(s):
+    destination_cells = geo.cover(s["destination_lat"], s["destination_lng"], PLAN_CHECK_RADIUS)
+    return (
+        geo.cover(s["origin_lat"], s["origin_lng"], PLAN_CHECK_RADIUS),
+        len(destination_cells[0]),
+        destination_cells,
+        s["origin_lat"], s["origin_lng"],
+        s["destination_lat"], s["destination_lng"],
+        PLAN_CHECK_RADIUS,
+    ) + _candidate_conditions(s)
+
+
+ROUTE_QUERIES = [
+    ("POST /token", "get_user_by_email", lambda s: (s["email"],)),
+    ("POST /signup", "user_exists", lambda s: (s["email"],)),
+    ("POST /search-orders", "search_candidate_orders", lambda s: (s["origin"], s["destination"]) + _candidate_conditions(s)),
+    ("POST /search-orders (match_mode=proximity)", "search_nearby_orders", _nearby_params),
+    ("GET /check-requested/{user_id}", "get_requested_order", lambda s: (s["requested_user_id"], hot_since())),
+    ("GET /check-requested/{user_id} (partner)", "get_partner_profile", lambda s: (s["user_id"], hot_since())),
+    ("GET /my-orders", "list_my_orders", lambda s: (s["user_id"], 21, 0, hot_since())),
+    ("GET /orders/{order_id}", "get_order_owner_profile", lambda s: (s["order_id"],)),
+    ("POST /send-confirmation-email/{order_id}", "get_order_emails", lambda s: (s["requested_order_id"],)),
+    ("POST /update-accept-order", "get_order_user_id", lambda s: (s["order_id"],)),
+    ("POST /update-accept-order (request)", "mark_order_requested", lambda s: (s["other_user_id"], s["order_id"])),
+    ("POST /update-accept-order (match)", "mark_order_matched", lambda s: (s["requested_order_id"],)),
+    ("GET /events/{event_id}", "get_event", lambda s: (s["event_id"],)),
+    ("GET /events/{event_id} (check-in places)", "get_check_in_places", lambda s: (s["event_venue_id"],)),
+    ("GET /get-email/{user_name}", "get_email_by_username", lambda s: (s["user_name"],)),
+    ("matching_index.py (get_orders_by_ids)", "get_orders_by_ids", lambda s: (s["order_ids"],)),
+    ("expiry.py (expire_past_orders)", "expire_past_orders", lambda s: (s["waiting_cutoff"], 500)),
+    ("expiry.py (revert_stale_requests)", "revert_stale_requests", lambda s: (s["request_cutoff"], 500, s["waiting_cutoff"])),
+    ("expiry.py (get_user_emails)", "get_user_emails", lambda s: ([s["user_id"], s["other_user_id"]],)),
+    ("GET /search-events (date range)", search_events_sql, lambda s: {"start_time": s["month_start"], "end_time": s["month_end"]}),
+    ("GET /search-events (genre/prefecture codes)", search_events_sql, lambda s: {"genre_codes": s["genre_codes"], "prefecture_codes": [13, 27]}),
+    ("GET /search-events (query)", search_events_sql, lambda s: {"query": s["event_title"]}),
+]
+
+# このクエリは拡張機能のインデックスが無ければ確認しない（0002 で pg_trgm がある場合だけ作る）
+ROUTE_EXTENSIONS = {
+    "GET /search-events (query)": "pg_trgm",
+}
+
+
+def get_db_connection():
+    settings = get_settings()
+    return psycopg2.connect(
+        host=settings.db_host,
+        port=settings.db_port,
+        database=settings.db_name,
+        user=settings.db_user,
+        password=settings.db_password,
+        connection_factory=PreparedConnection,
+    )
+
+
+# check-plans の接続先。PLAN_CHECK_DATABASE が無ければ（アプリのDBを使わずに）エラーにする
+def plan_check_params():
+    settings = get_settings()
+    target = settings.plan_check_database
+    if not target:
+        raise RuntimeError("PLAN_CHECK_DATABASE is not set; check-plans seeds data and needs a throwaway database")
+    if "=" in target or "://" in target:
+        params = parse_dsn(target)
+    else:
+        params = {"host": settings.db_host, "port": settings.db_port, "dbname": target, "user": settings.db_user, "password": settings.db_password}
+    same_host = params.get("host") == settings.db_host and str(params.get("port") or "") == str(settings.db_port or "")
+    if same_host and params.get("dbname") == settings.db_name:
+        raise RuntimeError("PLAN_CHECK_DATABASE must not be the application's database")
+    return {key: value for key, value in params.items() if value is not None}
+
+
+def get_plan_check_connection():
+    return psycopg2.connect(connection_factory=PreparedConnection, **plan_check_params())
+
+
+# migrations/ 以下の NNNN_name.sql をバージョン順に列挙
+def list_migrations():
+    migrations = []
+    for filename in sorted(os.listdir(MIGRATIONS_DIR)):
+        if not filename.endswith(".sql"):
+            continue
+        version, _, name = filename[:-4].partition("_")
+        migrations.append((int(version), name, os.path.join(MIGRATIONS_DIR, filename)))
+    return migrations
+
+
+def ensure_migrations_table(cursor):
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name VARCHAR(255) NOT NULL,
+            applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+        """
+    )
+
+
+def applied_versions(cursor):
+    cursor.execute("SELECT version FROM schema_migrations")
+    return {row[0] for row in cursor.fetchall()}
+
+
+# ; で終わる行でSQLを文に分ける（$$ で囲んだ本体の中では分けない）。コメントだけの部分は捨てる
+def split_statements(sql):
+    statements = []
+    lines = []
+    quoted = False
+    for line in sql.splitlines():
+        lines.append(line)
+        stripped = line.strip()
+        if stripped.startswith("--"):
+            continue
+        if line.count("$$") % 2:
+            quoted = not quoted
+        if not quoted and stripped.endswith(";"):
+            statements.append("\n".join(lines))
+            lines = []
+    statements.append("\n".join(lines))
+    return [
+        statement for statement in statements
+        if any(line.strip() and not line.strip().startswith("--") for line in statement.splitlines())
+    ]
+
+
+# CONCURRENTLY の作成が途中で失敗すると無効なインデックスが残り、IF NOT EXISTS で作り直されない
+# このマイグレーションで作るインデックスのうち無効なものを消しておく
+def drop_invalid_indexes(cursor, sql):
+    names = re.findall(r"CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+IF\s+NOT\s+EXISTS\s+(\w+)", sql, re.IGNORECASE)
+    if not names:
+        return
+    cursor.execute(
+        """
+        SELECT c.relname
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE NOT i.indisvalid AND c.relname = ANY(%s) AND pg_table_is_visible(c.oid)
+        """,
+        (names,),
+    )
+    for (name,) in cursor.fetchall():
+        logger.warning(f"dropping invalid index {name} left by an interrupted migration")
+        cursor.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"')
+
+
+# トランザクションの外で1文ずつ実行する。途中で失敗しても、再実行すれば残りから（IF NOT EXISTS で）続けられる
+def apply_without_transaction(conn, cursor, sql):
+    conn.commit()
+    conn.autocommit = True
+    try:
+        drop_invalid_indexes(cursor, sql)
+        for statement in split_statements(sql):
+            cursor.execute(statement)
+    finally:
+        conn.autocommit = False
+
+
+# 未適用のマイグレーションを1ファイル1トランザクションで適用する
+# （1行目が NO_TRANSACTION のファイルは apply_without_transaction で適用する）
+def upgrade(conn):
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_KEY,))
+        ensure_migrations_table(cursor)
+        conn.commit()
+
+        done = applied_versions(cursor)
+        for version, name, path in list_migrations():
+            if version in done:
+                continue
+            logger.info(f"applying migration {version:04d}_{name}")
+            with open(path, encoding="utf-8") as f:
+                sql = f.read()
+            try:
+                if sql.startswith(NO_TRANSACTION):
+                    apply_without_transaction(conn, cursor, sql)
+                else:
+                    cursor.execute(sql)
+                cursor.execute(
+                    "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+                    (version, name),
+                )
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                logger.error(f"migration {version:04d}_{name} failed")
+                raise
+    finally:
+        cursor.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_KEY,))
+        conn.commit()
+        cursor.close()
+
+
+def status(conn):
+    cursor = conn.cursor()
+    try:
+        ensure_migrations_table(cursor)
+        conn.commit()
+        done = applied_versions(cursor)
+        for version, name, _ in list_migrations():
+            mark = "applied" if version in done else "pending"
+            print(f"{version:04d}_{name}: {mark}")
+    finally:
+        cursor.close()
+
+
+# プランツリーからシーケンシャルスキャンしているテーブルを集める
+def find_seq_scans(plan):
+    tables = []
+    if plan.get("Node Type") == "Seq Scan":
+        tables.append(plan.get("Relation Name"))
+    for child in plan.get("Plans", []):
+        tables.extend(find_seq_scans(child))
+    return tables
+
+
+def _jitter(rng, lat, lng, meters):
+    angle = rng.uniform(0, 2 * math.pi)
+    distance = meters * math.sqrt(rng.random())
+    dlat = distance * math.cos(angle) / geo.METERS_PER_DEGREE
+    dlng = distance * math.sin(angle) / (geo.METERS_PER_DEGREE * math.cos(math.radians(lat)))
+    return lat + dlat, lng + dlng
+
+
+# 実行計画を確認するためのデータを投入し、統計を取り直す（呼び出し側のトランザクション内。最後にロールバックする）
+# 注文は過去半年〜2か月先に散らばらせ、過去の注文は成立・期限切れ、先の注文は大半を募集中にする
+# クエリのパラメータに使う値を sample として返す
+def seed_plan_check_data(cursor, seed=1):
+    rng = random.Random(seed)
+    # check_in_time はタイムゾーン無し（日本時間）、requested_at はタイムゾーン付き
+    now = now_jst().replace(minute=0, second=0, microsecond=0)
+    now_utc = datetime.now(timezone.utc)
+
+    cursor.execute(
+        """
+        WITH inserted AS (
+            INSERT INTO users (email, password, sex, user_name)
+            SELECT 'plan-check-' || i || '@example.com', '-', CASE WHEN i %% 2 = 0 THEN 'female' ELSE 'male' END, 'plan-check-' || i
+            FROM generate_series(1, %s) AS i
+            RETURNING user_id
+        )
+        SELECT array_agg(user_id ORDER BY user_id) FROM inserted
+        """,
+        (PLAN_CHECK_USERS,),
+    )
+    user_ids = cursor.fetchone()[0]
+    cursor.execute(
+        """
+        INSERT INTO test (user_name, email)
+        SELECT 'plan-check-' || i, 'plan-check-' || i || '@example.com'
+        FROM generate_series(1, %s) AS i
+        """,
+        (PLAN_CHECK_USERS,),
+    )
+
+    # 公演は過去1年〜先の1年に散らばらせる（都道府県・ジャンルのコードはトリガーが埋める）
+    cursor.execute(
+        """
+        WITH inserted AS (
+            INSERT INTO events (event_title, artist_name, open_time, start_time, prefectures, event_venue, event_venue_id, genre_1, genre_2)
+            SELECT 'plan-check event ' || i, 'plan-check artist ' || i %% 700,
+                   %s::timestamp + (i * 730 / %s) * interval '1 day' - interval '1 hour',
+                   %s::timestamp + (i * 730 / %s) * interval '1 day',
+                   p.name, 'plan-check venue ' || i %% %s, 900000 + i %% %s, '音楽', 'plan-check genre ' || i %% 20
+            FROM generate_series(1, %s) AS i
+            JOIN prefectures p ON p.prefecture_code = 1 + i %% 47
+            RETURNING event_id, event_title, event_venue_id, genre_2_code
+        )
+        SELECT array_agg(event_id ORDER BY event_id), min(event_title), min(event_venue_id), array_agg(DISTINCT genre_2_code)
+        FROM inserted
+        """,
+        (
+            now - timedelta(days=365), PLAN_CHECK_EVENTS, now - timedelta(days=365), PLAN_CHECK_EVENTS,
+            PLAN_CHECK_VENUES, PLAN_CHECK_VENUES, PLAN_CHECK_EVENTS,
+        ),
+    )
+    event_ids, event_title, event_venue_id, genre_codes = cursor.fetchone()
+    cursor.execute(
+        """
+        INSERT INTO check_in_place (event_venue_id, check_in_place)
+        SELECT 900000 + v, 'plan-check place ' || v || '-' || n
+        FROM generate_series(0, %s - 1) AS v, generate_series(1, 3) AS n
+        """,
+        (PLAN_CHECK_VENUES,),
+    )
+    cursor.execute("REFRESH MATERIALIZED VIEW event_listing")
+
+    # 本番と同じく、注文のある月にはパーティションを用意しておく
+    cursor.execute(
+        "SELECT create_orders_partition(month::date) FROM generate_series(%s::date, %s::date, interval '1 month') AS month",
+        (now.date() - timedelta(days=181), now.date() + timedelta(days=61)),
+    )
+
+    rows = []
+    for _ in range(PLAN_CHECK_ORDERS):
+        check_in_time = now + timedelta(hours=rng.randint(-180 * 24, 60 * 24))
+        if check_in_time < now:
+            status = rng.choice(["matched", "expired", "expired"])
+        else:
+            status = rng.choices(["waiting", "requested", "approved_waiting", "matched"], [70, 10, 5, 15])[0]
+        pending = status in ("requested", "approved_waiting")
+        origin, origin_lat, origin_lng = rng.choice(PLAN_CHECK_ORIGINS)
+        destination, destination_lat, destination_lng = rng.choice(PLAN_CHECK_DESTINATIONS)
+        origin_lat, origin_lng = _jitter(rng, origin_lat, origin_lng, 300)
+        destination_lat, destination_lng = _jitter(rng, destination_lat, destination_lng, 300)
+        rows.append((
+            rng.choice(user_ids), rng.choice(event_ids), origin, destination, check_in_time,
+            rng.randint(0, 3), rng.randint(1, 3), rng.randint(0, 2), rng.random() < 0.2,
+            rng.choice(["verified", "unverified"]), status, rng.choice(["outward", "return"]),
+            now_utc - timedelta(minutes=rng.randint(0, 180)) if pending else None,
+            rng.choice(user_ids) if pending or status == "matched" else None,
+            origin_lat, origin_lng, geo.encode(origin_lat, origin_lng),
+            destination_lat, destination_lng, geo.encode(destination_lat, destination_lng),
+        ))
+    execute_values(
+        cursor,
+        """
+        INSERT INTO orders (user_id, event_id, origin, destination, check_in_time, co_passenger, min_participants,
+                            back_seat_passengers, wants_female, id_verification_status, status, journey_type,
+                            requested_at, aitaku_user_id,
+                            origin_lat, origin_lng, origin_geohash, destination_lat, destination_lng, destination_geohash)
+        VALUES %s
+        """,
+        rows,
+        page_size=5000,
+    )
+    cursor.execute("ANALYZE users, test, events, check_in_place, event_listing, orders")
+
+    cursor.execute(
+        """
+        SELECT order_id, user_id, origin, destination, check_in_time, co_passenger, min_participants,
+               back_seat_passengers, wants_female, id_verification_status, journey_type,
+               origin_lat, origin_lng, destination_lat, destination_lng
+        FROM orders
+        WHERE status = 'waiting' AND check_in_time > %s AND user_id = ANY(%s)
+        ORDER BY order_id
+        LIMIT 1
+        """,
+        (now, user_ids),
+    )
+    columns = [column.name for column in cursor.description]
+    sample = dict(zip(columns, cursor.fetchone()))
+    cursor.execute(
+        """
+        SELECT order_id, user_id
+        FROM orders
+        WHERE status = 'requested' AND check_in_time > %s AND user_id = ANY(%s)
+        ORDER BY order_id
+        LIMIT 1
+        """,
+        (now, user_ids),
+    )
+    sample["requested_order_id"], sample["requested_user_id"] = cursor.fetchone()
+    cursor.execute("SELECT email, user_name FROM users WHERE user_id = %s", (sample["user_id"],))
+    sample["email"], sample["user_name"] = cursor.fetchone()
+    month_start = (now + timedelta(days=30)).date()
+    sample.update(
+        other_user_id=next(user_id for user_id in user_ids if user_id != sample["user_id"]),
+        order_ids=[sample["order_id"], sample["requested_order_id"]],
+        event_id=event_ids[len(event_ids) // 2],
+        event_title=event_title,
+        event_venue_id=event_venue_id,
+        genre_codes=sorted(genre_codes)[:2],
+        month_start=month_start.isoformat(),
+        month_end=(month_start + timedelta(days=30)).isoformat(),
+        waiting_cutoff=now - timedelta(minutes=30),
+        request_cutoff=now_utc - timedelta(minutes=60),
+    )
+    return sample
+
+
+def _explain(cursor, query, params):
+    if callable(query):
+        sql, values = query(**params)
+        cursor.execute("EXPLAIN (FORMAT JSON) " + sql, values)
+        plan = cursor.fetchone()[0]
+    else:
+        plan = explain(cursor, query, params)
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]["Plan"]
+
+
+# 投入したデータで各エンドポイントのクエリの実行計画を取り、PLAN_CHECK_MIN_ROWS 行以上のテーブルを
+# シーケンシャルスキャンしているものを (名前, テーブル) で返す
+# 登録済みのステートメントはカスタムプランと汎用プラン（PREPARE から6回目以降に選ばれうる）の両方を確認する
+# 確認できなかったクエリ（必要な拡張機能が無い）は skipped に名前を入れる
+def check_plans(conn, skipped=None):
+    # PLAN_CHECK_DATABASE で指定したDB以外には投入しない
+    if conn.info.dbname != plan_check_params()["dbname"]:
+        raise RuntimeError(f"check-plans must run on PLAN_CHECK_DATABASE, not {conn.info.dbname}")
+    cursor = conn.cursor()
+    failures = []
+    try:
+        cursor.execute("SELECT extname FROM pg_extension")
+        extensions = {row[0] for row in cursor.fetchall()}
+        sample = seed_plan_check_data(cursor)
+        cursor.execute("SELECT relname FROM pg_class WHERE relkind = 'r' AND reltuples < %s", (PLAN_CHECK_MIN_ROWS,))
+        small_tables = {row[0] for row in cursor.fetchall()}
+        for route, query, make_params in ROUTE_QUERIES:
+            extension = ROUTE_EXTENSIONS.get(route)
+            if extension is not None and extension not in extensions:
+                if skipped is not None:
+                    skipped.append(route)
+                continue
+            modes = ["force_custom_plan"] if callable(query) else ["force_custom_plan", "force_generic_plan"]
+            for mode in modes:
+                cursor.execute(f"SET LOCAL plan_cache_mode = {mode}")
+                for table in find_seq_scans(_explain(cursor, query, make_params(sample))):
+                    if table in small_tables:
+                        continue
+                    failures.append((f"{route} ({mode})" if len(modes) > 1 else route, table))
+    finally:
+        conn.rollback()
+        cursor.close()
+    return failures
+
+
+def print_plan_check(conn):
+    skipped = []
+    failures = check_plans(conn, skipped)
+    failed_routes = {route.split(" (force_")[0] for route, _ in failures}
+    for route, _, _ in ROUTE_QUERIES:
+        if route in skipped:
+            print(f"--  {route}: skipped ({ROUTE_EXTENSIONS[route]} is not installed)")
+        elif route not in failed_routes:
+            print(f"OK  {route}")
+    for route, table in failures:
+        print(f"NG  {route}: seq scan on {table}")
+    return len(failures)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="DBスキーマのマイグレーション")
+    parser.add_argument("command", nargs="?", default="upgrade", choices=["upgrade", "status", "check-plans"])
+    args = parser.parse_args(argv)
+
+    if args.command == "check-plans":
+        # 使い捨てのDBにマイグレーションを適用してから確認する
+        conn = get_plan_check_connection()
+        try:
+            upgrade(conn)
+            return 1 if print_plan_check(conn) else 0
+        finally:
+            conn.close()
+
+    conn = get_db_connection()
+    try:
+        if args.command == "upgrade":
+            upgrade(conn)
+        else:
+            status(conn)
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
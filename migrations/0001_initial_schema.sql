@@ -0,0 +1,58 @@
+-- 既存テーブルのスキーマ定義
+-- 本番環境ではテーブルが既に存在するため、すべて IF NOT EXISTS で作成する
+
+CREATE TABLE IF NOT EXISTS users (
+    user_id SERIAL PRIMARY KEY,
+    email VARCHAR(255) NOT NULL,
+    password VARCHAR(255) NOT NULL,
+    sex VARCHAR(16),
+    user_name VARCHAR(255),
+    rating NUMERIC(3, 2) NOT NULL DEFAULT 0,
+    review_count INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS events (
+    event_id SERIAL PRIMARY KEY,
+    event_title VARCHAR(255) NOT NULL,
+    artist_name VARCHAR(255),
+    open_time TIMESTAMP,
+    start_time TIMESTAMP,
+    prefectures VARCHAR(16),  -- 「東京」「大阪」のように末尾の都/府/県を除いた名称（北海道のみそのまま）
+    event_venue VARCHAR(255),
+    event_venue_id INTEGER,
+    genre_1 VARCHAR(64),
+    genre_2 VARCHAR(64)
+);
+
+CREATE TABLE IF NOT EXISTS check_in_place (
+    check_in_place_id SERIAL PRIMARY KEY,
+    event_venue_id INTEGER NOT NULL,
+    check_in_place VARCHAR(255) NOT NULL
+);
+
+-- カラム順は check_requested.py の SELECT * (result[16] = aitaku_user_id) に合わせている
+CREATE TABLE IF NOT EXISTS orders (
+    order_id SERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users (user_id),
+    event_id INTEGER NOT NULL REFERENCES events (event_id),
+    origin VARCHAR(255) NOT NULL,
+    destination VARCHAR(255) NOT NULL,
+    check_in_time TIMESTAMP NOT NULL,
+    co_passenger INTEGER NOT NULL DEFAULT 0,
+    min_participants INTEGER NOT NULL DEFAULT 1,
+    back_seat_passengers INTEGER NOT NULL DEFAULT 0,
+    wants_female BOOLEAN NOT NULL DEFAULT FALSE,
+    id_verification_status VARCHAR(16) NOT NULL DEFAULT 'unverified',
+    status VARCHAR(32) NOT NULL DEFAULT 'waiting',
+    journey_type VARCHAR(16) NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    requested_at TIMESTAMPTZ,
+    aitaku_user_id INTEGER REFERENCES users (user_id)
+);
+
+-- /get-email/{user_name} が参照する旧テーブル
+CREATE TABLE IF NOT EXISTS test (
+    user_name VARCHAR(255) NOT NULL,
+    email VARCHAR(255)
+);
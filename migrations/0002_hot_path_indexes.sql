@@ -0,0 +1,67 @@
+-- migrate: no-transaction
+-- 各エンドポイントのクエリが使うインデックス
+-- 既存のテーブルへの書き込みを止めないよう CREATE INDEX CONCURRENTLY で作る（トランザクションの外で1文ずつ実行する）
+
+-- サインアップは確認してから INSERT するため、同じメールアドレスのユーザーが既にいることがある
+-- ユニークインデックスを作る前に、最も古い（user_id が最小の）ユーザー以外のメールアドレスを書き換える
+-- 元のメールアドレスは users_email_duplicates に残す（ログインできなくなるので、運用で連絡・統合する）
+CREATE TABLE IF NOT EXISTS users_email_duplicates (
+    user_id INTEGER PRIMARY KEY,
+    email VARCHAR(255) NOT NULL,
+    kept_user_id INTEGER NOT NULL,
+    resolved_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+WITH duplicates AS (
+    SELECT user_id, email, min(user_id) OVER (PARTITION BY email) AS kept_user_id
+    FROM users
+    WHERE email IN (SELECT email FROM users GROUP BY email HAVING count(*) > 1)
+),
+recorded AS (
+    INSERT INTO users_email_duplicates (user_id, email, kept_user_id)
+    SELECT user_id, email, kept_user_id FROM duplicates WHERE user_id <> kept_user_id
+    ON CONFLICT (user_id) DO NOTHING
+    RETURNING user_id
+)
+UPDATE users u
+SET email = left('duplicate-' || u.user_id || '-' || u.email, 255)
+FROM recorded r
+WHERE u.user_id = r.user_id;
+
+-- auth.get_user_from_db / サインアップ時の重複チェック (WHERE email = %s)
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS users_email_key ON users (email);
+
+-- check_requested (WHERE user_id = %s AND status = 'requested')
+CREATE INDEX CONCURRENTLY IF NOT EXISTS orders_user_id_status_idx ON orders (user_id, status);
+
+-- 相手ユーザー側からの参照 (send_email の JOIN, aitaku_user_id での検索)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS orders_aitaku_user_id_idx ON orders (aitaku_user_id);
+
+-- search_candidates.search_orders の等価条件。候補になるステータスのみを対象にした部分インデックス
+CREATE INDEX CONCURRENTLY IF NOT EXISTS orders_candidates_idx
+    ON orders (origin, destination, check_in_time, journey_type)
+    WHERE status IN ('waiting', 'matched');
+
+-- search.get_event / search_events の check_in_place 結合
+CREATE INDEX CONCURRENTLY IF NOT EXISTS check_in_place_event_venue_id_idx ON check_in_place (event_venue_id);
+
+-- search_events の日付範囲・ジャンル・都道府県フィルタ
+CREATE INDEX CONCURRENTLY IF NOT EXISTS events_start_time_idx ON events (start_time);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS events_genre_2_idx ON events (genre_2);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS events_prefectures_idx ON events (prefectures);
+
+-- search_events のフリーテキスト検索 (ILIKE '%...%') 用のトライグラムインデックス
+-- pg_trgm が使えない環境（ローカルの素の PostgreSQL など）では作成しない
+-- DO の中では CONCURRENTLY を使えないため、この2つは events への書き込み（カタログの取り込み）を止めて作る
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm') THEN
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        CREATE INDEX IF NOT EXISTS events_event_title_trgm_idx ON events USING gin (event_title gin_trgm_ops);
+        CREATE INDEX IF NOT EXISTS events_artist_name_trgm_idx ON events USING gin (artist_name gin_trgm_ops);
+    END IF;
+END
+$$;
+
+-- main.get_email (WHERE user_name = %s)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS test_user_name_idx ON test (user_name);
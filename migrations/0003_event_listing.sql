@@ -0,0 +1,69 @@
+-- イベント一覧（検索画面のデフォルト表示）用のマテリアライズドビュー
+
+-- カタログ（events / check_in_place）の更新回数。変更のたびにトリガーで加算し、catalog_changed を通知する
+CREATE TABLE IF NOT EXISTS catalog_version (
+    id INTEGER PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+    version BIGINT NOT NULL DEFAULT 1,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+INSERT INTO catalog_version (id) VALUES (1) ON CONFLICT (id) DO NOTHING;
+
+CREATE OR REPLACE FUNCTION bump_catalog_version() RETURNS trigger AS $$
+DECLARE
+    new_version BIGINT;
+BEGIN
+    UPDATE catalog_version SET version = version + 1, updated_at = now() WHERE id = 1
+    RETURNING version INTO new_version;
+    PERFORM pg_notify('catalog_changed', new_version::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS events_catalog_version ON events;
+CREATE TRIGGER events_catalog_version
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON events
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_catalog_version();
+
+DROP TRIGGER IF EXISTS check_in_place_catalog_version ON check_in_place;
+CREATE TRIGGER check_in_place_catalog_version
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON check_in_place
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_catalog_version();
+
+-- イベントごとに1行。check_in_place は配列にまとめておく
+CREATE MATERIALIZED VIEW IF NOT EXISTS event_listing AS
+SELECT
+    e.event_id,
+    e.event_title,
+    e.artist_name,
+    e.open_time,
+    e.start_time,
+    e.prefectures,
+    e.event_venue,
+    e.event_venue_id,
+    e.genre_1,
+    e.genre_2,
+    COALESCE(
+        array_agg(c.check_in_place ORDER BY c.check_in_place_id) FILTER (WHERE c.check_in_place IS NOT NULL),
+        '{}'
+    ) AS check_in_places
+FROM events e
+LEFT JOIN check_in_place c ON e.event_venue_id = c.event_venue_id
+GROUP BY e.event_id;
+
+-- REFRESH ... CONCURRENTLY にはユニークインデックスが必要
+CREATE UNIQUE INDEX IF NOT EXISTS event_listing_event_id_idx ON event_listing (event_id);
+
+-- 都道府県・ジャンル × 公演日時での絞り込み
+CREATE INDEX IF NOT EXISTS event_listing_prefectures_start_time_idx ON event_listing (prefectures, start_time);
+CREATE INDEX IF NOT EXISTS event_listing_genre_2_start_time_idx ON event_listing (genre_2, start_time);
+CREATE INDEX IF NOT EXISTS event_listing_start_time_idx ON event_listing (start_time);
+
+-- 最後にリフレッシュした時点の catalog_version
+CREATE TABLE IF NOT EXISTS event_listing_state (
+    id INTEGER PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+    refreshed_version BIGINT NOT NULL,
+    refreshed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+INSERT INTO event_listing_state (id, refreshed_version)
+SELECT 1, version FROM catalog_version WHERE id = 1
+ON CONFLICT (id) DO NOTHING;
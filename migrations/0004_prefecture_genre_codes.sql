@@ -0,0 +1,130 @@
+-- 都道府県・ジャンルを整数コードに正規化する
+
+-- 都道府県（コードは JIS X 0401）。name は events.prefectures と同じく末尾の都/府/県を除いた名称
+CREATE TABLE IF NOT EXISTS prefectures (
+    prefecture_code SMALLINT PRIMARY KEY,
+    name VARCHAR(16) NOT NULL UNIQUE,
+    full_name VARCHAR(16) NOT NULL UNIQUE
+);
+INSERT INTO prefectures (prefecture_code, name, full_name) VALUES
+    (1, '北海道', '北海道'),
+    (2, '青森', '青森県'),
+    (3, '岩手', '岩手県'),
+    (4, '宮城', '宮城県'),
+    (5, '秋田', '秋田県'),
+    (6, '山形', '山形県'),
+    (7, '福島', '福島県'),
+    (8, '茨城', '茨城県'),
+    (9, '栃木', '栃木県'),
+    (10, '群馬', '群馬県'),
+    (11, '埼玉', '埼玉県'),
+    (12, '千葉', '千葉県'),
+    (13, '東京', '東京都'),
+    (14, '神奈川', '神奈川県'),
+    (15, '新潟', '新潟県'),
+    (16, '富山', '富山県'),
+    (17, '石川', '石川県'),
+    (18, '福井', '福井県'),
+    (19, '山梨', '山梨県'),
+    (20, '長野', '長野県'),
+    (21, '岐阜', '岐阜県'),
+    (22, '静岡', '静岡県'),
+    (23, '愛知', '愛知県'),
+    (24, '三重', '三重県'),
+    (25, '滋賀', '滋賀県'),
+    (26, '京都', '京都府'),
+    (27, '大阪', '大阪府'),
+    (28, '兵庫', '兵庫県'),
+    (29, '奈良', '奈良県'),
+    (30, '和歌山', '和歌山県'),
+    (31, '鳥取', '鳥取県'),
+    (32, '島根', '島根県'),
+    (33, '岡山', '岡山県'),
+    (34, '広島', '広島県'),
+    (35, '山口', '山口県'),
+    (36, '徳島', '徳島県'),
+    (37, '香川', '香川県'),
+    (38, '愛媛', '愛媛県'),
+    (39, '高知', '高知県'),
+    (40, '福岡', '福岡県'),
+    (41, '佐賀', '佐賀県'),
+    (42, '長崎', '長崎県'),
+    (43, '熊本', '熊本県'),
+    (44, '大分', '大分県'),
+    (45, '宮崎', '宮崎県'),
+    (46, '鹿児島', '鹿児島県'),
+    (47, '沖縄', '沖縄県')
+ON CONFLICT (prefecture_code) DO NOTHING;
+
+CREATE TABLE IF NOT EXISTS genres (
+    genre_code SERIAL PRIMARY KEY,
+    name VARCHAR(64) NOT NULL UNIQUE
+);
+INSERT INTO genres (name)
+SELECT DISTINCT genre_2 FROM events WHERE genre_2 IS NOT NULL
+ORDER BY genre_2
+ON CONFLICT (name) DO NOTHING;
+
+ALTER TABLE events ADD COLUMN IF NOT EXISTS prefecture_code SMALLINT REFERENCES prefectures (prefecture_code);
+ALTER TABLE events ADD COLUMN IF NOT EXISTS genre_2_code INTEGER REFERENCES genres (genre_code);
+
+UPDATE events e SET prefecture_code = p.prefecture_code
+FROM prefectures p WHERE p.name = e.prefectures;
+UPDATE events e SET genre_2_code = g.genre_code
+FROM genres g WHERE g.name = e.genre_2;
+
+-- events の登録・更新時に名称からコードを埋める（未登録のジャンルは genres に追加する）
+CREATE OR REPLACE FUNCTION set_event_codes() RETURNS trigger AS $$
+BEGIN
+    SELECT prefecture_code INTO NEW.prefecture_code FROM prefectures WHERE name = NEW.prefectures;
+    IF NEW.genre_2 IS NULL THEN
+        NEW.genre_2_code := NULL;
+    ELSE
+        INSERT INTO genres (name) VALUES (NEW.genre_2) ON CONFLICT (name) DO NOTHING;
+        SELECT genre_code INTO NEW.genre_2_code FROM genres WHERE name = NEW.genre_2;
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS events_set_codes ON events;
+CREATE TRIGGER events_set_codes
+    BEFORE INSERT OR UPDATE OF prefectures, genre_2 ON events
+    FOR EACH ROW EXECUTE FUNCTION set_event_codes();
+
+CREATE INDEX IF NOT EXISTS events_prefecture_code_idx ON events (prefecture_code);
+CREATE INDEX IF NOT EXISTS events_genre_2_code_idx ON events (genre_2_code);
+DROP INDEX IF EXISTS events_genre_2_idx;
+DROP INDEX IF EXISTS events_prefectures_idx;
+
+-- event_listing にコードを追加し、文字列ではなくコードで引くインデックスに張り替える
+DROP MATERIALIZED VIEW IF EXISTS event_listing;
+CREATE MATERIALIZED VIEW event_listing AS
+SELECT
+    e.event_id,
+    e.event_title,
+    e.artist_name,
+    e.open_time,
+    e.start_time,
+    e.prefectures,
+    e.event_venue,
+    e.event_venue_id,
+    e.genre_1,
+    e.genre_2,
+    COALESCE(
+        array_agg(c.check_in_place ORDER BY c.check_in_place_id) FILTER (WHERE c.check_in_place IS NOT NULL),
+        '{}'
+    ) AS check_in_places,
+    e.prefecture_code,
+    e.genre_2_code
+FROM events e
+LEFT JOIN check_in_place c ON e.event_venue_id = c.event_venue_id
+GROUP BY e.event_id;
+
+CREATE UNIQUE INDEX event_listing_event_id_idx ON event_listing (event_id);
+CREATE INDEX event_listing_prefecture_code_start_time_idx ON event_listing (prefecture_code, start_time);
+CREATE INDEX event_listing_genre_2_code_start_time_idx ON event_listing (genre_2_code, start_time);
+CREATE INDEX event_listing_start_time_idx ON event_listing (start_time);
+
+UPDATE event_listing_state s SET refreshed_version = v.version, refreshed_at = now()
+FROM catalog_version v WHERE s.id = 1 AND v.id = 1;
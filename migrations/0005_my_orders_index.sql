@@ -0,0 +1,4 @@
+-- GET /my-orders: ユーザーの進行中の注文を check_in_time 順に読む
+CREATE INDEX IF NOT EXISTS orders_user_active_idx
+    ON orders (user_id, check_in_time, order_id)
+    WHERE status IN ('waiting', 'requested', 'approved_waiting', 'matched');
@@ -0,0 +1,80 @@
+-- orders を check_in_time で月ごとにパーティション分割する
+-- 古い月のパーティションは partitions.py が切り離して orders_archive スキーマへ移す
+
+CREATE SCHEMA IF NOT EXISTS orders_archive;
+
+-- 指定した月のパーティション (orders_pYYYYMM) を作る。既にあれば何もしない
+CREATE OR REPLACE FUNCTION create_orders_partition(month DATE) RETURNS TEXT AS $$
+DECLARE
+    start_at DATE := date_trunc('month', month)::date;
+    end_at DATE := (date_trunc('month', month) + interval '1 month')::date;
+    partition_name TEXT := 'orders_p' || to_char(start_at, 'YYYYMM');
+BEGIN
+    IF to_regclass('public.' || partition_name) IS NULL
+       AND to_regclass('orders_archive.' || partition_name) IS NULL THEN
+        EXECUTE format(
+            'CREATE TABLE %I PARTITION OF orders FOR VALUES FROM (%L) TO (%L)',
+            partition_name, start_at, end_at
+        );
+    END IF;
+    RETURN partition_name;
+END;
+$$ LANGUAGE plpgsql;
+
+ALTER TABLE orders RENAME TO orders_unpartitioned;
+
+-- カラム順は元の orders と同じ（SELECT * の結果を変えない）
+CREATE TABLE orders (
+    order_id INTEGER NOT NULL DEFAULT nextval('orders_order_id_seq'),
+    user_id INTEGER NOT NULL REFERENCES users (user_id),
+    event_id INTEGER NOT NULL REFERENCES events (event_id),
+    origin VARCHAR(255) NOT NULL,
+    destination VARCHAR(255) NOT NULL,
+    check_in_time TIMESTAMP NOT NULL,
+    co_passenger INTEGER NOT NULL DEFAULT 0,
+    min_participants INTEGER NOT NULL DEFAULT 1,
+    back_seat_passengers INTEGER NOT NULL DEFAULT 0,
+    wants_female BOOLEAN NOT NULL DEFAULT FALSE,
+    id_verification_status VARCHAR(16) NOT NULL DEFAULT 'unverified',
+    status VARCHAR(32) NOT NULL DEFAULT 'waiting',
+    journey_type VARCHAR(16) NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    requested_at TIMESTAMPTZ,
+    aitaku_user_id INTEGER REFERENCES users (user_id),
+    PRIMARY KEY (order_id, check_in_time)
+) PARTITION BY RANGE (check_in_time);
+
+-- どの月にも当てはまらない行の受け皿（通常は partitions.py が先の月を作っておくので空）
+CREATE TABLE orders_default PARTITION OF orders DEFAULT;
+
+-- 既存データの月から3か月先までのパーティションを作る
+DO $$
+DECLARE
+    month DATE;
+    last_month DATE;
+BEGIN
+    SELECT date_trunc('month', COALESCE(min(check_in_time), now()))::date INTO month FROM orders_unpartitioned;
+    last_month := (date_trunc('month', greatest(now(), (SELECT COALESCE(max(check_in_time), now()) FROM orders_unpartitioned))) + interval '3 months')::date;
+    WHILE month <= last_month LOOP
+        PERFORM create_orders_partition(month);
+        month := (month + interval '1 month')::date;
+    END LOOP;
+END
+$$;
+
+INSERT INTO orders SELECT * FROM orders_unpartitioned;
+
+ALTER SEQUENCE orders_order_id_seq OWNED BY orders.order_id;
+DROP TABLE orders_unpartitioned;
+
+-- インデックスは親テーブルに作り、各パーティションに引き継がせる
+-- (order_id だけでの検索は主キー (order_id, check_in_time) を各パーティションで使う)
+CREATE INDEX orders_user_id_status_idx ON orders (user_id, status);
+CREATE INDEX orders_aitaku_user_id_idx ON orders (aitaku_user_id);
+CREATE INDEX orders_candidates_idx
+    ON orders (origin, destination, check_in_time, journey_type)
+    WHERE status IN ('waiting', 'matched');
+CREATE INDEX orders_user_active_idx
+    ON orders (user_id, check_in_time, order_id)
+    WHERE status IN ('waiting', 'requested', 'approved_waiting', 'matched');
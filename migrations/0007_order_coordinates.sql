@@ -0,0 +1,62 @@
+-- 乗車地・目的地を座標で持ち、近くの注文を探せるようにする（search-orders の match_mode=proximity）
+
+-- 地名辞書（駅・会場など）。名称の表記ゆれは gazetteer.py が正規化・前方一致で吸収する
+CREATE TABLE IF NOT EXISTS places (
+    place_id SERIAL PRIMARY KEY,
+    name VARCHAR(255) NOT NULL UNIQUE,
+    lat DOUBLE PRECISION NOT NULL,
+    lng DOUBLE PRECISION NOT NULL
+);
+
+INSERT INTO places (name, lat, lng) VALUES
+    ('東京駅', 35.681236, 139.767125),
+    ('渋谷駅', 35.658034, 139.701636),
+    ('新宿駅', 35.689607, 139.700571),
+    ('池袋駅', 35.729503, 139.710900),
+    ('品川駅', 35.628471, 139.738760),
+    ('上野駅', 35.713768, 139.777254),
+    ('水道橋駅', 35.702003, 139.753425),
+    ('後楽園駅', 35.707898, 139.751801),
+    ('東京ドーム', 35.705639, 139.751891),
+    ('横浜駅', 35.465798, 139.622314),
+    ('新横浜駅', 35.506848, 139.617585),
+    ('さいたま新都心駅', 35.893867, 139.633587),
+    ('幕張豊砂駅', 35.653600, 140.030200),
+    ('名古屋駅', 35.170915, 136.881537),
+    ('大阪駅', 34.702485, 135.495951),
+    ('京セラドーム大阪', 34.669400, 135.476200),
+    ('博多駅', 33.589728, 130.420727),
+    ('札幌駅', 43.068661, 141.350755)
+ON CONFLICT (name) DO NOTHING;
+
+-- 会場ごとの集合場所にも座標を持たせる（places に同じ名称があれば引き継ぐ）
+ALTER TABLE check_in_place ADD COLUMN IF NOT EXISTS lat DOUBLE PRECISION;
+ALTER TABLE check_in_place ADD COLUMN IF NOT EXISTS lng DOUBLE PRECISION;
+
+UPDATE check_in_place c
+SET lat = p.lat, lng = p.lng
+FROM places p
+WHERE p.name = c.check_in_place AND c.lat IS NULL;
+
+-- orders の末尾に追加する（SELECT * の先頭17列は変えない）
+-- ジオハッシュは "C" 照合順序にして、前方一致をパラメータ付きの範囲条件 (>=, <) でインデックス検索できるようにする
+ALTER TABLE orders ADD COLUMN IF NOT EXISTS origin_lat DOUBLE PRECISION;
+ALTER TABLE orders ADD COLUMN IF NOT EXISTS origin_lng DOUBLE PRECISION;
+ALTER TABLE orders ADD COLUMN IF NOT EXISTS origin_geohash VARCHAR(12) COLLATE "C";
+ALTER TABLE orders ADD COLUMN IF NOT EXISTS destination_lat DOUBLE PRECISION;
+ALTER TABLE orders ADD COLUMN IF NOT EXISTS destination_lng DOUBLE PRECISION;
+ALTER TABLE orders ADD COLUMN IF NOT EXISTS destination_geohash VARCHAR(12) COLLATE "C";
+
+-- search-orders は check_in_time を必ず等号で指定するため、check_in_time の中でジオハッシュの範囲を引く
+CREATE INDEX IF NOT EXISTS orders_origin_geohash_idx
+    ON orders (check_in_time, origin_geohash)
+    WHERE status IN ('waiting', 'matched');
+
+-- 2点間の距離（メートル）
+CREATE OR REPLACE FUNCTION haversine_m(lat1 DOUBLE PRECISION, lng1 DOUBLE PRECISION, lat2 DOUBLE PRECISION, lng2 DOUBLE PRECISION)
+RETURNS DOUBLE PRECISION AS $$
+    SELECT 2 * 6371008.8 * asin(least(1.0, sqrt(
+        power(sin(radians(lat2 - lat1) / 2), 2)
+        + cos(radians(lat1)) * cos(radians(lat2)) * power(sin(radians(lng2 - lng1) / 2), 2)
+    )))
+$$ LANGUAGE sql IMMUTABLE PARALLEL SAFE;
@@ -0,0 +1,19 @@
+-- 注文の追加・更新・削除を orders_changed チャンネルに order_id で通知する
+-- matching_index.py が受け取り、その注文だけを読み直してプロセス内の索引を更新する
+-- （同じトランザクション内の同じ order_id の通知は PostgreSQL が1つにまとめる）
+
+CREATE OR REPLACE FUNCTION notify_order_changed() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('orders_changed', OLD.order_id::text);
+    ELSE
+        PERFORM pg_notify('orders_changed', NEW.order_id::text);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS orders_notify_changed ON orders;
+CREATE TRIGGER orders_notify_changed
+    AFTER INSERT OR UPDATE OR DELETE ON orders
+    FOR EACH ROW EXECUTE FUNCTION notify_order_changed();
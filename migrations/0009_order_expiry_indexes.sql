@@ -0,0 +1,12 @@
+-- expiry.py が期限切れの注文を探すためのインデックス
+-- どちらも対象の状態の行だけを持つので、期限切れにした（状態を変えた）行はインデックスから外れて小さいまま保たれる
+
+-- 集合時刻を過ぎた募集中の注文
+CREATE INDEX IF NOT EXISTS orders_waiting_check_in_time_idx
+    ON orders (check_in_time)
+    WHERE status = 'waiting';
+
+-- 相手の確定を待ったまま止まっている注文（requested_at が無い古い行は updated_at で判断する）
+CREATE INDEX IF NOT EXISTS orders_pending_requested_at_idx
+    ON orders ((COALESCE(requested_at, updated_at)))
+    WHERE status IN ('requested', 'approved_waiting');
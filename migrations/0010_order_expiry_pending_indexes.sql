@@ -0,0 +1,13 @@
+-- expiry.py の対象の変更に合わせて 0009 のインデックスを作り直す
+-- - 集合時刻を過ぎた注文は、募集中だけでなく確定待ち（requested / approved_waiting）も期限切れにする
+-- - 確定されない依頼を戻すのは requested_at のある行だけにする（updated_at では判断しない）
+
+DROP INDEX IF EXISTS orders_waiting_check_in_time_idx;
+CREATE INDEX IF NOT EXISTS orders_open_check_in_time_idx
+    ON orders (check_in_time)
+    WHERE status IN ('waiting', 'requested', 'approved_waiting');
+
+DROP INDEX IF EXISTS orders_pending_requested_at_idx;
+CREATE INDEX IF NOT EXISTS orders_pending_requested_at_idx
+    ON orders (requested_at)
+    WHERE status IN ('requested', 'approved_waiting') AND requested_at IS NOT NULL;
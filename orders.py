@@ -1,28 +1,16 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query
 from pydantic import BaseModel, Field
 from datetime import datetime
-import psycopg2
-import os
 import pytz
 import logging
+from db import get_db_connection, release_connection, execute, mark_user_write
+from partitions import hot_since
+from gazetteer import resolve
 from auth import decode_access_token, oauth2_scheme  # auth.pyからoauth2_schemeをインポート
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# データベース接続関数
-def get_db_connection():
-    try:
-        conn = psycopg2.connect(
-            host=os.getenv("DB_HOST"),
-            database=os.getenv("DB_NAME"),
-            user=os.getenv("DB_USER"),
-            password=os.getenv("DB_PASSWORD")
-        )
-        return conn
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"DB connection error: {str(e)}")
-
 # リクエストボディ用のPydanticモデル
 class OrderCreate(BaseModel):
     event_id: int
@@ -51,6 +39,16 @@ def create_order(order: OrderCreate, token: str = Depends(oauth2_scheme)):
     except Exception as e:
         raise HTTPException(status_code=401, detail=f"Token error: {str(e)}")
     
+    # 乗車地・目的地を座標に変換する（近い注文の検索に使う。辞書に無ければ NULL）
+    # 辞書の読み込みで別の接続を使うことがあるため、接続を借りる前に行う
+    try:
+        origin_point = resolve(order.origin)
+        destination_point = resolve(order.destination)
+    except Exception as e:
+        # 辞書を読み込めなくても注文は作る（座標は NULL のまま。gazetteer.py の backfill が後から埋める）
+        logger.warning(f"failed to resolve coordinates: {str(e)}")
+        origin_point = destination_point = (None, None, None)
+
     # データベース接続を取得
     conn = get_db_connection()
     cursor = conn.cursor()
@@ -61,18 +59,14 @@ def create_order(order: OrderCreate, token: str = Depends(oauth2_scheme)):
 
     try:
         # 新しい注文を挿入
-        cursor.execute(
-            """
-            INSERT INTO orders (user_id, event_id, origin, destination, check_in_time, co_passenger, min_participants, 
-                                back_seat_passengers, wants_female, id_verification_status, status, journey_type, created_at, updated_at)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            RETURNING order_id
-            """,
+        execute(
+            cursor,
+            "insert_order",
             (
                 user_id, order.event_id, order.origin, order.destination, order.check_in_time,
                 order.co_passenger, order.min_participants, order.back_seat_passengers, order.wants_female,
                 order.id_verification_status, order.status, order.journey_type, now_jst, now_jst
-            )
+            ) + origin_point + destination_point
         )
 
         # 挿入された注文のorder_idを取得
@@ -80,6 +74,7 @@ def create_order(order: OrderCreate, token: str = Depends(oauth2_scheme)):
         logger.info('#order_id CHECK#')
         logger.info(order_id)
         conn.commit()
+        mark_user_write(conn, user_id)
 
         return {"order_id": order_id}
 
@@ -89,7 +84,7 @@ def create_order(order: OrderCreate, token: str = Depends(oauth2_scheme)):
 
     finally:
         cursor.close()  # カーソルを閉じる
-        conn.close()  # データベース接続を閉じる
+        release_connection(conn)  # 接続をプールに返す
 
 # 注文ステータスを取得するエンドポイント
 @order_router.get("/orders/{order_id}")
@@ -107,25 +102,19 @@ def get_order_status(order_id: int, token: str = Depends(oauth2_scheme)):
 
     logger.info("connection START")    
     # データベース接続を取得
-    conn = get_db_connection()
+    conn = get_db_connection("read")
     cursor = conn.cursor()
     logger.info("make cursor")    
 
     try:
         # 指定された注文のステータスを取得
-        query = """
-            SELECT users.user_name, users.rating, users.review_count
-            FROM orders
-            INNER JOIN users
-            ON orders.user_id = users.user_id
-            WHERE orders.order_id = %s ;
-        """
+        query = "get_order_owner_profile"
         values = (order_id,)  # タプル形式に変更
 
         logger.info(query)
         logger.info(values)
 
-        cursor.execute(query, values)
+        execute(cursor, query, values)
         logger.info("cursor execute DONE")
         result = cursor.fetchone()
 
@@ -143,4 +132,58 @@ def get_order_status(order_id: int, token: str = Depends(oauth2_scheme)):
 
     finally:
         cursor.close()
-        conn.close()
+        release_connection(conn)
+
+
+# 注文1件分を整形（相手ユーザーとイベントの概要を含める）
+def serialize_my_order(row):
+    return {
+        "order_id": row[0],
+        "status": row[1],
+        "event_id": row[2],
+        "origin": row[3],
+        "destination": row[4],
+        "check_in_time": row[5],
+        "journey_type": row[6],
+        "partner": None if row[7] is None else {
+            "user_id": row[7],
+            "user_name": row[8],
+            "rating": row[9],
+            "review_count": row[10],
+        },
+        "event": {
+            "event_title": row[11],
+            "artist_name": row[12],
+            "start_time": row[13],
+            "event_venue": row[14],
+        },
+    }
+
+# ログイン中のユーザーの進行中の注文を、相手ユーザーとイベントの情報付きで1回のクエリで返すエンドポイント
+@order_router.get("/my-orders")
+def get_my_orders(
+    token: str = Depends(oauth2_scheme),
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+):
+    user_id = decode_access_token(token)  # トークンが無効なら401
+
+    conn = get_db_connection("read", user_id=user_id)
+    cursor = conn.cursor()
+
+    try:
+        # 次のページの有無を判定するため1件多く取得する
+        execute(cursor, "list_my_orders", (user_id, limit + 1, offset, hot_since()))
+        rows = cursor.fetchall()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error fetching orders: {str(e)}")
+    finally:
+        cursor.close()
+        release_connection(conn)
+
+    return {
+        "orders": [serialize_my_order(row) for row in rows[:limit]],
+        "limit": limit,
+        "offset": offset,
+        "has_more": len(rows) > limit,
+    }
@@ -0,0 +1,187 @@
+import argparse
+import logging
+import re
+import sys
+from datetime import date, datetime, timedelta
+
+import pytz
+from psycopg2 import errors, sql
+
+from db import get_db_connection, release_connection
+from settings import get_settings
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 複数プロセスが同時にメンテナンスしないためのアドバイザリロックのキー
+MAINTENANCE_LOCK_KEY = 727003
+
+PARTITION_NAME_RE = re.compile(r"^orders_p(\d{4})(\d{2})$")
+
+
+def add_months(month, months):
+    index = month.year * 12 + (month.month - 1) + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+JST = pytz.timezone('Asia/Tokyo')
+
+
+# check_in_time（タイムゾーン無しの日本時間）と比べるための現在時刻
+# サーバーのタイムゾーン（RDS / EC2 では UTC）に関係なく日本時間で返す
+def now_jst():
+    return datetime.now(JST).replace(tzinfo=None)
+
+
+# 依頼中・進行中の注文を探すときの check_in_time の下限
+# 条件に入れておくと、プランナが古い月のパーティションを読まずに済む
+def hot_since():
+    return now_jst() - timedelta(days=get_settings().orders_hot_days)
+
+
+def partition_name(month):
+    return f"orders_p{month:%Y%m}"
+
+
+# public スキーマにある orders の月パーティションを (名前, 月初) で返す
+def list_partitions(cursor):
+    cursor.execute(
+        """
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE i.inhparent = 'public.orders'::regclass
+        AND n.nspname = 'public'
+        """
+    )
+    partitions = []
+    for (name,) in cursor.fetchall():
+        match = PARTITION_NAME_RE.match(name)
+        if match:
+            partitions.append((name, date(int(match.group(1)), int(match.group(2)), 1)))
+    return sorted(partitions, key=lambda p: p[1])
+
+
+# 今月から months_ahead か月先までのパーティションを用意する
+def ensure_future_partitions(conn, months_ahead):
+    cursor = conn.cursor()
+    try:
+        this_month = now_jst().date().replace(day=1)
+        for i in range(months_ahead + 1):
+            month = add_months(this_month, i)
+            try:
+                cursor.execute("SELECT create_orders_partition(%s)", (month,))
+                conn.commit()
+            except errors.CheckViolation as e:
+                conn.rollback()
+                # orders_default に該当月の行が入っていると作れないので、行を移してから付け替える
+                logger.info(f"moving rows out of orders_default for {month:%Y-%m}: {str(e).strip()}")
+                move_default_rows(conn, month)
+            except Exception:
+                conn.rollback()
+                raise
+    finally:
+        cursor.close()
+
+
+def move_default_rows(conn, month):
+    name = partition_name(month)
+    start_at, end_at = month, add_months(month, 1)
+    cursor = conn.cursor()
+    try:
+        cursor.execute("LOCK TABLE orders_default IN ACCESS EXCLUSIVE MODE")
+        cursor.execute(
+            sql.SQL("CREATE TABLE {} (LIKE orders INCLUDING DEFAULTS INCLUDING CONSTRAINTS)").format(sql.Identifier(name))
+        )
+        cursor.execute(
+            sql.SQL(
+                """
+                WITH moved AS (
+                    DELETE FROM orders_default
+                    WHERE check_in_time >= %s AND check_in_time < %s
+                    RETURNING *
+                )
+                INSERT INTO {} SELECT * FROM moved
+                """
+            ).format(sql.Identifier(name)),
+            (start_at, end_at),
+        )
+        logger.info(f"moved {cursor.rowcount} rows from orders_default to {name}")
+        cursor.execute(
+            sql.SQL("ALTER TABLE orders ATTACH PARTITION {} FOR VALUES FROM (%s) TO (%s)").format(sql.Identifier(name)),
+            (start_at, end_at),
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+# check_in_time が retention_months か月より前の月のパーティションを切り離し、orders_archive に移す
+# 切り離した行は search_orders などのスキャンやインデックスの対象から外れる
+def archive_old_partitions(conn, retention_months):
+    cutoff = add_months(now_jst().date().replace(day=1), -retention_months)
+    cursor = conn.cursor()
+    archived = []
+    try:
+        for name, month in list_partitions(cursor):
+            if add_months(month, 1) > cutoff:
+                continue
+            cursor.execute(sql.SQL("ALTER TABLE orders DETACH PARTITION {}").format(sql.Identifier(name)))
+            cursor.execute(sql.SQL("ALTER TABLE {} SET SCHEMA orders_archive").format(sql.Identifier(name)))
+            conn.commit()
+            archived.append(name)
+            logger.info(f"archived {name} to orders_archive")
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+    return archived
+
+
+def run_maintenance():
+    settings = get_settings()
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT pg_try_advisory_lock(%s)", (MAINTENANCE_LOCK_KEY,))
+        if not cursor.fetchone()[0]:
+            logger.info("partition maintenance is already running")
+            return
+        conn.commit()
+        # パーティションの作成に失敗してもアーカイブは実行する（失敗は両方を実行した後に送出する）
+        failures = []
+        try:
+            try:
+                ensure_future_partitions(conn, settings.orders_partition_months_ahead)
+            except Exception as e:
+                logger.error(f"failed to create partitions: {str(e).strip()}")
+                failures.append(e)
+            try:
+                archive_old_partitions(conn, settings.orders_retention_months)
+            except Exception as e:
+                logger.error(f"failed to archive partitions: {str(e).strip()}")
+                failures.append(e)
+        finally:
+            cursor.execute("SELECT pg_advisory_unlock(%s)", (MAINTENANCE_LOCK_KEY,))
+            conn.commit()
+    finally:
+        cursor.close()
+        release_connection(conn)
+    if failures:
+        raise failures[0]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="orders パーティションのメンテナンス（日次の cron で実行）")
+    parser.parse_args(argv)
+    run_maintenance()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
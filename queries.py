@@ -0,0 +1,267 @@
+# 各ルーターで使うSQLの一覧
+# ここで名前を付けて一度だけ定義し、db.execute() がプール内の接続ごとに
+# サーバー側のプリペアドステートメント (PREPARE / EXECUTE) として実行する。
+# パラメータは $1, $2 ... で記述する（型は PostgreSQL が文脈から推論する）。
+
+QUERIES = {
+    # --- 疎通確認 ---
+    "ping": """
+        SELECT 1
+    """,
+
+    # --- auth.py ---
+    "get_user_by_email": """
+        SELECT user_id, email, password, sex
+        FROM users
+        WHERE email = $1
+    """,
+    "user_exists": """
+        SELECT 1
+        FROM users
+        WHERE email = $1
+    """,
+    "insert_user": """
+        INSERT INTO users (password, email, sex)
+        VALUES ($1, $2, $3)
+    """,
+
+    # --- main.py ---
+    "get_email_by_username": """
+        SELECT email
+        FROM test
+        WHERE user_name = $1
+    """,
+
+    # --- search.py ---
+    "get_event": """
+        SELECT e.event_id, e.event_title, e.artist_name, e.open_time, e.start_time, e.prefectures, e.event_venue, e.event_venue_id, e.genre_1, e.genre_2,
+               e.prefecture_code, e.genre_2_code
+        FROM events e
+        WHERE e.event_id = $1
+    """,
+    "get_catalog_version": """
+        SELECT v.version, v.updated_at, s.refreshed_version, s.refreshed_at
+        FROM catalog_version v, event_listing_state s
+        WHERE v.id = 1 AND s.id = 1
+    """,
+    "get_check_in_places": """
+        SELECT check_in_place
+        FROM check_in_place
+        WHERE event_venue_id = $1
+    """,
+
+    # --- lookups.py ---
+    "list_prefectures": """
+        SELECT prefecture_code, name, full_name
+        FROM prefectures
+        ORDER BY prefecture_code
+    """,
+    "list_genres": """
+        SELECT genre_code, name
+        FROM genres
+        ORDER BY genre_code
+    """,
+
+    # --- gazetteer.py ---
+    "list_places": """
+        SELECT name, lat, lng FROM places
+        UNION ALL
+        SELECT check_in_place, lat, lng FROM check_in_place
+        WHERE lat IS NOT NULL AND lng IS NOT NULL
+    """,
+    "list_orders_without_coordinates": """
+        SELECT order_id, check_in_time, origin, destination
+        FROM orders
+        WHERE (origin_geohash IS NULL OR destination_geohash IS NULL)
+        AND order_id > $1
+        ORDER BY order_id
+        LIMIT $2
+    """,
+    "set_order_coordinates": """
+        UPDATE orders
+        SET origin_lat = $3, origin_lng = $4, origin_geohash = $5,
+            destination_lat = $6, destination_lng = $7, destination_geohash = $8
+        WHERE order_id = $1 AND check_in_time = $2
+    """,
+
+    # --- orders.py ---
+    "insert_order": """
+        INSERT INTO orders (user_id, event_id, origin, destination, check_in_time, co_passenger, min_participants,
+                            back_seat_passengers, wants_female, id_verification_status, status, journey_type, created_at, updated_at,
+                            origin_lat, origin_lng, origin_geohash, destination_lat, destination_lng, destination_geohash)
+        VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14, $15, $16, $17, $18, $19, $20)
+        RETURNING order_id
+    """,
+    "get_order_owner_profile": """
+        SELECT users.user_name, users.rating, users.review_count
+        FROM orders
+        INNER JOIN users
+        ON orders.user_id = users.user_id
+        WHERE orders.order_id = $1
+    """,
+    "list_my_orders": """
+        SELECT o.order_id, o.status, o.event_id, o.origin, o.destination, o.check_in_time, o.journey_type,
+               o.aitaku_user_id, p.user_name, p.rating, p.review_count,
+               e.event_title, e.artist_name, e.start_time, e.event_venue
+        FROM orders o
+        LEFT JOIN users p ON p.user_id = o.aitaku_user_id
+        LEFT JOIN events e ON e.event_id = o.event_id
+        WHERE o.user_id = $1
+        AND o.status IN ('waiting', 'requested', 'approved_waiting', 'matched')
+        AND o.check_in_time >= $4
+        ORDER BY o.check_in_time, o.order_id
+        LIMIT $2 OFFSET $3
+    """,
+
+    # --- search_candidates.py ---
+    "search_candidate_orders": """
+        SELECT order_id, user_id, event_id, origin, destination, check_in_time, co_passenger, min_participants,
+               back_seat_passengers, wants_female, id_verification_status, status, journey_type, created_at, updated_at,
+               requested_at, aitaku_user_id
+        FROM orders
+        WHERE origin = $1
+        AND destination = $2
+        AND check_in_time = $3
+        AND co_passenger = $4
+        AND min_participants = $5
+        AND back_seat_passengers = $6
+        AND wants_female = $7
+        AND id_verification_status = $8
+        AND journey_type = $9
+        AND status IN ('waiting', 'matched')
+        AND user_id != $10
+    """,
+
+    # 乗車地のジオハッシュの前方一致 ($1 のセル) でインデックスを引き、乗車地・目的地とも半径 $8 メートル以内に絞る
+    # 列は search_candidate_orders と同じ
+    "search_nearby_orders": """
+        SELECT o.order_id, o.user_id, o.event_id, o.origin, o.destination, o.check_in_time, o.co_passenger, o.min_participants,
+               o.back_seat_passengers, o.wants_female, o.id_verification_status, o.status, o.journey_type, o.created_at, o.updated_at,
+               o.requested_at, o.aitaku_user_id
+        FROM unnest($1::text[]) AS cell (prefix)
+        CROSS JOIN LATERAL (
+            SELECT * FROM orders
+            WHERE status IN ('waiting', 'matched')
+            AND check_in_time = $9
+            AND origin_geohash >= cell.prefix AND origin_geohash < cell.prefix || '~'
+            OFFSET 0  -- 平坦化させず、セルごとに (check_in_time, origin_geohash) のインデックスを引かせる
+        ) o
+        WHERE left(o.destination_geohash, $2) = ANY($3::text[])
+        AND haversine_m(o.origin_lat, o.origin_lng, $4, $5) <= $8
+        AND haversine_m(o.destination_lat, o.destination_lng, $6, $7) <= $8
+        AND o.co_passenger = $10
+        AND o.min_participants = $11
+        AND o.back_seat_passengers = $12
+        AND o.wants_female = $13
+        AND o.id_verification_status = $14
+        AND o.journey_type = $15
+        AND o.user_id != $16
+        ORDER BY haversine_m(o.origin_lat, o.origin_lng, $4, $5) + haversine_m(o.destination_lat, o.destination_lng, $6, $7), o.order_id
+    """,
+
+    # --- matching_index.py ---
+    "list_open_orders": """
+        SELECT order_id, user_id, event_id, origin, destination, check_in_time, co_passenger, min_participants,
+               back_seat_passengers, wants_female, id_verification_status, status, journey_type, created_at, updated_at,
+               requested_at, aitaku_user_id
+        FROM orders
+        WHERE status IN ('waiting', 'matched')
+        AND check_in_time >= $1
+    """,
+    "get_orders_by_ids": """
+        SELECT order_id, user_id, event_id, origin, destination, check_in_time, co_passenger, min_participants,
+               back_seat_passengers, wants_female, id_verification_status, status, journey_type, created_at, updated_at,
+               requested_at, aitaku_user_id
+        FROM orders
+        WHERE order_id = ANY($1::integer[])
+    """,
+
+    # --- check_requested.py ---
+    "get_requested_order": """
+        SELECT * FROM orders
+        WHERE user_id = $1
+        AND status = 'requested'
+        AND check_in_time >= $2
+    """,
+    "get_partner_profile": """
+        SELECT users.user_name, users.rating, users.review_count, orders.order_id, orders.status
+        FROM orders
+        INNER JOIN users
+        ON orders.user_id = users.user_id
+        WHERE orders.user_id = $1
+        AND orders.check_in_time >= $2
+    """,
+
+    # --- update_accept_order.py ---
+    "get_order_user_id": """
+        SELECT user_id
+        FROM orders
+        WHERE order_id = $1
+    """,
+    "mark_order_requested": """
+        UPDATE public.orders
+        SET status='requested', aitaku_user_id = $1, requested_at = now(), updated_at = now()
+        WHERE order_id = $2
+    """,
+    "mark_order_approved_waiting": """
+        UPDATE public.orders
+        SET status='approved_waiting', aitaku_user_id = $1, requested_at = now(), updated_at = now()
+        WHERE order_id = $2
+    """,
+    "mark_order_matched": """
+        UPDATE public.orders
+        SET status='matched', updated_at = now()
+        WHERE order_id = $1
+        RETURNING user_id
+    """,
+
+    # --- expiry.py ---
+    # 1回に $2 件まで。他のトランザクションが更新中の行は飛ばす
+    # 集合時刻を過ぎても成立していない注文（募集中・確定待ち）
+    "expire_past_orders": """
+        UPDATE orders o
+        SET status = 'expired', updated_at = now()
+        FROM (
+            SELECT order_id, check_in_time FROM orders
+            WHERE status IN ('waiting', 'requested', 'approved_waiting')
+            AND check_in_time < $1
+            LIMIT $2
+            FOR UPDATE SKIP LOCKED
+        ) expired
+        WHERE o.order_id = expired.order_id AND o.check_in_time = expired.check_in_time
+        AND o.status IN ('waiting', 'requested', 'approved_waiting') AND o.check_in_time < $1  -- 更新側も部分インデックスで引かせる（無いと orders 全体を読んで結合しうる）
+        RETURNING o.order_id, o.user_id, o.origin, o.destination, o.check_in_time
+    """,
+    # 依頼してから確定されないまま $1 を過ぎた注文を募集中に戻す
+    # requested_at の無い（記録する前からの）行と、集合時刻が $3 を過ぎた行は戻さない（後者は expire_past_orders が期限切れにする）
+    "revert_stale_requests": """
+        UPDATE orders o
+        SET status = 'waiting', aitaku_user_id = NULL, requested_at = NULL, updated_at = now()
+        FROM (
+            SELECT order_id, check_in_time FROM orders
+            WHERE status IN ('requested', 'approved_waiting')
+            AND requested_at IS NOT NULL AND requested_at < $1
+            AND check_in_time >= $3
+            LIMIT $2
+            FOR UPDATE SKIP LOCKED
+        ) stale
+        WHERE o.order_id = stale.order_id AND o.check_in_time = stale.check_in_time
+        AND o.status IN ('requested', 'approved_waiting')
+        AND o.requested_at IS NOT NULL AND o.requested_at < $1 AND o.check_in_time >= $3
+        RETURNING o.order_id, o.user_id, o.origin, o.destination, o.check_in_time
+    """,
+    "get_user_emails": """
+        SELECT user_id, email
+        FROM users
+        WHERE user_id = ANY($1::integer[])
+    """,
+
+    # --- send_email.py ---
+    "get_order_emails": """
+        SELECT u.email AS user_email, a.email AS aitaku_email
+        FROM orders
+        JOIN users AS u ON orders.user_id = u.user_id
+        JOIN users AS a ON orders.aitaku_user_id = a.user_id
+        WHERE orders.order_id = $1
+    """,
+}
@@ -0,0 +1,142 @@
+import asyncio
+import logging
+import threading
+from contextvars import ContextVar
+
+from fastapi.exception_handlers import http_exception_handler
+from fastapi.responses import JSONResponse
+from psycopg2 import errors
+from starlette.concurrency import run_in_threadpool
+from starlette.exceptions import HTTPException as StarletteHTTPException
+
+from settings import get_settings
+
+logger = logging.getLogger(__name__)
+
+# 処理中のリクエスト（ミドルウェアが設定する。リクエスト外では None）
+_request_queries = ContextVar("request_queries", default=None)
+# ルートごとの statement_timeout（ミリ秒。statement_timeout() の依存関係が設定する）
+_route_timeout = ContextVar("route_statement_timeout", default=None)
+
+
+# リクエストが借りている接続。クライアントが切断したら実行中のクエリをキャンセルする
+class RequestQueries:
+    def __init__(self):
+        self.connections = set()
+        self.disconnected = False
+        self.lock = threading.Lock()
+
+    def add(self, conn):
+        with self.lock:
+            self.connections.add(conn)
+
+    def discard(self, conn):
+        with self.lock:
+            self.connections.discard(conn)
+
+    # ロックを持ったままキャンセルする。release_connection は discard で待つので、
+    # プールに返されて別のリクエストが借りた接続のクエリをキャンセルすることはない
+    def cancel_all(self):
+        with self.lock:
+            count = len(self.connections)
+            for conn in self.connections:
+                try:
+                    conn.cancel()
+                except Exception as e:
+                    logger.warning(f"failed to cancel query: {str(e)}")
+        if count:
+            logger.info(f"canceled {count} queries after client disconnect")
+
+
+# 借りた接続に設定する statement_timeout（ミリ秒）
+# リクエスト中はルートごとの値（無ければ STATEMENT_TIMEOUT_DEFAULT）、リクエスト外（CLI や定期処理）は None（サーバーの既定値）
+def current_statement_timeout():
+    if _request_queries.get() is None:
+        return None
+    timeout = _route_timeout.get()
+    if timeout is None:
+        timeout = get_settings().statement_timeout_default
+    return timeout or None
+
+
+def track_connection(conn):
+    queries = _request_queries.get()
+    if queries is not None:
+        queries.add(conn)
+
+
+def untrack_connection(conn):
+    queries = _request_queries.get()
+    if queries is not None:
+        queries.discard(conn)
+
+
+# ルートの依存関係に指定する: dependencies=[Depends(statement_timeout("search_events"))]
+# STATEMENT_TIMEOUT_<ROUTE>（ミリ秒、0 で無制限）をこのリクエストで借りる接続に設定する
+def statement_timeout(route):
+    async def dependency():
+        _route_timeout.set(getattr(get_settings(), f"statement_timeout_{route}"))
+    return dependency
+
+
+# クライアントの切断を監視し、切断されたらそのリクエストが実行中のクエリをキャンセルするミドルウェア
+# 受信メッセージはキューを通してアプリに渡すので、アプリ側の受信（リクエストボディの読み込み）は変わらない
+class QueryCancellationMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        queries = RequestQueries()
+        token = _request_queries.set(queries)
+        messages = asyncio.Queue()
+
+        async def watch():
+            while True:
+                message = await receive()
+                await messages.put(message)
+                if message["type"] == "http.disconnect":
+                    queries.disconnected = True
+                    if queries.connections:
+                        await run_in_threadpool(queries.cancel_all)
+                    return
+
+        async def queued_receive():
+            if queries.disconnected and messages.empty():
+                return {"type": "http.disconnect"}
+            return await messages.get()
+
+        watcher = asyncio.create_task(watch())
+        try:
+            await self.app(scope, queued_receive, send)
+        finally:
+            watcher.cancel()
+            _request_queries.reset(token)
+
+
+def _is_query_canceled(exc):
+    while exc is not None:
+        if isinstance(exc, errors.QueryCanceled):
+            return True
+        exc = exc.__cause__ or exc.__context__
+    return False
+
+
+# statement_timeout を超えた（またはキャンセルされた）クエリは 503 (Retry-After) にする
+# ハンドラが例外を HTTPException(500) に包み直している場合も、元の例外をたどって判定する
+async def query_canceled_handler(request, exc):
+    if not _is_query_canceled(exc):
+        return await http_exception_handler(request, exc)
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "処理に時間がかかりすぎたため中断しました。しばらくしてから再度お試しください"},
+        headers={"Retry-After": "1"},
+    )
+
+
+def add_query_canceled_handlers(app):
+    app.add_exception_handler(StarletteHTTPException, query_canceled_handler)
+    app.add_exception_handler(errors.QueryCanceled, query_canceled_handler)
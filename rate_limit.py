@@ -0,0 +1,235 @@
+import hmac
+import logging
+import math
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import JSONResponse
+from jose import JWTError, jwt
+
+from settings import get_settings
+
+logger = logging.getLogger(__name__)
+
+# 拒否したリクエスト数 ((ルート, 理由) ごと。ワーカーごとに数える)
+REJECTED = Counter()
+_rejected_lock = threading.Lock()
+
+
+def count_rejected(route, reason):
+    with _rejected_lock:
+        REJECTED[(route, reason)] += 1
+
+
+# "10/60" (60秒あたり10回) を (1秒あたりの補充量, バケットの容量, 秒数) に変換する
+def parse_limit(spec):
+    count, _, seconds = spec.partition("/")
+    count = float(count)
+    seconds = float(seconds or 1)
+    return count / seconds, count, seconds
+
+
+# プロセス内のトークンバケット（ワーカーごとに独立）
+class MemoryBackend:
+    MAX_KEYS = 100000
+    PRUNE_INTERVAL = 1.0  # 満タンまで回復したバケットを消す間隔（秒）
+
+    def __init__(self):
+        # key -> (トークン数, 更新した時刻, 満タンに戻る時刻)。最後に使った順（先頭が最も古い）
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+        self.pruned_at = time.monotonic()
+
+    # 許可なら 0、拒否なら次に許可されるまでの秒数を返す
+    async def acquire(self, key, rate, burst):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.buckets.pop(key, None)
+            tokens = burst if entry is None else min(burst, entry[0] + (now - entry[1]) * rate)
+            if tokens >= 1:
+                retry_after = 0.0
+                tokens -= 1
+            else:
+                retry_after = (1 - tokens) / rate
+            self.buckets[key] = (tokens, now, now + (burst - tokens) / rate)
+            if now - self.pruned_at >= self.PRUNE_INTERVAL:
+                self._prune(now)
+            # 上限を超えたら最も長く使われていないバケットから捨てる
+            while len(self.buckets) > self.MAX_KEYS:
+                self.buckets.popitem(last=False)
+        return retry_after
+
+    # 満タンまで回復しているバケットは消しても結果が変わらない
+    # 古い順に見て、まだ回復していないバケットに当たったらやめる（全体は走査しない）
+    def _prune(self, now):
+        self.pruned_at = now
+        while self.buckets:
+            key, (_, _, full_at) = next(iter(self.buckets.items()))
+            if full_at > now:
+                break
+            del self.buckets[key]
+
+
+# Redis 上のトークンバケット（全ワーカーで共有）。時刻は Redis の TIME を使う
+_REDIS_TOKEN_BUCKET = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local data = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(data[1]) or burst
+local ts = tonumber(data[2]) or now
+tokens = math.min(burst, tokens + (now - ts) * rate)
+local retry_after = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    retry_after = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(retry_after)
+"""
+
+
+class RedisBackend:
+    def __init__(self, url):
+        # redis は rate_limit_backend=redis のときだけ必要
+        import redis.asyncio as redis
+
+        self.client = redis.from_url(url)
+        self.script = self.client.register_script(_REDIS_TOKEN_BUCKET)
+
+    async def acquire(self, key, rate, burst):
+        try:
+            return float(await self.script(keys=[f"rate_limit:{key}"], args=[rate, burst]))
+        except Exception as e:
+            # Redis 障害時は制限せずに通す
+            logger.warning(f"rate limit backend error: {str(e)}")
+            return 0.0
+
+
+_backend = None
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        settings = get_settings()
+        if settings.rate_limit_backend == "redis":
+            _backend = RedisBackend(settings.rate_limit_redis_url)
+        else:
+            _backend = MemoryBackend()
+    return _backend
+
+
+def client_ip(request: Request):
+    if get_settings().rate_limit_trust_forwarded_for:
+        forwarded = request.headers.get("x-forwarded-for")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else "unknown"
+
+
+# Bearer トークンが有効なら user_id、無ければクライアントIPでバケットを分ける
+def client_key(request: Request):
+    authorization = request.headers.get("authorization", "")
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() == "bearer" and token:
+        try:
+            payload = jwt.decode(token, get_settings().secret_key, algorithms=["HS256"])
+            if payload.get("user_id") is not None:
+                return f"user:{payload['user_id']}"
+        except JWTError:
+            pass
+    return f"ip:{client_ip(request)}"
+
+
+def _limit_spec(route):
+    return getattr(get_settings(), f"rate_limit_{route.replace('-', '_')}")
+
+
+# 指定したキーのバケットからトークンを1つ取る。足りなければ 429
+async def check_rate_limit(route, key):
+    spec = _limit_spec(route)
+    if not spec:
+        return
+    rate, burst, seconds = parse_limit(spec)
+    if rate <= 0:
+        # "0/60" はルートを止める（バケットには問い合わせずに常に拒否する）
+        retry_after = seconds
+    else:
+        retry_after = await get_backend().acquire(f"{route}:{key}", rate, burst)
+    if retry_after > 0:
+        count_rejected(route, "rate_limited")
+        raise HTTPException(
+            status_code=429,
+            detail="リクエストが多すぎます。しばらくしてから再度お試しください",
+            headers={"Retry-After": str(math.ceil(retry_after))},
+        )
+
+
+# ルートごとのレート制限（依存関係として使う。ハンドラがDB接続を取る前に判定される）
+def rate_limit(route):
+    async def dependency(request: Request):
+        await check_rate_limit(route, client_key(request))
+    return dependency
+
+
+# 処理中のリクエスト数（ワーカーごと。イベントループ上でのみ増減するためロックは不要）
+_in_flight = 0
+
+
+# 同時に処理するリクエスト数の上限。超えた分はルーティング前（DB接続を取る前）に 503 で返す
+class ConcurrencyLimitMiddleware:
+    def __init__(self, app, limit):
+        self.app = app
+        self.limit = limit
+
+    async def __call__(self, scope, receive, send):
+        global _in_flight
+        if scope["type"] != "http" or self.limit <= 0:
+            await self.app(scope, receive, send)
+            return
+
+        if _in_flight >= self.limit:
+            count_rejected("*", "overloaded")
+            response = JSONResponse(
+                status_code=503,
+                content={"detail": "サーバーが混み合っています。しばらくしてから再度お試しください"},
+                headers={"Retry-After": "1"},
+            )
+            await response(scope, receive, send)
+            return
+
+        _in_flight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _in_flight -= 1
+
+
+# 運用者向けのエンドポイント。X-Stats-Token ヘッダーが RATE_LIMIT_STATS_TOKEN と一致しなければ 404
+# （RATE_LIMIT_STATS_TOKEN が空ならルーター自体を登録しない。main.py を参照）
+def require_stats_token(request: Request):
+    token = get_settings().rate_limit_stats_token
+    if not token or not hmac.compare_digest(request.headers.get("x-stats-token", ""), token):
+        raise HTTPException(status_code=404, detail="Not Found")
+
+
+rate_limit_router = APIRouter(dependencies=[Depends(require_stats_token)])
+
+
+# 拒否したリクエスト数の確認用
+# 数はこの応答を返したワーカーのもの（ワーカー間では集計しない）。全体は pid ごとに集めて足し合わせる
+@rate_limit_router.get("/rate-limit/stats")
+def rate_limit_stats():
+    with _rejected_lock:
+        rejected = [
+            {"route": route, "reason": reason, "count": count}
+            for (route, reason), count in sorted(REJECTED.items())
+        ]
+    return {"scope": "worker", "pid": os.getpid(), "in_flight": _in_flight, "rejected": rejected}
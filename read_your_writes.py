@@ -0,0 +1,170 @@
+import logging
+import threading
+import time
+from contextvars import ContextVar
+
+from starlette.datastructures import MutableHeaders
+from starlette.requests import cookie_parser
+
+from settings import get_settings
+
+logger = logging.getLogger(__name__)
+
+# 書き込んだ時点の WAL の位置 (LSN) を覚えておき、レプリカがそこまで再生するまでは読み込みをプライマリに送る
+# プロセスのメモリだけに覚えると、別のワーカーに届いた読み込みには効かないので、次の2つで持ち回る
+# - クライアントごと: 書き込んだリクエストの応答で Cookie に LSN を返し、以降のリクエストで受け取る
+# - ユーザーごと: DB_READ_YOUR_WRITES_BACKEND のストアに記録する（相手の注文を更新した場合など、書き込んだ本人以外の読み込み用）
+#   redis なら全ワーカー・全ホストで共有する。memory はワーカーごと
+
+COOKIE_NAME = "aitaku_wal_lsn"
+
+# 処理中のリクエストの状態（ミドルウェアが設定する。リクエスト外では None）
+_request_writes = ContextVar("request_writes", default=None)
+
+
+class RequestWrites:
+    def __init__(self, required_lsn):
+        self.required_lsn = required_lsn  # Cookie で受け取った LSN
+        self.written_lsn = None  # このリクエストで書き込んだ LSN
+
+
+# ユーザーごとの LSN をプロセス内に持つ（ワーカーごとに独立）
+class MemoryStore:
+    MAX_KEYS = 10000
+
+    def __init__(self):
+        self.lsns = {}  # user_id -> (LSN, 記録した時刻)
+        self.lock = threading.Lock()
+
+    def mark(self, user_ids, lsn, ttl):
+        now = time.monotonic()
+        with self.lock:
+            for user_id in user_ids:
+                previous = self.lsns.get(user_id)
+                if previous is None or previous[0] < lsn:
+                    self.lsns[user_id] = (lsn, now)
+            if len(self.lsns) > self.MAX_KEYS:
+                for key in [k for k, (_, marked_at) in self.lsns.items() if now - marked_at > ttl]:
+                    del self.lsns[key]
+
+    def get(self, user_id, ttl):
+        with self.lock:
+            entry = self.lsns.get(user_id)
+        if entry is None or time.monotonic() - entry[1] > ttl:
+            return None
+        return entry[0]
+
+
+# 記録済みの LSN より大きいときだけ更新する
+_REDIS_MARK = """
+local lsn = tonumber(ARGV[1])
+for _, key in ipairs(KEYS) do
+    local current = tonumber(redis.call('GET', key))
+    if current == nil or current < lsn then
+        redis.call('SET', key, ARGV[1], 'EX', ARGV[2])
+    end
+end
+return 0
+"""
+
+
+# Redis 上のユーザーごとの LSN（全ワーカーで共有）
+class RedisStore:
+    def __init__(self, url):
+        # redis は db_read_your_writes_backend=redis のときだけ必要
+        import redis
+
+        self.client = redis.from_url(url, socket_timeout=0.5)
+        self.script = self.client.register_script(_REDIS_MARK)
+
+    def mark(self, user_ids, lsn, ttl):
+        try:
+            self.script(keys=[f"read_your_writes:{user_id}" for user_id in user_ids], args=[lsn, max(1, int(ttl))])
+        except Exception as e:
+            logger.warning(f"read-your-writes backend error: {str(e)}")
+
+    def get(self, user_id, ttl):
+        try:
+            lsn = self.client.get(f"read_your_writes:{user_id}")
+        except Exception as e:
+            # 記録を確かめられないので、レプリカが追いついていない可能性があるとしてプライマリを読む
+            logger.warning(f"read-your-writes backend error: {str(e)}")
+            return float("inf")
+        return int(lsn) if lsn is not None else None
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                settings = get_settings()
+                if settings.db_read_your_writes_backend == "redis":
+                    _store = RedisStore(settings.db_read_your_writes_redis_url)
+                else:
+                    _store = MemoryStore()
+    return _store
+
+
+# 書き込みを記録する（lsn はコミット後のプライマリの WAL の位置）
+def record_write(lsn, user_ids):
+    ttl = get_settings().db_read_your_writes_seconds
+    if user_ids:
+        get_store().mark(user_ids, lsn, ttl)
+    writes = _request_writes.get()
+    if writes is not None and (writes.written_lsn is None or writes.written_lsn < lsn):
+        writes.written_lsn = lsn
+
+
+# レプリカから読むために、再生が済んでいる必要がある LSN（無ければ None）
+def required_lsn(user_id=None):
+    lsns = []
+    writes = _request_writes.get()
+    if writes is not None:
+        lsns += [writes.required_lsn, writes.written_lsn]
+    if user_id is not None:
+        lsns.append(get_store().get(user_id, get_settings().db_read_your_writes_seconds))
+    lsns = [lsn for lsn in lsns if lsn is not None]
+    return max(lsns) if lsns else None
+
+
+def _cookie_lsn(scope):
+    for name, value in scope["headers"]:
+        if name == b"cookie":
+            lsn = cookie_parser(value.decode("latin-1")).get(COOKIE_NAME)
+            if lsn and lsn.isdigit():
+                return int(lsn)
+    return None
+
+
+# Cookie の LSN をリクエストの状態に読み込み、書き込んだリクエストの応答で Cookie を返すミドルウェア
+class ReadYourWritesMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        writes = RequestWrites(_cookie_lsn(scope))
+        token = _request_writes.set(writes)
+
+        async def send_with_cookie(message):
+            if message["type"] == "http.response.start" and writes.written_lsn is not None:
+                max_age = int(get_settings().db_read_your_writes_seconds)
+                headers = MutableHeaders(scope=message)
+                headers.append(
+                    "set-cookie",
+                    f"{COOKIE_NAME}={writes.written_lsn}; Max-Age={max_age}; Path=/; HttpOnly; SameSite=Lax",
+                )
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_cookie)
+        finally:
+            _request_writes.reset(token)
@@ -1,21 +1,16 @@
-from fastapi import APIRouter, Query, HTTPException
-from fastapi.responses import JSONResponse
-import psycopg2
-import os
+from fastapi import APIRouter, Depends, Query, HTTPException, Request
+from fastapi.responses import JSONResponse, Response
 from datetime import datetime
 from typing import Optional, List
+from db import get_db_connection, release_connection, execute
+from lookups import get_lookups, genre_codes_for, prefecture_codes_for
+from rate_limit import rate_limit
+from query_guard import statement_timeout
+from http_cache import get_catalog_version, make_etag, cache_headers, is_not_modified, not_modified_response, get_response_cache
 
-search_router = APIRouter()
+JSON_MEDIA_TYPE = "application/json; charset=utf-8"
 
-# データベース接続の設定
-def get_db_connection():
-    conn = psycopg2.connect(
-        host=os.getenv("DB_HOST"),
-        database=os.getenv("DB_NAME"),
-        user=os.getenv("DB_USER"),
-        password=os.getenv("DB_PASSWORD")
-    )
-    return conn
+search_router = APIRouter()
 
 # datetimeオブジェクトをシリアライズ可能な形式に変換
 def serialize_event(event):
@@ -30,51 +25,54 @@ def serialize_event(event):
         "event_venue_id": event[7],
         "genre_1": event[8],
         "genre_2": event[9],
-        "check_in_places": event[10]  # 複数のcheck_in_placeを追加
+        "check_in_places": event[10],  # 複数のcheck_in_placeを追加
+        "prefecture_code": event[11],
+        "genre_2_code": event[12]
     }
 
-# イベント一覧を検索するエンドポイント
-@search_router.get("/search-events")
-def search_events(
-    query: Optional[str] = Query(None),
-    genre_2: Optional[List[str]] = Query(None),  # 複数ジャンルの絞り込み
-    prefectures: Optional[List[str]] = Query(None),  # 複数都道府県の絞り込み
-    start_time: Optional[str] = Query(None),  # 公演日の開始
-    end_time: Optional[str] = Query(None)  # 公演日の終了
-):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # 基本的なクエリ構造
-    sql = """
-    SELECT e.event_id, e.event_title, e.artist_name, e.open_time, e.start_time, e.prefectures, e.event_venue, c.check_in_place, e.event_venue_id, e.genre_1, e.genre_2
-    FROM events e
-    LEFT JOIN check_in_place c ON e.event_venue_id = c.event_venue_id
-    WHERE 1=1
-    """
+# /search-events のSQLとパラメータを組み立てる（migrate.py check-plans も同じSQLの実行計画を確認する）
+# genre_codes / prefecture_codes は None なら絞り込まない
+def search_events_sql(query=None, genre_codes=None, prefecture_codes=None, start_time=None, end_time=None):
+    if query:
+        # フリーテキスト検索はイベント本体を直接検索し、check_in_place を配列にまとめる
+        sql = """
+        SELECT e.event_id, e.event_title, e.artist_name, e.open_time, e.start_time, e.prefectures, e.event_venue, e.event_venue_id, e.genre_1, e.genre_2,
+               COALESCE(array_agg(c.check_in_place ORDER BY c.check_in_place_id) FILTER (WHERE c.check_in_place IS NOT NULL), '{}'),
+               e.prefecture_code, e.genre_2_code
+        FROM events e
+        LEFT JOIN check_in_place c ON e.event_venue_id = c.event_venue_id
+        WHERE 1=1
+        """
+        group_by = " GROUP BY e.event_id"
+    else:
+        # 日付・ジャンル・都道府県のみの検索は、事前に集計済みの event_listing を読む
+        sql = """
+        SELECT e.event_id, e.event_title, e.artist_name, e.open_time, e.start_time, e.prefectures, e.event_venue, e.event_venue_id, e.genre_1, e.genre_2, e.check_in_places,
+               e.prefecture_code, e.genre_2_code
+        FROM event_listing e
+        WHERE 1=1
+        """
+        group_by = ""
 
     params = []
-    
+
     # フリーテキスト検索
     if query:
         sql += " AND (e.event_title ILIKE %s OR e.artist_name ILIKE %s)"
         params.extend([f"%{query}%", f"%{query}%"])
-    
+
     # ジャンルと都道府県でOR検索
     filter_clauses = []
-    
+
     # ジャンルでの絞り込み（OR検索）
-    if genre_2:
-        genre_placeholders = ' OR '.join(['e.genre_2 = %s'] * len(genre_2))
-        filter_clauses.append(f"({genre_placeholders})")
-        params.extend(genre_2)
+    if genre_codes is not None:
+        filter_clauses.append("e.genre_2_code = ANY(%s)")
+        params.append(genre_codes)
 
     # 都道府県での絞り込み（OR検索）
-    if prefectures:
-        processed_prefectures = [p[:-1] if p != '北海道' else p for p in prefectures]
-        prefecture_placeholders = ' OR '.join(['e.prefectures = %s'] * len(processed_prefectures))
-        filter_clauses.append(f"({prefecture_placeholders})")
-        params.extend(processed_prefectures)
+    if prefecture_codes is not None:
+        filter_clauses.append("e.prefecture_code = ANY(%s)")
+        params.append(prefecture_codes)
 
     # フィルタをORで結合
     if filter_clauses:
@@ -91,57 +89,112 @@ def search_events(
         sql += " AND e.start_time <= %s"
         params.append(f"{end_time} 23:59:59")
 
-    # クエリ実行
-    cursor.execute(sql, tuple(params))
-    rows = cursor.fetchall()
+    sql += group_by + " ORDER BY e.start_time, e.event_id"
+    return sql, tuple(params)
+
+# イベント一覧を検索するエンドポイント
+@search_router.get("/search-events", dependencies=[Depends(rate_limit("search_events")), Depends(statement_timeout("search_events"))])
+def search_events(
+    request: Request,
+    query: Optional[str] = Query(None),
+    genre_2: Optional[List[str]] = Query(None),  # 複数ジャンルの絞り込み（名称。genre_codes を推奨）
+    prefectures: Optional[List[str]] = Query(None),  # 複数都道府県の絞り込み（名称。prefecture_codes を推奨）
+    genre_codes: Optional[List[int]] = Query(None),  # ジャンルコード（/search-filters を参照）
+    prefecture_codes: Optional[List[int]] = Query(None),  # 都道府県コード（JIS X 0401）
+    start_time: Optional[str] = Query(None),  # 公演日の開始
+    end_time: Optional[str] = Query(None)  # 公演日の終了
+):
+    # 読む元（events か event_listing）の版が変わっていなければ 304 を返す
+    version = get_catalog_version()
+    if query:
+        etag = make_etag("c", version.catalog_version, request)
+        last_modified = version.catalog_updated_at
+    else:
+        etag = make_etag("l", version.listing_version, request)
+        last_modified = version.listing_refreshed_at
+    headers = cache_headers(etag, last_modified)
+    if is_not_modified(request, etag, last_modified):
+        return not_modified_response(headers)
+
+    # 同じ版・同じ条件の結果がキャッシュにあれば、DBを読まずに返す
+    cached = get_response_cache().get(etag)
+    if cached is not None:
+        return Response(content=cached, media_type=JSON_MEDIA_TYPE, headers=headers)
+
+    # 名称で指定されたジャンル・都道府県はコードに変換する
+    genre_codes = list(genre_codes or []) + genre_codes_for(genre_2 or []) if genre_2 or genre_codes else None
+    prefecture_codes = list(prefecture_codes or []) + prefecture_codes_for(prefectures or []) if prefectures or prefecture_codes else None
+    sql, params = search_events_sql(query, genre_codes, prefecture_codes, start_time, end_time)
+
+    # クエリ実行（条件によってSQLが変わるため、プリペアドステートメントにはしない）
+    conn = get_db_connection("read")
+    cursor = conn.cursor()
+    try:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+    finally:
+        cursor.close()
+        release_connection(conn)
 
     # 各イベントを整形して、datetime を文字列形式に変換
     events = [serialize_event(row) for row in rows]
 
-    cursor.close()
-    conn.close()
-
     # 整形されたデータをJSONとして返す
-    return JSONResponse(content={"events": events}, media_type="application/json; charset=utf-8")
+    response = JSONResponse(content={"events": events}, media_type=JSON_MEDIA_TYPE, headers=headers)
+    get_response_cache().put(etag, response.body)
+    return response
 
 # 特定のイベントを取得するエンドポイント
 @search_router.get("/events/{event_id}")
-def get_event(event_id: int):
-    conn = get_db_connection()
+def get_event(request: Request, event_id: int):
+    version = get_catalog_version()
+    etag = make_etag("c", version.catalog_version, request)
+    headers = cache_headers(etag, version.catalog_updated_at)
+    if is_not_modified(request, etag, version.catalog_updated_at):
+        return not_modified_response(headers)
+
+    cached = get_response_cache().get(etag)
+    if cached is not None:
+        return Response(content=cached, media_type=JSON_MEDIA_TYPE, headers=headers)
+
+    conn = get_db_connection("read")
     cursor = conn.cursor()
 
-    # イベント取得クエリ
-    sql_event = """
-    SELECT e.event_id, e.event_title, e.artist_name, e.open_time, e.start_time, e.prefectures, e.event_venue, e.event_venue_id, e.genre_1, e.genre_2
-    FROM events e
-    WHERE e.event_id = %s
-    """
-    
-    cursor.execute(sql_event, (event_id,))
-    event = cursor.fetchone()
-
-    if not event:
+    try:
+        # イベント取得クエリ
+        execute(cursor, "get_event", (event_id,))
+        event = cursor.fetchone()
+
+        if not event:
+            raise HTTPException(status_code=404, detail="Event not found")
+
+        # 複数のcheck_in_placeを取得するクエリ
+        execute(cursor, "get_check_in_places", (event[7],))  # event_venue_idを使ってクエリ
+        check_in_places = cursor.fetchall()
+    finally:
         cursor.close()
-        conn.close()
-        raise HTTPException(status_code=404, detail="Event not found")
-    
-    # 複数のcheck_in_placeを取得するクエリ
-    sql_check_in_places = """
-    SELECT check_in_place
-    FROM check_in_place
-    WHERE event_venue_id = %s
-    """
-    
-    cursor.execute(sql_check_in_places, (event[7],))  # event_venue_idを使ってクエリ
-    check_in_places = cursor.fetchall()
+        release_connection(conn)
 
     # check_in_placeをリストとして格納
     check_in_place_list = [place[0] for place in check_in_places]
 
     # イベントデータにcheck_in_placeを追加して整形
-    event_data = list(event) + [check_in_place_list]
-
-    cursor.close()
-    conn.close()
-
-    return JSONResponse(content=serialize_event(event_data), media_type="application/json; charset=utf-8")
+    event_data = list(event[:10]) + [check_in_place_list] + list(event[10:])
+
+    response = JSONResponse(content=serialize_event(event_data), media_type=JSON_MEDIA_TYPE, headers=headers)
+    get_response_cache().put(etag, response.body)
+    return response
+
+# 検索条件に使う都道府県・ジャンルのコード一覧
+@search_router.get("/search-filters")
+def search_filters():
+    lookups = get_lookups()
+    return JSONResponse(
+        content={
+            "prefectures": [
+                {"prefecture_code": code, "name": full_name} for code, _, full_name in lookups.prefectures
+            ],
+            "genres": [{"genre_code": code, "name": name} for code, name in lookups.genres],
+        },
+        media_type=JSON_MEDIA_TYPE,
+    )
@@ -1,25 +1,16 @@
 from fastapi import APIRouter, HTTPException, Depends
-from pydantic import BaseModel
-import psycopg2
-import os
+from pydantic import BaseModel, Field
 import logging
+import geo
+from db import get_db_connection, release_connection, execute
+from gazetteer import resolve
+from matching_index import get_matching_index
+from rate_limit import rate_limit
+from query_guard import statement_timeout
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# データベース接続関数
-def get_db_connection():
-    try:
-        conn = psycopg2.connect(
-            host=os.getenv("DB_HOST"),
-            database=os.getenv("DB_NAME"),
-            user=os.getenv("DB_USER"),
-            password=os.getenv("DB_PASSWORD")
-        )
-        return conn
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"DB接続エラー: {str(e)}")
-
 # 検索条件を表すPydanticモデル
 class OrderSearchCriteria(BaseModel):
     origin: str
@@ -32,46 +23,58 @@ class OrderSearchCriteria(BaseModel):
     id_verification_status: str
     journey_type: str
     user_id: int
+    match_mode: str = Field(default="exact", pattern="^(exact|proximity)$")  # proximity: 乗車地・目的地とも radius_m 以内
+    radius_m: int = Field(default=500, ge=50, le=5000)
 
 # エンドポイント用のルーター
 search_candidates_router = APIRouter()
 
 # 一致する注文を検索するエンドポイント
-@search_candidates_router.post("/search-orders")
+@search_candidates_router.post("/search-orders", dependencies=[Depends(rate_limit("search_orders")), Depends(statement_timeout("search_orders"))])
 def search_orders(criteria: OrderSearchCriteria):
-    conn = get_db_connection()
+    conditions = (
+        criteria.check_in_time,
+        criteria.co_passenger,
+        criteria.min_participants,
+        criteria.back_seat_passengers,
+        criteria.wants_female,
+        criteria.id_verification_status,
+        criteria.journey_type,
+        criteria.user_id
+    )
+
+    query = "search_candidate_orders"
+    values = (criteria.origin, criteria.destination) + conditions
+    if criteria.match_mode == "exact":
+        # プロセス内の索引が最新なら、DBを読まずに答える
+        index = get_matching_index()
+        results = index.search(*values) if index is not None else None
+        if results is not None:
+            return results
+    else:
+        # 地名を座標に変換できれば近い注文を探す（できなければ名称の完全一致で探す）
+        origin_lat, origin_lng, _ = resolve(criteria.origin)
+        destination_lat, destination_lng, _ = resolve(criteria.destination)
+        if origin_lat is not None and destination_lat is not None:
+            destination_cells = geo.cover(destination_lat, destination_lng, criteria.radius_m)
+            query = "search_nearby_orders"
+            values = (
+                geo.cover(origin_lat, origin_lng, criteria.radius_m),
+                len(destination_cells[0]),
+                destination_cells,
+                origin_lat, origin_lng,
+                destination_lat, destination_lng,
+                criteria.radius_m
+            ) + conditions
+        else:
+            logger.info(f"proximity search fell back to exact match: {criteria.origin} / {criteria.destination}")
+
+    conn = get_db_connection("read", user_id=criteria.user_id)
     cursor = conn.cursor()
 
     try:
-        query = """
-            SELECT * FROM orders
-            WHERE origin = %s
-            AND destination = %s
-            AND check_in_time = %s
-            AND co_passenger = %s
-            AND min_participants = %s
-            AND back_seat_passengers = %s
-            AND wants_female = %s
-            AND id_verification_status = %s
-            AND journey_type = %s
-            AND status IN ('waiting', 'matched')
-            AND user_id != %s ;
-        """
-        values = (
-            criteria.origin,
-            criteria.destination,
-            criteria.check_in_time,
-            criteria.co_passenger,
-            criteria.min_participants,
-            criteria.back_seat_passengers,
-            criteria.wants_female,
-            criteria.id_verification_status,
-            criteria.journey_type,
-            criteria.user_id
-        )
-
         # クエリの実行
-        cursor.execute(query, values)
+        execute(cursor, query, values)
         results = cursor.fetchall()  # リストとして結果を取得
 
         # 結果がない場合
@@ -85,4 +88,4 @@ def search_orders(criteria: OrderSearchCriteria):
         raise HTTPException(status_code=500, detail=f"注文検索エラー: {str(e)}")
     finally:
         cursor.close()
-        conn.close()
+        release_connection(conn)
@@ -1,45 +1,59 @@
 from fastapi import APIRouter, HTTPException
-import psycopg2
-import os
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-import smtplib
 import logging
+from db import get_db_connection, release_connection, execute
+from settings import get_settings
 
 # ロガーの設定
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# データベース接続関数
-def get_db_connection():
-    conn = psycopg2.connect(
-        host=os.getenv("DB_HOST"),
-        database=os.getenv("DB_NAME"),
-        user=os.getenv("DB_USER"),
-        password=os.getenv("DB_PASSWORD")
-    )
-    return conn
+# 送信するメッセージを作る
+def build_message(to_email, subject, body):
+    from email.mime.text import MIMEText
+    from email.mime.multipart import MIMEMultipart
+
+    msg = MIMEMultipart()
+    msg['From'] = get_settings().gmail_username
+    msg['To'] = to_email
+    msg['Subject'] = subject
+    msg.attach(MIMEText(body, 'plain'))
+    return msg
+
+
+# SMTP サーバーに接続してログインする
+def smtp_connect():
+    # smtplib / email は起動時には不要なため、送信時に読み込む
+    import smtplib
+
+    settings = get_settings()
+    server = smtplib.SMTP(settings.smtp_server, settings.smtp_port)
+    try:
+        server.starttls()
+        server.login(settings.gmail_username, settings.gmail_password)
+    except Exception:
+        server.close()
+        raise
+    return server
+
+
+def smtp_quit(server):
+    try:
+        server.quit()
+    except Exception:
+        server.close()
+
 
 # メール送信関数
 def send_email(to_email, subject, body):
-
-    SMTP_SERVER = os.getenv('SMTP_SERVER')
-    SMTP_PORT = int(os.getenv('SMTP_PORT'))
-    GMAIL_USERNAME = os.getenv('GMAIL_USERNAME')
-    GMAIL_PASSWORD = os.getenv('GMAIL_PASSWORD')
+    settings = get_settings()
+    GMAIL_USERNAME = settings.gmail_username
 
     try:
-        msg = MIMEMultipart()
-        msg['From'] = GMAIL_USERNAME
-        msg['To'] = to_email
-        msg['Subject'] = subject
-        msg.attach(MIMEText(body, 'plain'))
+        msg = build_message(to_email, subject, body)
 
-        server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT)
-        server.starttls()
-        server.login(GMAIL_USERNAME, GMAIL_PASSWORD)
+        server = smtp_connect()
         server.sendmail(GMAIL_USERNAME, to_email, msg.as_string())
-        server.quit()
+        smtp_quit(server)
 
         logger.info(f"Email sent to {to_email}")  # メール送信成功のログ出力
 
@@ -47,6 +61,45 @@ def send_email(to_email, subject, body):
         logger.error(f"Failed to send email: {str(e)}")  # エラーログ出力
         raise HTTPException(status_code=500, detail=f"Failed to send email: {str(e)}")
 
+
+# 複数のメールを1つの SMTP セッションで送る（一括の通知用）
+# messages は (宛先, 件名, 本文) のリスト。送れなかった宛先のリストを返す
+def send_emails(messages):
+    import smtplib
+
+    GMAIL_USERNAME = get_settings().gmail_username
+    failed = []
+    server = None
+    try:
+        for to_email, subject, body in messages:
+            msg = build_message(to_email, subject, body)
+            try:
+                if server is None:
+                    server = smtp_connect()
+                try:
+                    server.sendmail(GMAIL_USERNAME, to_email, msg.as_string())
+                except smtplib.SMTPServerDisconnected:
+                    # 途中で切断されたら1回だけ接続し直す
+                    server = None
+                    server = smtp_connect()
+                    server.sendmail(GMAIL_USERNAME, to_email, msg.as_string())
+                logger.info(f"Email sent to {to_email}")
+            except smtplib.SMTPRecipientsRefused as e:
+                # 宛先だけの問題なのでセッションはそのまま使う
+                logger.error(f"Failed to send email to {to_email}: {str(e)}")
+                failed.append(to_email)
+            except Exception as e:
+                # 1件の送信失敗で残りを止めない。セッションは次の送信で作り直す
+                logger.error(f"Failed to send email to {to_email}: {str(e)}")
+                failed.append(to_email)
+                if server is not None:
+                    server.close()
+                    server = None
+    finally:
+        if server is not None:
+            smtp_quit(server)
+    return failed
+
 # ルーター作成
 send_email_router = APIRouter()
 
@@ -59,14 +112,8 @@ def send_confirmation_email(order_id: int):
 
     try:
         # order_idを使ってuser_idとaitaku_user_idのメールアドレスを取得
-        query = """
-            SELECT u.email AS user_email, a.email AS aitaku_email
-            FROM orders
-            JOIN users AS u ON orders.user_id = u.user_id
-            JOIN users AS a ON orders.aitaku_user_id = a.user_id
-            WHERE orders.order_id = %s;
-        """
-        cursor.execute(query, (order_id,))
+        query = "get_order_emails"
+        execute(cursor, query, (order_id,))
         result = cursor.fetchone()
 
         if result is None:
@@ -98,4 +145,4 @@ def send_confirmation_email(order_id: int):
 
     finally:
         cursor.close()
-        conn.close()
+        release_connection(conn)
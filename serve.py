@@ -0,0 +1,111 @@
+import argparse
+import logging
+import math
+import os
+import sys
+
+from gunicorn.app.base import BaseApplication
+from uvicorn.workers import UvicornWorker
+
+from settings import get_settings
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+# uvloop / httptools を明示する uvicorn ワーカー（入っていなければ起動時にエラーにする）
+class Worker(UvicornWorker):
+    CONFIG_KWARGS = {"loop": "uvloop", "http": "httptools"}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # SIGTERM を受けたら新しい接続を受け付けずに処理中のリクエストを待ち、lifespan の終了処理（プールを閉じる）を行う
+        # gunicorn が graceful_timeout で強制終了する前に終了処理を始められるよう、少し短く区切る
+        self.config.timeout_graceful_shutdown = max(1, self.cfg.graceful_timeout - 5)
+
+
+# このプロセスが使えるCPU数（affinity と cgroup v2 の cpu.max を考慮する）
+def available_cpus():
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            cpus = min(cpus, max(1, math.ceil(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
+
+# ワーカー数: WEB_WORKERS が 0 ならCPU数（非同期ワーカーはCPU1つにつき1つ）
+# ワーカーごとにコネクションプールを持つため、WEB_MAX_DB_CONNECTIONS を超えない数に抑える
+def worker_count():
+    settings = get_settings()
+    workers = settings.web_workers or available_cpus()
+    if settings.web_max_db_connections:
+        # プールの上限 + LISTEN 用の接続（プロセス内索引を使う場合）
+        per_worker = settings.db_pool_max + (1 if settings.matching_index_enabled else 0)
+        workers = min(workers, max(1, settings.web_max_db_connections // per_worker))
+    return workers
+
+
+def gunicorn_options(workers=None, bind=None):
+    settings = get_settings()
+    return {
+        "bind": bind or settings.web_bind,
+        "workers": workers or worker_count(),
+        "worker_class": "serve.Worker",
+        # マスターで一度だけアプリを読み込み、fork したワーカーで共有する
+        # （DB接続やスレッドは lifespan でワーカーごとに作るので、fork 前には作られない）
+        "preload_app": True,
+        "graceful_timeout": settings.web_graceful_timeout,
+        "timeout": settings.web_timeout,
+        "keepalive": settings.web_keepalive,
+        # メモリの断片化やリークに備えてワーカーを入れ替える（全ワーカーが同時に入れ替わらないよう揺らす）
+        "max_requests": settings.web_max_requests,
+        "max_requests_jitter": settings.web_max_requests_jitter,
+        "forwarded_allow_ips": settings.web_forwarded_allow_ips,
+        "accesslog": "-" if settings.web_access_log else None,
+        "errorlog": "-",
+    }
+
+
+class Application(BaseApplication):
+    def __init__(self, options):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            if value is not None:
+                self.cfg.set(key, value)
+
+    def load(self):
+        from main import create_app
+
+        return create_app()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="本番用のサーバー (gunicorn + uvicorn ワーカー)")
+    parser.add_argument("--workers", type=int, help="ワーカー数（省略時は WEB_WORKERS、0ならCPU数から決める）")
+    parser.add_argument("--bind", help="待ち受けるアドレス（省略時は WEB_BIND）")
+    parser.add_argument("--print-config", action="store_true", help="設定を表示して終了する")
+    args = parser.parse_args(argv)
+
+    options = gunicorn_options(args.workers, args.bind)
+    if args.print_config:
+        for key, value in options.items():
+            print(f"{key} = {value}")
+        return 0
+
+    logger.info(f"starting {options['workers']} workers on {options['bind']} ({available_cpus()} CPUs available)")
+    Application(options).run()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
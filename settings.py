@@ -0,0 +1,117 @@
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+
+# 環境変数（と .env）から読み込む設定。プロセス起動時に一度だけ読み込む
+class Settings(BaseSettings):
+    model_config = SettingsConfigDict(env_file=".env", env_file_encoding="utf-8", extra="ignore")
+
+    # サーバー（serve.py）
+    web_bind: str = "0.0.0.0:8000"
+    web_workers: int = 0  # 0 でCPU数から決める
+    web_max_db_connections: int = 0  # 全ワーカーのDB接続数の上限（ワーカー数を抑える。0 で無制限）
+    web_graceful_timeout: int = 30  # SIGTERM から強制終了までの秒数
+    web_timeout: int = 60  # 応答しないワーカーを再起動するまでの秒数
+    web_keepalive: int = 5
+    web_max_requests: int = 10000  # この数のリクエストを処理したワーカーを入れ替える（0 で無効）
+    web_max_requests_jitter: int = 1000
+    web_forwarded_allow_ips: str = "127.0.0.1"
+    web_access_log: bool = False
+
+    # JWT
+    secret_key: str = ""
+    access_token_expire_minutes: int = 30
+
+    # プライマリDB
+    db_host: Optional[str] = None
+    db_port: Optional[int] = None
+    db_name: Optional[str] = None
+    db_user: Optional[str] = None
+    db_password: Optional[str] = None
+
+    # 実行計画の確認（migrate.py check-plans / tests/test_query_plans.py）に使う使い捨てのDB
+    # DB名（接続先はプライマリDBの設定）か接続文字列。空なら実行しない（アプリのDBには投入しない）
+    plan_check_database: str = ""
+
+    # コネクションプール
+    db_pool_min: int = 1
+    db_pool_max: int = 10
+    db_pool_timeout: float = 5.0
+    db_plan_cache_mode: str = "auto"
+
+    # リードレプリカ ("host1:5432,host2:5433")
+    db_replica_hosts: str = ""
+    db_replica_max_lag: float = 5.0
+    db_replica_check_interval: float = 1.0  # バックグラウンドのスレッドでチェックする間隔（秒）
+    db_read_your_writes_seconds: float = 30.0
+    db_read_your_writes_backend: str = "memory"  # memory: ワーカーごと / redis: 全ワーカーで共有
+    db_read_your_writes_redis_url: str = "redis://localhost:6379/0"
+
+    # レート制限 ("回数/秒数"。空文字で無効)
+    rate_limit_backend: str = "memory"  # memory: ワーカーごと / redis: 全ワーカーで共有
+    rate_limit_redis_url: str = "redis://localhost:6379/0"
+    rate_limit_trust_forwarded_for: bool = False  # ロードバランサの X-Forwarded-For を信用する
+    rate_limit_token: str = "10/60"  # /token (IPごと)
+    rate_limit_token_user: str = "5/60"  # /token (ログインしようとしているメールアドレスごと)
+    rate_limit_search_orders: str = "60/60"
+    rate_limit_search_events: str = "120/60"
+    max_concurrent_requests: int = 200  # 0 で無効
+    rate_limit_stats_token: str = ""  # /rate-limit/stats に必要な X-Stats-Token（空なら公開しない）
+
+    # リクエスト中のクエリの statement_timeout（ミリ秒。0 で無制限）。超えたら 503 (Retry-After)
+    statement_timeout_default: int = 5000
+    statement_timeout_search_events: int = 2000
+    statement_timeout_search_orders: int = 1000
+
+    # イベント系エンドポイントの HTTP キャッシュ
+    event_cache_max_age: int = 60  # Cache-Control: max-age（秒）
+    catalog_version_ttl: float = 1.0  # カタログの版をプロセス内で使い回す秒数
+
+    # レスポンス圧縮
+    compression_min_size: int = 1024  # これより小さい本文は圧縮しない（バイト）
+    gzip_level: int = 6
+    brotli_quality: int = 5
+    zstd_level: int = 3
+    response_cache_bytes: int = 64 * 1024 * 1024  # イベント系レスポンス（本文 + 圧縮済み）のキャッシュ上限
+
+    # orders のパーティション（partitions.py）
+    orders_partition_months_ahead: int = 3  # 先に作っておく月数
+    orders_retention_months: int = 6  # これより古い月のパーティションを orders_archive に移す
+    orders_hot_days: int = 7  # 依頼中の注文を探すときに見る check_in_time の範囲（日）
+
+    # search-orders のプロセス内索引（matching_index.py）
+    matching_index_enabled: bool = False
+    matching_index_max_staleness: float = 5.0  # 通知の受信がこの秒数途絶えたらDBで検索する
+
+    # 期限切れの注文の整理（expiry.py）
+    expiry_enabled: bool = False  # アプリ内で定期実行する（別プロセスなら python expiry.py）
+    expiry_interval: float = 60.0  # 実行間隔（秒）
+    expiry_batch_size: int = 500  # 1回の UPDATE で更新する件数
+    expiry_waiting_grace_minutes: int = 30  # 集合時刻からこの分数を過ぎた waiting / requested / approved_waiting を expired にする
+    expiry_request_timeout_minutes: int = 60  # requested / approved_waiting がこの分数確定されなければ waiting に戻す
+    expiry_notify: bool = True  # 対象のユーザーにメールで知らせる
+    expiry_notify_max_age_hours: int = 24  # 集合時刻がこれより前の注文は知らせずに整理する
+
+    # メール送信
+    smtp_server: Optional[str] = None
+    smtp_port: int = 587
+    gmail_username: Optional[str] = None
+    gmail_password: Optional[str] = None
+
+    # DB_REPLICA_HOSTS を (host, port) のリストに分解する
+    def replica_hosts(self) -> List[Tuple[str, Optional[int]]]:
+        hosts = []
+        for entry in self.db_replica_hosts.split(","):
+            entry = entry.strip()
+            if not entry:
+                continue
+            host, sep, port = entry.rpartition(":")
+            hosts.append((host, int(port)) if sep else (entry, None))
+        return hosts
+
+
+@lru_cache
+def get_settings() -> Settings:
+    return Settings()
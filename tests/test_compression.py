@@ -0,0 +1,33 @@
+import pytest
+
+from compression import choose_encoding, supported_encodings
+from http_cache import not_modified_response
+
+
+def test_prefers_server_order_on_equal_q():
+    assert choose_encoding("gzip, deflate, br, zstd") == supported_encodings()[0]
+
+
+def test_q_after_other_parameters():
+    assert choose_encoding("gzip;foo=bar;q=0.5") == "gzip"
+    assert choose_encoding("gzip;foo=bar;Q=0") is None
+
+
+def test_highest_q_wins():
+    assert choose_encoding("gzip;q=1.0, br;q=0.5, zstd;q=0.1") == "gzip"
+
+
+@pytest.mark.parametrize("header", ["", "identity", "gzip;q=0", "gzip;q=abc", "*;q=0"])
+def test_no_acceptable_encoding(header):
+    assert choose_encoding(header) is None
+
+
+def test_wildcard():
+    assert choose_encoding("*") == supported_encodings()[0]
+
+
+def test_not_modified_varies_on_accept_encoding():
+    response = not_modified_response({"ETag": '"v1"', "Vary": "Accept-Encoding"})
+    assert response.status_code == 304
+    assert response.headers.getlist("vary") == ["Accept-Encoding"]
+    assert "accept-encoding" in not_modified_response({"ETag": '"v1"'}).headers["vary"].lower()
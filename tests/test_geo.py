@@ -0,0 +1,89 @@
+import math
+import random
+
+import pytest
+
+import geo
+
+
+def test_encode_known_values():
+    assert geo.encode(57.64911, 10.40744, 11) == "u4pruydqqvj"
+    assert geo.encode(42.6, -5.6, 5) == "ezs42"
+    assert geo.encode(35.681236, 139.767125, 6) == "xn76ur"
+
+
+def test_encode_uses_stored_precision_and_prefixes():
+    full = geo.encode(35.658034, 139.701636)
+    assert len(full) == geo.STORED_PRECISION
+    for precision in range(1, geo.STORED_PRECISION):
+        assert geo.encode(35.658034, 139.701636, precision) == full[:precision]
+
+
+def test_cell_boundaries():
+    # 緯度 0 / 経度 0 の境界は北側・東側のセルに入る
+    assert geo.encode(0.0, 0.0, 1) == "s"
+    assert geo.encode(-1e-9, 0.0, 1) == "k"
+    assert geo.encode(0.0, -1e-9, 1) == "e"
+    assert geo.encode(-1e-9, -1e-9, 1) == "7"
+    assert geo.encode(-90.0, -180.0, 3) == "000"
+    assert geo.encode(90.0, 180.0, 3) == "zzz"
+
+
+@pytest.mark.parametrize("precision", [1, 4, 7, 9])
+def test_decode_returns_cell_center(precision):
+    rng = random.Random(precision)
+    lat_size, lng_size = geo.cell_size(precision)
+    for _ in range(200):
+        lat, lng = rng.uniform(-89, 89), rng.uniform(-179, 179)
+        center_lat, center_lng = geo.decode(geo.encode(lat, lng, precision))
+        assert abs(center_lat - lat) <= lat_size / 2
+        assert abs(center_lng - lng) <= lng_size / 2
+
+
+def test_neighbours():
+    cells = geo.neighbours("xn76ur")
+    assert len(cells) == 9 and len(set(cells)) == 9
+    assert "xn76ur" in cells
+    assert all(len(cell) == 6 for cell in cells)
+    # 日付変更線をまたいで隣接する
+    east = geo.encode(0.0, 179.99, 3)
+    assert geo.encode(0.0, -179.99, 3) in geo.neighbours(east)
+    # 極では北（南）側の隣接セルが無い
+    assert len(geo.neighbours(geo.encode(89.99, 0.0, 2))) == 6
+
+
+def test_haversine():
+    assert geo.haversine(35.0, 139.0, 35.0, 139.0) == 0
+    assert geo.haversine(0.0, 0.0, 1.0, 0.0) == pytest.approx(geo.METERS_PER_DEGREE)
+    assert geo.haversine(0.0, 0.0, 0.0, 180.0) == pytest.approx(math.pi * geo.EARTH_RADIUS_M)
+    # 東京駅 - 渋谷駅（およそ 6.5km）
+    distance = geo.haversine(35.681236, 139.767125, 35.658034, 139.701636)
+    assert 6300 < distance < 6600
+    assert geo.haversine(35.658034, 139.701636, 35.681236, 139.767125) == pytest.approx(distance)
+
+
+@pytest.mark.parametrize("radius", [100, 500, 2000])
+@pytest.mark.parametrize("lat, lng", [(35.658034, 139.701636), (43.068661, 141.350755), (26.2124, 127.6809), (0.0001, -0.0001)])
+def test_cover_contains_every_point_in_radius(lat, lng, radius):
+    cells = geo.cover(lat, lng, radius)
+    precision = len(cells[0])
+    rng = random.Random(radius)
+    for _ in range(500):
+        # 円周上（最も外れやすい位置）と円の内側
+        angle = rng.uniform(0, 2 * math.pi)
+        distance = radius * (1.0 if rng.random() < 0.5 else rng.random()) * 0.999
+        point_lat = lat + distance * math.cos(angle) / geo.METERS_PER_DEGREE
+        point_lng = lng + distance * math.sin(angle) / (geo.METERS_PER_DEGREE * math.cos(math.radians(lat)))
+        assert geo.haversine(lat, lng, point_lat, point_lng) <= radius
+        assert geo.encode(point_lat, point_lng)[:precision] in cells
+
+
+def test_precision_for_radius_is_finest_fitting_cell():
+    for radius in [50, 500, 5000]:
+        precision = geo.precision_for_radius(35.0, radius)
+        lat_size, lng_size = geo.cell_size(precision)
+        assert lat_size * geo.METERS_PER_DEGREE >= radius
+        assert lng_size * geo.METERS_PER_DEGREE * math.cos(math.radians(35.0)) >= radius
+        if precision < geo.STORED_PRECISION:
+            finer_lat, finer_lng = geo.cell_size(precision + 1)
+            assert min(finer_lat * geo.METERS_PER_DEGREE, finer_lng * geo.METERS_PER_DEGREE * math.cos(math.radians(35.0))) < radius
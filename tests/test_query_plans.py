@@ -0,0 +1,21 @@
+import pytest
+
+import migrate
+from settings import get_settings
+
+# PLAN_CHECK_DATABASE（使い捨てのDB）を指定したときだけ実行する。DB_NAME（.env のアプリのDB）には投入しない
+# マイグレーションを適用し、データはトランザクション内に投入して最後にロールバックする
+pytestmark = pytest.mark.skipif(not get_settings().plan_check_database, reason="PLAN_CHECK_DATABASE is not set")
+
+
+@pytest.fixture
+def conn():
+    conn = migrate.get_plan_check_connection()
+    migrate.upgrade(conn)
+    yield conn
+    conn.close()
+
+
+def test_route_queries_use_indexes(conn):
+    failures = migrate.check_plans(conn)
+    assert failures == [], "\n".join(f"{route}: seq scan on {table}" for route, table in failures)
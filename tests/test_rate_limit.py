@@ -0,0 +1,93 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+import rate_limit
+from rate_limit import MemoryBackend, check_rate_limit, parse_limit
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rate_limit.time, "monotonic", clock)
+    return clock
+
+
+def acquire(backend, key, rate, burst):
+    return asyncio.run(backend.acquire(key, rate, burst))
+
+
+def test_parse_limit():
+    assert parse_limit("10/60") == (10 / 60, 10, 60)
+    assert parse_limit("5") == (5, 5, 1)
+    assert parse_limit("0/60") == (0, 0, 60)
+
+
+def test_bucket_allows_burst_then_refills(clock):
+    backend = MemoryBackend()
+    rate, burst, _ = parse_limit("3/60")
+    for _ in range(3):
+        assert acquire(backend, "k", rate, burst) == 0
+    assert acquire(backend, "k", rate, burst) == pytest.approx(20)
+
+    # 1トークン分（20秒）で1回だけ通る
+    clock.now += 20
+    assert acquire(backend, "k", rate, burst) == 0
+    assert acquire(backend, "k", rate, burst) > 0
+
+    # 長く待っても容量を超えては貯まらない
+    clock.now += 3600
+    for _ in range(3):
+        assert acquire(backend, "k", rate, burst) == 0
+    assert acquire(backend, "k", rate, burst) > 0
+
+
+def test_buckets_are_per_key(clock):
+    backend = MemoryBackend()
+    assert acquire(backend, "a", 1, 1) == 0
+    assert acquire(backend, "a", 1, 1) > 0
+    assert acquire(backend, "b", 1, 1) == 0
+
+
+def test_prune_drops_only_refilled_buckets(clock):
+    backend = MemoryBackend()
+    acquire(backend, "refilled", 1, 1)
+    acquire(backend, "empty", 0.01, 1)
+    clock.now += backend.PRUNE_INTERVAL
+    acquire(backend, "new", 1, 1)
+    assert list(backend.buckets) == ["empty", "new"]
+    # 消さずに残したバケットは空のまま
+    assert acquire(backend, "empty", 0.01, 1) > 0
+
+
+def test_least_recently_used_bucket_is_evicted(clock, monkeypatch):
+    monkeypatch.setattr(MemoryBackend, "MAX_KEYS", 2)
+    backend = MemoryBackend()
+    for key in ["a", "b", "c"]:
+        acquire(backend, key, 0.01, 1)
+    assert list(backend.buckets) == ["b", "c"]
+    acquire(backend, "b", 0.01, 1)
+    acquire(backend, "d", 0.01, 1)
+    assert list(backend.buckets) == ["b", "d"]
+
+
+def test_zero_limit_blocks_route(monkeypatch):
+    monkeypatch.setattr(rate_limit, "_limit_spec", lambda route: "0/60")
+    with pytest.raises(HTTPException) as exc_info:
+        asyncio.run(check_rate_limit("token", "ip:127.0.0.1"))
+    assert exc_info.value.status_code == 429
+    assert exc_info.value.headers["Retry-After"] == "60"
+
+
+def test_empty_limit_is_disabled(monkeypatch):
+    monkeypatch.setattr(rate_limit, "_limit_spec", lambda route: "")
+    asyncio.run(check_rate_limit("token", "ip:127.0.0.1"))
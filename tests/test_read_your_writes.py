@@ -0,0 +1,158 @@
+import time
+
+import psycopg2
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import db
+import read_your_writes
+from read_your_writes import ReadYourWritesMiddleware
+from settings import get_settings
+
+# プライマリ (DB_HOST) とストリーミングレプリケーションのレプリカ (DB_REPLICA_HOSTS) の2台で実行する
+# 手順は README の「read-your-writes の確認」を参照。レプリカが無ければスキップする
+pytestmark = pytest.mark.skipif(
+    not get_settings().db_name or len(get_settings().replica_hosts()) != 1,
+    reason="a primary and one streaming replica are not configured",
+)
+
+USER_ID = 2000000001
+PARTNER_ID = 2000000002
+OTHER_USER_ID = 2000000003
+
+
+def replica_connection():
+    settings = get_settings()
+    host, port = settings.replica_hosts()[0]
+    conn = psycopg2.connect(host=host, port=port, database=settings.db_name, user=settings.db_user, password=settings.db_password)
+    conn.autocommit = True
+    return conn
+
+
+# 読み込みに使った接続がレプリカ（リカバリ中）か
+def reads_from_replica(user_id=None):
+    conn = db.get_db_connection("read", user_id=user_id)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT pg_is_in_recovery()")
+        in_recovery = cursor.fetchone()[0]
+        conn.commit()
+        cursor.close()
+        return in_recovery
+    finally:
+        db.release_connection(conn)
+
+
+def refresh_replica():
+    db.get_replicas()[0].check()
+
+
+# WAL にレコードを書き込み、コミットした後の mark_user_write まで行う
+def write(*user_ids):
+    conn = db.get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT pg_logical_emit_message(true, 'aitaku-read-your-writes-test', 'x')")
+        conn.commit()
+        cursor.close()
+        db.mark_user_write(conn, *user_ids)
+    finally:
+        db.release_connection(conn)
+
+
+def wait_for_replay():
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        refresh_replica()
+        if not db.get_replicas()[0].replay_lsn < read_your_writes.required_lsn(USER_ID):
+            return
+        time.sleep(0.1)
+    pytest.fail("replica did not catch up")
+
+
+# 先に実行したテストの書き込みをレプリカが再生し終えるまで待つ
+# 遅延は最後に再生したコミットの時刻から測るので、コミットを1つ書いて（DBが暇だった後でも）遅延を小さくしておく
+def wait_for_replica_to_catch_up(cursor):
+    conn = db.get_db_connection()
+    try:
+        primary = conn.cursor()
+        primary.execute("SELECT pg_logical_emit_message(true, 'aitaku-read-your-writes-test', 'x')")
+        conn.commit()
+        primary.execute("SELECT pg_current_wal_lsn()")
+        lsn = primary.fetchone()[0]
+        conn.commit()
+        primary.close()
+    finally:
+        db.release_connection(conn)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        cursor.execute("SELECT pg_last_wal_replay_lsn() >= %s::pg_lsn", (lsn,))
+        if cursor.fetchone()[0]:
+            return
+        time.sleep(0.1)
+    pytest.fail("replica did not catch up")
+
+
+@pytest.fixture
+def paused_replica():
+    conn = replica_connection()
+    cursor = conn.cursor()
+    wait_for_replica_to_catch_up(cursor)
+    cursor.execute("SELECT pg_wal_replay_pause()")
+    # 別のワーカーを再現するため、プロセス内の記録を空にする
+    read_your_writes._store = None
+    try:
+        yield cursor
+    finally:
+        cursor.execute("SELECT pg_wal_replay_resume()")
+        conn.close()
+        db.close_pool()
+
+
+def test_writer_and_partner_read_from_primary_until_replayed(paused_replica):
+    refresh_replica()
+    assert reads_from_replica(OTHER_USER_ID)
+
+    write(USER_ID, PARTNER_ID)
+    refresh_replica()
+    assert not reads_from_replica(USER_ID)
+    assert not reads_from_replica(PARTNER_ID)
+    # 書き込んでいないユーザーはレプリカを読む
+    assert reads_from_replica(OTHER_USER_ID)
+
+    # 再生が進めばレプリカに戻る
+    paused_replica.execute("SELECT pg_wal_replay_resume()")
+    wait_for_replay()
+    assert reads_from_replica(USER_ID)
+    assert reads_from_replica(PARTNER_ID)
+
+
+# 書き込んだリクエストの応答の Cookie で、別のワーカー（記録を持たないプロセス）に届いた読み込みもプライマリに送る
+def test_cookie_carries_write_position_across_workers(paused_replica):
+    app = FastAPI()
+    app.add_middleware(ReadYourWritesMiddleware)
+
+    @app.post("/write")
+    def write_route():
+        write()
+        return {}
+
+    @app.get("/read")
+    def read_route():
+        return {"replica": reads_from_replica()}
+
+    with TestClient(app) as client:
+        refresh_replica()
+        assert client.get("/read").json() == {"replica": True}
+
+        response = client.post("/write")
+        assert read_your_writes.COOKIE_NAME in response.cookies
+
+        read_your_writes._store = None
+        refresh_replica()
+        assert client.get("/read").json() == {"replica": False}
+
+        # Cookie を持たないクライアントはレプリカを読む
+        client.cookies.clear()
+        assert client.get("/read").json() == {"replica": True}
@@ -1,25 +1,11 @@
 from fastapi import APIRouter, HTTPException, Depends
 from pydantic import BaseModel
-import psycopg2
-import os
 import logging
+from db import get_db_connection, release_connection, execute, mark_user_write
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# データベース接続関数
-def get_db_connection():
-    try:
-        conn = psycopg2.connect(
-            host=os.getenv("DB_HOST"),
-            database=os.getenv("DB_NAME"),
-            user=os.getenv("DB_USER"),
-            password=os.getenv("DB_PASSWORD")
-        )
-        return conn
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"DB接続エラー: {str(e)}")
-
 # 検索条件を表すPydanticモデル
 class OrderSearchCriteria(BaseModel):
     order_id: int
@@ -37,61 +23,46 @@ def update_accept_order(criteria: OrderSearchCriteria):
     cursor = conn.cursor()
 
     try:
-        query = """
-            SELECT user_id
-            FROM orders
-            WHERE order_id = %s;
-        """
+        query = "get_order_user_id"
         values = (criteria.order_id,)  # タプルとして渡す
 
         logger.info(query)
         logger.info(values)
 
         # クエリの実行
-        cursor.execute(query, values)
+        execute(cursor, query, values)
         aitaku_user_id = cursor.fetchone()
 
-        query = """
-            SELECT user_id
-            FROM orders
-            WHERE order_id = %s;
-        """
+        query = "get_order_user_id"
         values = (criteria.my_order_id,)  # タプルとして渡す
 
         logger.info(query)
         logger.info(values)
 
         # クエリの実行
-        cursor.execute(query, values)
+        execute(cursor, query, values)
         myUserId = cursor.fetchone()
 
         # 指定された注文のステータスを更新するSQLクエリ
-        query = """
-            UPDATE public.orders
-            SET status='requested', aitaku_user_id = %s
-            WHERE order_id = %s;
-        """
+        query = "mark_order_requested"
         values = (myUserId, criteria.order_id,)  # タプルとして渡す
 
         logger.info(query)
         logger.info(values)
 
         # クエリの実行
-        cursor.execute(query, values)
+        execute(cursor, query, values)
 
-        query = """
-            UPDATE public.orders
-            SET status='approved_waiting', aitaku_user_id = %s
-            WHERE order_id = %s;
-        """
+        query = "mark_order_approved_waiting"
         values = (aitaku_user_id, criteria.my_order_id,)  # タプルとして渡す
 
         logger.info(query)
         logger.info(values)
 
         # クエリの実行
-        cursor.execute(query, values)
+        execute(cursor, query, values)
         conn.commit()  # 変更をデータベースに保存
+        mark_user_write(conn, myUserId and myUserId[0], aitaku_user_id and aitaku_user_id[0])
 
         return {"message": "注文が正常に更新されました。"}
 
@@ -101,7 +72,7 @@ def update_accept_order(criteria: OrderSearchCriteria):
     
     finally:
         cursor.close()
-        conn.close()
+        release_connection(conn)
 
 # 両ユーザーをマッチングするエンドポイント
 @matching_router.post("/matching")
@@ -112,32 +83,27 @@ def matching_order(criteria: OrderSearchCriteria):
 
     try:
         # 指定された注文のステータスを更新するSQLクエリ
-        query = """
-            UPDATE public.orders
-            SET status='matched'
-            WHERE order_id = %s;
-        """
+        query = "mark_order_matched"
         values = (criteria.order_id,)  # タプルとして渡す
 
         logger.info(query)
         logger.info(values)
 
         # クエリの実行
-        cursor.execute(query, values)
+        execute(cursor, query, values)
+        updated = cursor.fetchall()
 
-        query = """
-            UPDATE public.orders
-            SET status='matched'
-            WHERE order_id = %s;
-        """
+        query = "mark_order_matched"
         values = (criteria.my_order_id,)  # タプルとして渡す
 
         logger.info(query)
         logger.info(values)
 
         # クエリの実行
-        cursor.execute(query, values)
+        execute(cursor, query, values)
+        updated += cursor.fetchall()
         conn.commit()  # 変更をデータベースに保存
+        mark_user_write(conn, *[row[0] for row in updated])
 
         return {"order_id": criteria.order_id, "my_order_id": criteria.my_order_id}
         # return {"message": "注文が正常に更新されました。"}
@@ -148,4 +114,4 @@ def matching_order(criteria: OrderSearchCriteria):
     
     finally:
         cursor.close()
-        conn.close()
\ No newline at end of file
+        release_connection(conn)
\ No newline at end of file